@@ -0,0 +1,584 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Asyncio variant of the caching service
+	Same /login, /cache and /version contract as caching.py, served as a plain
+	ASGI application on top of redis.asyncio, so one process can keep thousands
+	of cache requests in flight instead of blocking a worker thread on each.
+
+	Tokens are minted with the same claims and secret as flask_jwt_extended, so a
+	token issued by either service is accepted by the other.
+
+	how-to:
+		uvicorn async_caching:app --host 0.0.0.0 --port 9090
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import redis.asyncio as aredis
+
+# import required local modules
+from cache_settings import (CONFIG, HOT_COPY_PREFIX, HOT_KEYS_CONFIG, HOT_KEYS_ENABLED, MUTATING_COMMANDS, R_MODE,
+                            R_NODES, R_POOL_CONFIG, R_VIRTUAL_NODES, SINGLE_KEY_COMMANDS)
+from distributed_cache import CachePipeline, DistributedCache
+from hot_keys import HotKeyTracker
+import metrics
+from utils import get_version
+
+JWT_SECRET_KEY = CONFIG.get('service', 'JWT_SECRET_KEY')
+JWT_ALGORITHM = 'HS256'
+# a non-JSON response body
+Text = namedtuple('Text', ['body', 'content_type'])
+JWT_ACCESS_TOKEN_EXPIRES = timedelta(minutes=15)  # flask_jwt_extended default
+
+class AsyncDistributedCache(DistributedCache):
+    def __init__(self, nodes, vnodes=R_VIRTUAL_NODES, hot_keys=None):
+        """Establish connection context
+            Routing and the request/response protocol are inherited from
+            DistributedCache; only the Redis I/O is asynchronous.
+        """
+
+        super().__init__(nodes, vnodes=vnodes, hot_keys=hot_keys)
+        self.executor.shutdown(wait=False)  # node batches fan out on the event loop instead
+        self.executor = None
+
+    def connect(self, configs):
+        """Build one bounded asyncio pool and client per connection config"""
+
+        pools = [aredis.BlockingConnectionPool(**R_POOL_CONFIG, **config) for config in configs]
+        return pools, [aredis.StrictRedis(connection_pool=pool) for pool in pools]
+
+    async def close(self):
+        """Close every node's connection pools"""
+
+        for pool in self.pools + [pool for pools in self.replica_pools for pool in pools]:
+            await pool.disconnect()
+
+    async def send_request(self, node, request):
+        """Send a request to the specified cache node and receive the response"""
+
+        if request["command"] not in SINGLE_KEY_COMMANDS:
+            return {"status": "ERROR", "message": request["command"] + " Invalid command"}
+
+        if request.get("tags"):
+            # the tag index updates ride along in the same round trip
+            return (await self.send_batch(node, [request]))[0]
+
+        start = time.perf_counter()
+        replica = self.read_replica(node, [request])
+        try:
+            if replica is None:
+                result = await self.issue_command(self.redis_clients[node], request)
+            else:
+                try:
+                    result = await self.issue_command(self.replica_clients[node][replica], request)
+                except (aredis.ConnectionError, aredis.TimeoutError) as e:
+                    metrics.observe_error(self.nodes[node], e)
+                    self.replica_sets[node].mark_down(replica)
+                    result = await self.issue_command(self.redis_clients[node], request)
+        except aredis.ResponseError as e:
+            metrics.observe_error(self.nodes[node], e)
+            return {"command": request["command"], "status": "ERROR", "message": str(e)}
+        except aredis.RedisError as e:
+            metrics.observe_error(self.nodes[node], e)
+            raise
+        metrics.observe_round_trip(self.nodes[node], [request], [result], time.perf_counter() - start)
+        return self.build_response(request, result)
+
+    async def send_batch(self, node, requests, transaction=False):
+        """Send several requests to one cache node in a single pipelined round trip"""
+
+        start = time.perf_counter()
+        replica = self.read_replica(node, requests)
+        if replica is not None:
+            try:
+                results = await self.execute_pipeline(self.replica_clients[node][replica], requests, transaction)
+            except (aredis.ConnectionError, aredis.TimeoutError) as e:
+                metrics.observe_error(self.nodes[node], e)
+                self.replica_sets[node].mark_down(replica)
+                replica = None
+        if replica is None:
+            try:
+                results = await self.execute_pipeline(self.redis_clients[node], requests, transaction)
+            except aredis.RedisError as e:
+                metrics.observe_error(self.nodes[node], e)
+                raise
+        metrics.observe_round_trip(self.nodes[node], requests, results, time.perf_counter() - start)
+
+        responses = []
+        for request, result in zip(requests, results):
+            if isinstance(result, Exception):
+                responses.append({"command": request["command"], "status": "ERROR", "message": str(result)})
+            else:
+                responses.append(self.build_response(request, result))
+        return responses
+
+    async def execute_pipeline(self, client, requests, transaction=False):
+        """Run requests through one pipeline on client, returns the raw replies"""
+
+        async with client.pipeline(transaction=transaction) as pipe:
+            for request in requests:
+                self.issue_command(pipe, request)
+            self.issue_tag_updates(pipe, requests)
+            return await pipe.execute(raise_on_error=False)
+
+    async def send_multi(self, requests, transaction=False):
+        """Group requests by target node, flush the node batches concurrently"""
+
+        by_node = {}
+        for position, request in enumerate(requests):
+            by_node.setdefault(self.get_node(request["key"]), []).append(position)
+
+        nodes = list(by_node)
+        batches = await asyncio.gather(*(
+            self.send_batch(node, [requests[position] for position in by_node[node]], transaction)
+            for node in nodes))
+
+        responses = [None] * len(requests)
+        for node, batch in zip(nodes, batches):
+            for position, response in zip(by_node[node], batch):
+                response["key"] = requests[position]["key"]
+                responses[position] = response
+        for previous, positions in self.previous_fallbacks(requests, responses).items():
+            fallbacks = await self.send_batch(previous, [requests[position] for position in positions])
+            for position, fallback in zip(positions, fallbacks):
+                fallback["key"] = requests[position]["key"]
+                responses[position] = self.merge_fallback(responses[position], fallback)
+        await self.drop_hot_copies([request["key"] for request in requests if request["command"] in MUTATING_COMMANDS])
+        return responses
+
+    async def read_hot_copy(self, key, node, target):
+        """READ a hot key from its copy on target, falling back to the owner
+            node and refilling the copy on a miss
+        """
+
+        copy_key = HOT_COPY_PREFIX + key
+        client = self.redis_clients[target]
+        try:
+            start = time.perf_counter()
+            raw = await client.get(copy_key)
+            metrics.observe_round_trip(self.nodes[target], [{"command": "READ"}], [raw], time.perf_counter() - start)
+            if raw is not None:
+                response = self.build_response({"command": "READ", "key": key}, raw)
+                response.pop("etag", None)  # the copy's bytes, not the key's
+                return response
+        except (aredis.ConnectionError, aredis.TimeoutError) as e:
+            metrics.observe_error(self.nodes[target], e)
+            return await self.send_request(node, {"command": "READ", "key": key})
+
+        response = await self.send_request(node, {"command": "READ", "key": key})
+        if response["status"] == "SUCCESS":
+            try:
+                await client.set(copy_key, self.encode_value(key, response["value"]),
+                                 px=int(self.hot_key_copy_ttl * 1000))
+            except (aredis.ConnectionError, aredis.TimeoutError) as e:
+                metrics.observe_error(self.nodes[target], e)
+        return response
+
+    async def drop_hot_copies(self, keys):
+        """Delete the copies of any replicated key among keys"""
+
+        if not self.replicated:
+            return
+        by_node = {}
+        for key in keys:
+            if key in self.replicated:
+                for node in self.ring.get_nodes(key, self.hot_key_copies)[1:]:
+                    by_node.setdefault(self.node_index[node], []).append(HOT_COPY_PREFIX + key)
+        for node, copy_keys in by_node.items():
+            try:
+                await self.redis_clients[node].delete(*copy_keys)
+            except (aredis.ConnectionError, aredis.TimeoutError) as e:
+                logging.warning("dropping hot key copies on %s failed, they expire in %ss: %s",
+                                self.nodes[node], self.hot_key_copy_ttl, e)
+
+    def pipeline(self, transaction=False):
+        """Return an AsyncCachePipeline that buffers commands until execute()"""
+
+        return AsyncCachePipeline(self, transaction=transaction)
+
+    def pool_usage(self, pool):
+        """Utilization of one connection pool"""
+
+        idle = len(pool._available_connections)
+        in_use = len(pool._in_use_connections)
+        return {
+            "host": pool.connection_kwargs.get("host"),
+            "port": pool.connection_kwargs.get("port"),
+            "db": pool.connection_kwargs.get("db"),
+            "max_connections": pool.max_connections,
+            "created": idle + in_use,
+            "in_use": in_use,
+            "idle": idle
+        }
+
+    async def read(self, key, read_your_writes=False):
+        """Send a READ request to the appropriate cache node"""
+
+        node = self.get_node(key)
+        if self.hot_keys is not None:
+            self.hot_keys.record(key)
+            hot_nodes = None if read_your_writes else self.hot_nodes(key)
+            if hot_nodes:
+                target = random.choice(hot_nodes)
+                if target != node:
+                    return await self.read_hot_copy(key, node, target)
+
+        request = {"command": "READ", "key": key}
+        if read_your_writes:
+            request["read_your_writes"] = True
+        response = await self.send_request(node, request)
+        for previous in self.previous_fallbacks([request], [response]):
+            response = self.merge_fallback(response, await self.send_request(previous, request))
+        return response
+
+    async def write(self, key, value, expire=None, tags=None):
+        """Send a WRITE request to the appropriate cache node"""
+
+        request = {'command': 'WRITE', 'key': key, 'value': value}
+        if expire is not None:
+            request['expire'] = expire
+        if tags:
+            request['tags'] = tags
+        response = await self.send_request(self.get_node(key), request)
+        await self.drop_hot_copies([key])
+        return response
+
+    async def write_nx(self, key, value, expire=None):
+        """WRITE only if key does not exist, EXISTS otherwise"""
+
+        request = {'command': 'WRITE_NX', 'key': key, 'value': value}
+        if expire is not None:
+            request['expire'] = expire
+        return await self.send_conditional(request)
+
+    async def cas(self, key, value, etag, expire=None):
+        """WRITE only if key still holds the value READ returned etag for"""
+
+        request = {'command': 'CAS', 'key': key, 'value': value, 'etag': etag}
+        if expire is not None:
+            request['expire'] = expire
+        return await self.send_conditional(request)
+
+    async def incr(self, key, amount=1, expire=None):
+        """Add amount to the integer counter at key, returns the new value"""
+
+        if self.encrypt_prefixes and key.startswith(self.encrypt_prefixes):
+            return {"command": "INCR", "status": "ERROR", "message": key + " is under an encrypted prefix"}
+        request = {'command': 'INCR', 'key': key, 'amount': amount}
+        if expire is not None:
+            request['expire'] = expire
+        return await self.send_conditional(request)
+
+    async def send_conditional(self, request):
+        """Send a WRITE_NX/CAS/INCR to the key's node"""
+
+        response = await self.send_request(self.get_node(request["key"]), request)
+        await self.drop_hot_copies([request["key"]])
+        return response
+
+    async def delete(self, key):
+        """Send a DELETE request to the appropriate cache node"""
+
+        request = {"command": "DELETE", "key": key}
+        response = await self.send_request(self.get_node(key), request)
+        for previous in self.previous_fallbacks([request], [response]):
+            response = self.merge_fallback(response, await self.send_request(previous, request))
+        await self.drop_hot_copies([key])
+        return response
+
+    async def mread(self, keys, read_your_writes=False):
+        """READ many keys, one pipelined round trip per node"""
+
+        pipe = self.pipeline()
+        for key in keys:
+            if self.hot_keys is not None:
+                self.hot_keys.record(key)
+            pipe.read(key, read_your_writes)
+        return {"command": "MREAD", "status": "SUCCESS", "results": await pipe.execute()}
+
+    async def mwrite(self, keys, values, expire=None, tags=None):
+        """WRITE many keys, one pipelined round trip per node"""
+
+        try:
+            items = self.mwrite_items(keys, values, expire)
+        except ValueError as e:
+            return {"command": "MWRITE", "status": "ERROR", "message": str(e)}
+
+        pipe = self.pipeline()
+        for key, value, key_expire in items:
+            pipe.write(key, value, key_expire, tags)
+        return {"command": "MWRITE", "status": "SUCCESS", "results": await pipe.execute()}
+
+    async def mdelete(self, keys):
+        """DELETE many keys, one pipelined round trip per node"""
+
+        pipe = self.pipeline()
+        for key in keys:
+            pipe.delete(key)
+        return {"command": "MDELETE", "status": "SUCCESS", "results": await pipe.execute()}
+
+    async def run_invalidate_tag(self, node, indexes):
+        """Run INVALIDATE_TAG_SCRIPT on one node, returns (deleted, keys listed)"""
+
+        start = time.perf_counter()
+        try:
+            deleted, listed = await self._invalidate_tag_script(keys=indexes, client=self.redis_clients[node])
+        except aredis.RedisError as e:
+            metrics.observe_error(self.nodes[node], e)
+            raise
+        metrics.observe_round_trip(self.nodes[node], [{"command": "INVALIDATE_TAG"}], [deleted],
+                                   time.perf_counter() - start)
+        return deleted, [key.decode('utf-8') for key in listed]
+
+    async def invalidate_tags(self, tags):
+        """Delete every key written with one of tags, all nodes concurrently"""
+
+        try:
+            indexes = self.tag_indexes(tags)
+        except ValueError as e:
+            return {"command": "INVALIDATE_TAG", "status": "ERROR", "message": str(e)}
+
+        results = await asyncio.gather(*(self.run_invalidate_tag(node, indexes) for node in range(len(self.nodes))))
+        keys = [key for _, node_keys in results for key in node_keys]
+        if keys:
+            await self.drop_hot_copies(keys)
+        return {"command": "INVALIDATE_TAG", "status": "SUCCESS", "tags": len(tags),
+                "deleted": sum(deleted for deleted, _ in results)}
+
+class AsyncCachePipeline(CachePipeline):
+    async def execute(self):
+        """Flush buffered requests, returns their responses in order"""
+
+        requests, self.requests = self.requests, []
+        if not requests:
+            return []
+        return await self.cache.send_multi(requests, transaction=self.transaction)
+
+# Instantiate the cache with nodes
+if R_MODE != 'ring':
+    raise ValueError(f"async_caching shards over [redis] nodes only, [redis] mode={R_MODE} needs caching.py")
+cache = AsyncDistributedCache(nodes=R_NODES, hot_keys=HotKeyTracker(**HOT_KEYS_CONFIG) if HOT_KEYS_ENABLED else None)
+metrics.register_cache(cache, key_counts=False)
+
+def create_access_token(identity):
+    """Mint an access token with the same claims flask_jwt_extended uses
+    """
+
+    now = datetime.now(timezone.utc)
+    token_data = {
+        "fresh": False,
+        "iat": now,
+        "jti": str(uuid.uuid4()),
+        "type": "access",
+        "sub": identity,
+        "nbf": now,
+        "exp": now + JWT_ACCESS_TOKEN_EXPIRES
+    }
+    return jwt.encode(token_data, JWT_SECRET_KEY, JWT_ALGORITHM)
+
+def verify_access_token(headers):
+    """Check the bearer token, returns None when valid or an (error, status) tuple
+    """
+
+    auth_header = headers.get('authorization', '')
+    if not auth_header:
+        return {"msg": "Missing Authorization Header"}, 401
+    parts = auth_header.split()
+    if len(parts) != 2 or parts[0] != 'Bearer':
+        return {"msg": "Bad Authorization header. Expected 'Authorization: Bearer <JWT>'"}, 422
+
+    try:
+        claims = jwt.decode(parts[1], JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        return {"msg": "Token has expired"}, 401
+    except jwt.InvalidTokenError as e:
+        return {"msg": str(e)}, 422
+    if claims.get('type') != 'access':
+        return {"msg": "Only non-refresh tokens are allowed"}, 422
+    return None
+
+async def version(headers, data):
+    """Get service version semver
+    """
+
+    response = get_version()
+
+    if isinstance(response, dict) and 'error' in response:
+        return response, 400
+    elif response is False:
+        return {'message': 'Version information is not available'}, 500
+    return response, 200
+
+async def pool_stats(headers, data):
+    """Redis connection pool utilization per node
+    """
+
+    error = verify_access_token(headers)
+    if error:
+        return error
+    return cache.pool_stats(), 200
+
+async def hot_keys(headers, data):
+    """Hottest keys by estimated recent READs, and which are replicated
+    """
+
+    error = verify_access_token(headers)
+    if error:
+        return error
+    return cache.hot_key_stats(), 200
+
+async def prometheus_metrics(headers, data):
+    """Prometheus scrape endpoint, answered as text rather than JSON
+    """
+
+    body, content_type = metrics.render()
+    return Text(body, content_type), 200
+
+async def login(headers, data):
+    """Generate JWT
+    """
+
+    secret = (data or {}).get('api_key')
+
+    if secret != CONFIG.get('service','SRVC_SHARED_SECRET'):
+        return {"message": "Invalid secret"}, 401
+
+    return {"access_token": create_access_token(CONFIG.get('service','IDENTITY'))}, 200
+
+async def cache_request(headers, data):
+    """Endpoint to handle caching requests"""
+
+    error = verify_access_token(headers)
+    if error:
+        return error
+
+    data = data or {}
+    command = data.get('command')
+    key = data.get('key')
+    keys = data.get('keys')
+    value = data.get('value')
+    values = data.get('values')
+    expire = data.get('expire')
+    tags = data.get('tags')
+    etag = data.get('etag')
+    amount = data.get('amount', 1)
+    read_your_writes = bool(data.get('read_your_writes'))
+
+    if command in ('MREAD', 'MWRITE', 'MDELETE') and not (isinstance(keys, list)
+                                                         and all(isinstance(key, str) for key in keys)):
+        return {"status": "ERROR", "message": command + " requires a list of string keys"}, 200
+    if command in ('WRITE', 'MWRITE', 'INVALIDATE_TAG') and tags is not None:
+        try:
+            cache.tag_indexes(tags)
+        except ValueError as e:
+            return {"status": "ERROR", "message": str(e)}, 200
+
+    if command == 'READ':
+        return await cache.read(key, read_your_writes), 200
+    elif command == 'WRITE':
+        return await cache.write(key, value, expire, tags), 200
+    elif command == 'DELETE':
+        return await cache.delete(key), 200
+    elif command == 'WRITE_NX':
+        return await cache.write_nx(key, value, expire), 200
+    elif command == 'CAS':
+        if not isinstance(etag, str):
+            return {"status": "ERROR", "message": command + " requires the etag from a READ"}, 200
+        return await cache.cas(key, value, etag, expire), 200
+    elif command == 'INCR':
+        if not isinstance(amount, int) or isinstance(amount, bool):
+            return {"status": "ERROR", "message": command + " amount must be an integer"}, 200
+        return await cache.incr(key, amount, expire), 200
+    elif command == 'MREAD':
+        return await cache.mread(keys, read_your_writes), 200
+    elif command == 'MWRITE':
+        if not isinstance(values, list):
+            return {"status": "ERROR", "message": command + " requires a list of values"}, 200
+        return await cache.mwrite(keys, values, expire, tags), 200
+    elif command == 'MDELETE':
+        return await cache.mdelete(keys), 200
+    elif command == 'INVALIDATE_TAG':
+        return await cache.invalidate_tags(tags), 200
+    else:
+        return {"status": "ERROR", "message": "Invalid command"}, 200
+
+ROUTES = {
+    ('GET', '/version'): version,
+    ('GET', '/pool_stats'): pool_stats,
+    ('GET', '/metrics'): prometheus_metrics,
+    ('GET', '/hot_keys'): hot_keys,
+    ('POST', '/login'): login,
+    ('POST', '/cache'): cache_request
+}
+
+async def read_body(receive):
+    """Read the whole request body"""
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+async def send_json(send, payload, status):
+    """Send a JSON response, or a Text one as is"""
+
+    if isinstance(payload, Text):
+        body, content_type = payload.body, payload.content_type
+    else:
+        body, content_type = json.dumps(payload).encode(), 'application/json'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()),
+                    (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def lifespan(receive, send):
+    """Close Redis pools on shutdown"""
+
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await cache.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        await send_json(send, {"message": "Not Found"}, 404)
+        return
+
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+               for name, value in scope['headers']}
+    body = await read_body(receive)
+    data = None
+    if body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            await send_json(send, {"message": "Invalid JSON body"}, 400)
+            return
+
+    payload, status = await handler(headers, data)
+    await send_json(send, payload, status)
@@ -0,0 +1,11 @@
+"""©2024, Ovais Quraishi
+
+    LICENSE: The 3-Clause BSD License - license.txt
+"""
+import uvicorn
+
+from async_caching import app
+from config import get_config
+
+if __name__ == "__main__":
+    uvicorn.run(app, host='0.0.0.0', port=int(get_config().get('service', 'PORT')))
@@ -0,0 +1,311 @@
+# backend_loader.py
+# ©2024, Ovais Quraishi
+"""Read-through and write-behind in front of any backend, for the middleware layer
+
+    CachedLoader.cached() wraps a backend fetch function:
+        loader = CachedLoader(cache_client, ttl=600, negative_ttl=30)
+
+        @loader.cached(lambda item_id: f"item:{item_id}")
+        def fetch_item(item_id):
+            response = session.get(f"{BACKEND_URL}/{item_id}")
+            if response.status_code == 404:
+                raise NotFound(item_id)
+            response.raise_for_status()
+            return response.json()
+
+    * a cache hit never reaches the backend
+    * NotFound is cached too, for negative_ttl seconds, and raised again from
+      the cache, so lookups of missing ids do not hammer the backend
+    * TTLs get +/- jitter, so keys filled together do not expire together
+    * concurrent calls for the same key in this process share one cache READ
+      and at most one backend fetch
+    * when the caching service is down the backend is called directly
+
+    WriteBehind writes to the cache right away and hands the backend writes to
+    a background thread, which sends everything queued within `window`
+    seconds as one write_batch({key: value}) call, the last value per key.
+    A failed batch is retried with backoff; if it never goes through its keys
+    are deleted from the cache, which must not keep values the backend lacks.
+
+    cache_client is a CacheClient, or anything with the same read/write/delete
+    responses (DistributedCache).
+"""
+
+import functools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+import requests
+
+from resilience import CircuitOpenError, backoff_delays
+
+# stored in place of a value the backend does not have
+NOT_FOUND_MARKER = {"__not_found__": True}
+# errors after which the cache is skipped and the backend called directly;
+#   ValueError is how CacheClient fails the calls of a batch the service refused
+CACHE_UNAVAILABLE = (requests.exceptions.RequestException, CircuitOpenError, ValueError)
+
+class NotFound(Exception):
+    """Raised by a fetch function for a missing item, and for its cached miss"""
+
+class CachedLoader:
+    def __init__(self, cache_client, ttl=600, jitter=0.1, negative_ttl=30):
+        """ttl and negative_ttl in seconds, jitter a fraction of the TTL"""
+
+        self.cache_client = cache_client
+        self.ttl = ttl
+        self.jitter = jitter
+        self.negative_ttl = negative_ttl
+        self._inflight = {}  # key -> Future of (found, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.backend_calls = 0
+        self.cache_errors = 0
+
+    def expire_for(self, ttl):
+        """ttl with jitter, whole seconds and at least 1"""
+
+        return max(1, round(ttl * (1 + random.uniform(-self.jitter, self.jitter))))
+
+    def cached(self, key_func, ttl=None, negative_ttl=None):
+        """Decorator: cache fetch(*args, **kwargs) under key_func(*args, **kwargs)
+            The wrapped function gets .invalidate(*args, **kwargs).
+        """
+
+        def decorate(fetch):
+            @functools.wraps(fetch)
+            def wrapper(*args, **kwargs):
+                return self.get(key_func(*args, **kwargs), lambda: fetch(*args, **kwargs), ttl, negative_ttl)
+
+            wrapper.invalidate = lambda *args, **kwargs: self.invalidate(key_func(*args, **kwargs))
+            return wrapper
+        return decorate
+
+    def get(self, key, fetch, ttl=None, negative_ttl=None):
+        """Value for key from the cache, or from fetch() on a miss
+            Raises NotFound for items the backend does not have.
+        """
+
+        with self._lock:
+            inflight = self._inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                inflight.set_result(self.load(key, fetch, ttl, negative_ttl))
+            except Exception as e:
+                inflight.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+
+        found, value = inflight.result()
+        if not found:
+            raise NotFound(key)
+        return value
+
+    def load(self, key, fetch, ttl, negative_ttl):
+        """Cache READ, then the backend on a miss; returns (found, value)"""
+
+        try:
+            response = self.cache_client.read(key)
+        except CACHE_UNAVAILABLE as e:
+            self.cache_errors += 1
+            logging.warning("cache read of %s failed, calling the backend: %s", key, e)
+            return self.fetch(fetch, key, None, None)
+
+        if response.get("status") == "SUCCESS":
+            if response["value"] == NOT_FOUND_MARKER:
+                self.negative_hits += 1
+                return False, None
+            self.hits += 1
+            return True, response["value"]
+        self.misses += 1
+        return self.fetch(fetch, key, self.ttl if ttl is None else ttl,
+                          self.negative_ttl if negative_ttl is None else negative_ttl)
+
+    def fetch(self, fetch, key, ttl, negative_ttl):
+        """Call the backend, cache what it returned unless ttl is None"""
+
+        self.backend_calls += 1
+        try:
+            found, value = True, fetch()
+        except NotFound:
+            found, value = False, None
+        if ttl is None or (not found and not negative_ttl):
+            return found, value
+
+        try:
+            if found:
+                self.cache_client.write(key, value, self.expire_for(ttl))
+            else:
+                self.cache_client.write(key, NOT_FOUND_MARKER, self.expire_for(negative_ttl))
+        except CACHE_UNAVAILABLE as e:
+            self.cache_errors += 1
+            logging.warning("caching %s failed: %s", key, e)
+        return found, value
+
+    def invalidate(self, key):
+        """Drop key from the cache, e.g. after the backend item changed"""
+
+        return self.cache_client.delete(key)
+
+    def stats(self):
+        """Cache hits, misses and how often the backend was called"""
+
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "backend_calls": self.backend_calls,
+            "cache_errors": self.cache_errors
+        }
+
+class WriteBehind:
+    def __init__(self, cache_client, write_batch, ttl=600, window=0.05, max_batch=100,
+                 retries=3, backoff=0.1):
+        """Cache writes now, backend writes batched in the background
+            write_batch({key: value}) persists one batch to the backend. A
+            failing batch is retried up to retries times, with full jitter
+            backoff, before later batches are sent, so writes to a key still
+            reach the backend in order.
+        """
+
+        self.cache_client = cache_client
+        self.write_batch = write_batch
+        self.ttl = ttl
+        self.window = window
+        self.max_batch = max_batch
+        self.retries = retries
+        self.backoff = backoff
+        self._queue = Queue()
+        self._dispatcher = None
+        self._dispatcher_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.queued = 0
+        self.batches = 0
+        self.written = 0
+        self.retried_batches = 0
+        self.failed_batches = 0
+        self.invalidated = 0
+
+    def ensure_dispatcher(self):
+        """Start the batching thread on first use"""
+
+        with self._dispatcher_lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self.dispatch, name="write-behind", daemon=True)
+                self._dispatcher.start()
+
+    def write(self, key, value):
+        """Cache value now, queue the backend write
+            Returns a Future resolved once the batch holding it was written.
+        """
+
+        self.cache_client.write(key, value, self.ttl)
+        future = Future()
+        self.ensure_dispatcher()
+        with self._stats_lock:
+            self.queued += 1
+        self._queue.put((key, value, future))
+        return future
+
+    def dispatch(self):
+        """Collect queued writes for window seconds, then send them"""
+
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+            self.send(pending)
+
+    def send(self, pending):
+        """Write one batch, the last value per key, resolve its futures"""
+
+        batch = {key: value for key, value, _ in pending if key is not None}  # None: a flush() marker
+        try:
+            if batch:
+                self.write_with_retries(batch)
+        except Exception as e:
+            logging.error("write-behind batch of %d keys failed, dropping them from the cache: %s", len(batch), e)
+            self.invalidate(batch)
+            with self._stats_lock:
+                self.failed_batches += 1
+            for _, _, future in pending:
+                future.set_exception(e)
+            return
+        if batch:
+            with self._stats_lock:
+                self.batches += 1
+                self.written += len(batch)
+        for _, _, future in pending:
+            future.set_result(len(batch))
+
+    def write_with_retries(self, batch):
+        """write_batch(batch), retried with backoff; raises the last error"""
+
+        delays = backoff_delays(self.retries, self.backoff)
+        for attempt in range(self.retries + 1):
+            try:
+                return self.write_batch(batch)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logging.warning("write-behind batch of %d keys failed, retrying: %s", len(batch), e)
+                with self._stats_lock:
+                    self.retried_batches += 1
+                time.sleep(delays[attempt])
+
+    def invalidate(self, batch):
+        """Delete the keys of a batch the backend never got from the cache
+            Their next read then loads what the backend really has.
+        """
+
+        for key in batch:
+            try:
+                self.cache_client.delete(key)
+            except CACHE_UNAVAILABLE as e:
+                logging.error("could not drop %s from the cache, it may be served until it expires: %s", key, e)
+                continue
+            with self._stats_lock:
+                self.invalidated += 1
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far reached the backend"""
+
+        marker = Future()
+        self.ensure_dispatcher()
+        self._queue.put((None, None, marker))
+        marker.result(timeout)
+
+    def stats(self):
+        """Writes queued, backend batches, keys written and failures"""
+
+        with self._stats_lock:
+            return {
+                "queued": self.queued,
+                "batches": self.batches,
+                "written": self.written,
+                "retried_batches": self.retried_batches,
+                "failed_batches": self.failed_batches,
+                "invalidated": self.invalidated
+            }
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark AsyncCacheClient with 10k concurrent lookups
+
+    Runs a stand-in for the caching service (keep-alive HTTP/1.1, /login and
+    /cache backed by a dict) in a separate process, then fires --lookups
+    concurrent READs over --keys distinct keys, so hot keys repeat and get
+    coalesced. Reports lookups/sec, p50/p99 and how many HTTP requests were
+    actually sent. Needs neither Redis nor setup.config beyond what
+    cache_client imports.
+   how-to:
+        ./bench_async_client.py --lookups 10000 --keys 1000
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+import jwt
+
+from async_cache_client import AsyncCacheClient
+
+STAND_IN_SECRET = "stand-in-secret-for-the-benchmark-only"
+
+async def handle(reader, writer, store):
+    """Serve keep-alive requests on one connection"""
+
+    while True:
+        request_line = await reader.readline()
+        if not request_line:
+            break
+        _, path, _ = request_line.decode().split(' ', 2)
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        data = json.loads(await reader.readexactly(length)) if length else {}
+
+        if path == '/login':
+            token = jwt.encode({"sub": "bench", "exp": int(time.time()) + 900}, STAND_IN_SECRET, 'HS256')
+            payload = {"access_token": token}
+        elif data.get('command') == 'READ':
+            await asyncio.sleep(0.001)  # stand-in for the Redis round trip
+            if data['key'] in store:
+                payload = {"command": "READ", "status": "SUCCESS", "value": store[data['key']]}
+            else:
+                payload = {"command": "READ", "status": "NOT_FOUND", "message": data['key'] + " Key not found"}
+        elif data.get('command') == 'MWRITE':
+            store.update(zip(data['keys'], data['values']))
+            payload = {"command": "MWRITE", "status": "SUCCESS", "results": []}
+        else:
+            payload = {"status": "ERROR", "message": "Invalid command"}
+
+        body = json.dumps(payload).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+    writer.close()
+
+def serve(port):
+    """Stand-in caching service process"""
+
+    async def main():
+        store = {}
+        server = await asyncio.start_server(lambda r, w: handle(r, w, store), '127.0.0.1', port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+async def drive(args):
+    """Fire the lookups, return (elapsed, latencies, client)"""
+
+    base = f"http://127.0.0.1:{args.port}"
+    async with AsyncCacheClient(base + '/cache', base + '/login', 'bench',
+                                max_concurrency=args.concurrency, max_connections=args.connections) as client:
+        keys = [f"bench:{i}" for i in range(args.keys)]
+        await client.mwrite(keys, [{"id": i} for i in range(args.keys)])
+        client.requests_sent = 0
+
+        latencies = []
+
+        async def lookup(i):
+            start = time.perf_counter()
+            await client.read(keys[i % len(keys)])
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(lookup(i) for i in range(args.lookups)))
+        return time.perf_counter() - start, sorted(latencies), client
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--port', type=int, default=9093)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=serve, args=(args.port,), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    try:
+        elapsed, latencies, client = asyncio.run(drive(args))
+    finally:
+        server.terminate()
+
+    p = lambda fraction: latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+    print(f"lookups={args.lookups} keys={args.keys} concurrency={args.concurrency} connections={args.connections}")
+    print(f"{args.lookups / elapsed:10.0f} lookups/s   p50 {p(0.50):7.2f} ms   p99 {p(0.99):7.2f} ms")
+    print(f"HTTP requests sent {client.requests_sent}, READs coalesced {client.reads_coalesced}")
+
+if __name__ == "__main__":
+    main()
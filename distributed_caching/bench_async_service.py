@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Load benchmark: Flask+gunicorn caching service vs the asyncio/ASGI one
+
+    Starts both services as subprocesses against the Redis in setup.config (or a
+    local fakeredis stand-in with --fake-redis), drives each with the same
+    number of concurrent keep-alive clients issuing READs and reports
+    requests/sec with p50/p99 latency.
+   how-to:
+        ./bench_async_service.py --fake-redis --requests 20000 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+
+from config import get_config
+
+CONFIG = get_config()
+
+def start_fake_redis():
+    """Serve a fakeredis instance on the host/port from setup.config"""
+
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        sys.exit("--fake-redis needs the fakeredis package (pip install fakeredis)")
+
+    server = TcpFakeServer((CONFIG.get('redis', 'host'), CONFIG.getint('redis', 'port')),
+                           server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class HttpConnection:
+    def __init__(self, host, port):
+        """Minimal HTTP/1.1 keep-alive client, reconnects when the server closes"""
+
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, payload=None, token=None):
+        """Send a request, return (status, parsed JSON body)"""
+
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        body = json.dumps(payload).encode() if payload is not None else b''
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                "Content-Type: application/json", f"Content-Length: {len(body)}"]
+        if token:
+            head.append(f"Authorization: Bearer {token}")
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+
+        status_line = await self.reader.readline()
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        data = await self.reader.readexactly(int(headers.get('content-length', 0)))
+
+        if headers.get('connection', '').lower() == 'close':
+            self.writer.close()
+            self.writer = None
+        return status, json.loads(data) if data else None
+
+async def wait_until_up(port, timeout=30):
+    """Poll /version until the service answers"""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await HttpConnection('127.0.0.1', port).request('GET', '/version')
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"service on port {port} did not start")
+
+async def drive(port, total, concurrency):
+    """Run total READs over concurrency connections, return (req/s, latencies)"""
+
+    login = HttpConnection('127.0.0.1', port)
+    _, body = await login.request('POST', '/login',
+                                  {'api_key': CONFIG.get('service', 'SRVC_SHARED_SECRET')})
+    token = body['access_token']
+    await login.request('POST', '/cache', {'command': 'WRITE', 'key': 'bench_key', 'value': 'x' * 100}, token)
+
+    latencies = []
+    remaining = [total]
+
+    async def client():
+        conn = HttpConnection('127.0.0.1', port)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.perf_counter()
+            await conn.request('POST', '/cache', {'command': 'READ', 'key': 'bench_key'}, token)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, sorted(latencies)
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile"""
+
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def run(name, command, port, args):
+    """Start a service, benchmark it, stop it"""
+
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        asyncio.run(wait_until_up(port))
+        rps, latencies = asyncio.run(drive(port, args.requests, args.concurrency))
+    finally:
+        proc.terminate()
+        proc.wait()
+    print(f"{name:16} {rps:10.0f} req/s   p50 {percentile(latencies, 0.50) * 1000:7.2f} ms"
+          f"   p99 {percentile(latencies, 0.99) * 1000:7.2f} ms")
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=2, help='processes per service')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--fake-redis', action='store_true', help='serve a fakeredis stand-in')
+    args = parser.parse_args()
+
+    if args.fake_redis:
+        start_fake_redis()
+
+    print(f"requests={args.requests} concurrency={args.concurrency} workers={args.workers}")
+    run('flask+gunicorn',
+        [sys.executable, '-m', 'gunicorn', 'caching:app', '--bind', '127.0.0.1:9091',
+         '--workers', str(args.workers), '--threads', str(args.threads), '--log-level', 'warning'],
+        9091, args)
+    run('asgi+uvicorn',
+        [sys.executable, '-m', 'uvicorn', 'async_caching:app', '--host', '127.0.0.1', '--port', '9092',
+         '--workers', str(args.workers), '--log-level', 'warning'],
+        9092, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark CachedLoader and WriteBehind against a local fake HTTP backend
+
+    The backend sleeps --latency seconds per request and answers 404 for every
+    tenth id. --threads threads read --reads ids drawn from a Zipf(--skew)
+    distribution over --ids ids: straight from the backend, through the
+    read/miss/fetch/write pattern middleware.py used to hand roll (404s not
+    cached, no coalescing), and through CachedLoader. Then --writes updates go
+    to the backend one POST each, and through WriteBehind. Prints backend
+    calls, caller latency p50/p99 and throughput for each.
+    Needs the Redis nodes in setup.config; keys live under bench:loader:<run>:.
+   how-to:
+        ./bench_backend_loader.py --reads 20000 --ids 2000 --threads 32 --latency 0.005
+"""
+
+import argparse
+import bisect
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from backend_loader import CachedLoader, NotFound, WriteBehind
+from cache_settings import R_NODES
+from distributed_cache import DistributedCache
+
+class FakeBackend(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency):
+        """Slow local backend counting its GETs and POSTs"""
+
+        super().__init__(("127.0.0.1", 0), BackendHandler)
+        self.latency = latency
+        self.gets = 0
+        self.posts = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/items"
+
+class BackendHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, status, payload):
+        """Send a JSON response"""
+
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.gets += 1
+        time.sleep(self.server.latency)
+        item_id = int(self.path.rsplit('/', 1)[-1])
+        if item_id % 10 == 0:
+            self.reply(404, {"message": "not found"})
+        else:
+            self.reply(200, {"id": item_id, "name": f"item {item_id}"})
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.posts += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.latency)
+        self.reply(200, {"status": "ok"})
+
+    def log_message(self, *args):
+        pass
+
+def zipf_ids(ids, skew, count, seed=7):
+    """count ids drawn from a Zipf distribution, id 0 the most popular"""
+
+    rng = random.Random(seed)
+    cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, ids + 1)))
+    return [bisect.bisect(cumulative, rng.random() * cumulative[-1]) for _ in range(count)]
+
+def percentile(values, fraction):
+    """Nearest rank percentile of values"""
+
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def run(label, call, items, threads, backend, counter):
+    """Call call(item) for every item from threads threads, print one result line"""
+
+    before = getattr(backend, counter)
+    latencies = []
+
+    def timed(item):
+        start = time.perf_counter()
+        call(item)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(timed, items))
+    elapsed = time.perf_counter() - start
+    calls = getattr(backend, counter) - before
+    print(f"{label:24} backend calls {calls:7d} ({calls / len(items):6.1%})  "
+          f"p50 {percentile(latencies, 0.5) * 1000:7.2f} ms  p99 {percentile(latencies, 0.99) * 1000:7.2f} ms  "
+          f"{len(items) / elapsed:8.0f} ops/s")
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reads', type=int, default=20000)
+    parser.add_argument('--writes', type=int, default=5000)
+    parser.add_argument('--ids', type=int, default=2000)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.005, help='backend seconds per request')
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.latency)
+    threading.Thread(target=backend.serve_forever, daemon=True).start()
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.threads))
+    cache = DistributedCache(nodes=R_NODES)
+    run_id = int(time.time())
+    reads = zipf_ids(args.ids, args.skew, args.reads)
+    print(f"reads={args.reads} ids={args.ids} skew={args.skew} threads={args.threads} "
+          f"backend latency={args.latency * 1000:.1f}ms")
+
+    def backend_get(item_id):
+        response = session.get(f"{backend.url}/{item_id}")
+        if response.status_code == 404:
+            raise NotFound(item_id)
+        response.raise_for_status()
+        return response.json()
+
+    def uncached(item_id):
+        try:
+            return backend_get(item_id)
+        except NotFound:
+            return None
+
+    def naive(item_id):
+        key = f"bench:loader:{run_id}:naive:{item_id}"
+        response = cache.read(key)
+        if response["status"] == "SUCCESS":
+            return response["value"]
+        try:
+            value = backend_get(item_id)
+        except NotFound:
+            return None
+        cache.write(key, value, 600)
+        return value
+
+    loader = CachedLoader(cache, ttl=600, jitter=0.1, negative_ttl=30)
+    cached_get = loader.cached(lambda item_id: f"bench:loader:{run_id}:loader:{item_id}")(backend_get)
+
+    def loaded(item_id):
+        try:
+            return cached_get(item_id)
+        except NotFound:
+            return None
+
+    run("backend only", uncached, reads, args.threads, backend, "gets")
+    run("naive read-through", naive, reads, args.threads, backend, "gets")
+    run("CachedLoader", loaded, reads, args.threads, backend, "gets")
+    print(f"CachedLoader {loader.stats()}")
+
+    writes = [(item_id, {"id": item_id, "updated": index}) for index, item_id in
+              enumerate(zipf_ids(args.ids, args.skew, args.writes, seed=13))]
+
+    def direct_write(item):
+        item_id, value = item
+        cache.write(f"bench:loader:{run_id}:w:{item_id}", value, 600)
+        session.post(f"{backend.url}/batch", json={str(item_id): value}).raise_for_status()
+
+    def write_batch(batch):
+        session.post(f"{backend.url}/batch", json=batch).raise_for_status()
+
+    write_behind = WriteBehind(cache, write_batch, ttl=600, window=0.05, max_batch=500)
+
+    def behind_write(item):
+        item_id, value = item
+        write_behind.write(f"bench:loader:{run_id}:w:{item_id}", value)
+
+    print(f"writes={args.writes}")
+    run("write-through", direct_write, writes, args.threads, backend, "posts")
+    posts = backend.posts
+    run("WriteBehind (queued)", behind_write, writes, args.threads, backend, "posts")
+    write_behind.flush()
+    print(f"WriteBehind backend calls after flush {backend.posts - posts} {write_behind.stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark encryption: ops/sec before and after caching the cipher
+
+    "before" is the old behaviour, reading the key file and building a Fernet
+    on every call; "after" is encrypt_text/decrypt_text on the cached cipher,
+    and encrypt_many/decrypt_many on a batch. Uses a throwaway key file, so no
+    real key is needed.
+   how-to:
+        ./bench_encryption.py --ops 20000 --size 256
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from cryptography.fernet import Fernet
+
+import encryption
+
+def old_encrypt(text):
+    """encrypt_text as it was: key file read and Fernet built per call"""
+
+    return Fernet(encryption.load_key()).encrypt(text.encode())
+
+def old_decrypt(token):
+    """decrypt_text as it was"""
+
+    return Fernet(encryption.load_key()).decrypt(token).decode()
+
+def ops_per_sec(func, items):
+    """Calls per second of func over items"""
+
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - start)
+
+def batch_ops_per_sec(func, items):
+    """Items per second of one batch call"""
+
+    start = time.perf_counter()
+    func(items)
+    return len(items) / (time.perf_counter() - start)
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=256, help='plaintext bytes')
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('wb', suffix='.key', delete=False) as key_file:
+        key_file.write(Fernet.generate_key())
+    encryption.KEY_FILE = key_file.name
+    try:
+        texts = [os.urandom(args.size // 2).hex() for _ in range(args.ops)]
+        tokens = encryption.encrypt_many(texts)
+
+        print(f"ops={args.ops} size={args.size} bytes cpus={os.cpu_count()}")
+        print(f"  {'':22} {'encrypt/s':>10} {'decrypt/s':>10}")
+        print(f"  {'before (per call)':22} {ops_per_sec(old_encrypt, texts):10.0f} "
+              f"{ops_per_sec(old_decrypt, tokens):10.0f}")
+        print(f"  {'after (cached cipher)':22} {ops_per_sec(encryption.encrypt_text, texts):10.0f} "
+              f"{ops_per_sec(encryption.decrypt_text, tokens):10.0f}")
+        print(f"  {'after (*_many)':22} {batch_ops_per_sec(encryption.encrypt_many, texts):10.0f} "
+              f"{batch_ops_per_sec(encryption.decrypt_many, tokens):10.0f}")
+    finally:
+        os.unlink(key_file.name)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark the consistent hash ring against plain modulo routing
+
+    Reports lookup latency and the fraction of keys that change owner when a
+    node joins or leaves. Does not need Redis or setup.config.
+   how-to:
+        ./bench_hash_ring.py --keys 200000 --nodes 3 --vnodes 160
+"""
+
+import argparse
+import time
+
+from hash_ring import HashRing, ring_hash
+
+def modulo_owner(nodes, key):
+    """The routing DistributedCache used before the hash ring"""
+
+    return nodes[ring_hash(key) % len(nodes)]
+
+def moved_fraction(keys, before, after):
+    """Fraction of keys whose owner differs between two routing functions"""
+
+    moved = sum(1 for key in keys if before(key) != after(key))
+    return moved / len(keys)
+
+def lookup_latency_ns(lookup, keys):
+    """Average nanoseconds per lookup"""
+
+    start = time.perf_counter_ns()
+    for key in keys:
+        lookup(key)
+    return (time.perf_counter_ns() - start) / len(keys)
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=200000)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--vnodes', type=int, default=160)
+    args = parser.parse_args()
+
+    keys = [f"key:{i}" for i in range(args.keys)]
+    nodes = [f"node{i + 1}" for i in range(args.nodes)]
+    joined = nodes + [f"node{args.nodes + 1}"]
+    left = nodes[:-1]
+
+    ring = HashRing(nodes, vnodes=args.vnodes)
+    ring_joined = HashRing(joined, vnodes=args.vnodes)
+    ring_left = HashRing(left, vnodes=args.vnodes)
+
+    print(f"keys={args.keys} nodes={args.nodes} vnodes={args.vnodes}")
+    print(f"ring   lookup: {lookup_latency_ns(ring.get_node, keys):8.0f} ns/key")
+    print(f"modulo lookup: {lookup_latency_ns(lambda k: modulo_owner(nodes, k), keys):8.0f} ns/key")
+
+    print(f"ideal moved on join : {1 / len(joined):.3f}")
+    print(f"ring   moved on join : {moved_fraction(keys, ring.get_node, ring_joined.get_node):.3f}")
+    print(f"modulo moved on join : {moved_fraction(keys, lambda k: modulo_owner(nodes, k), lambda k: modulo_owner(joined, k)):.3f}")
+
+    if left:
+        print(f"ideal moved on leave: {1 / len(nodes):.3f}")
+        print(f"ring   moved on leave: {moved_fraction(keys, ring.get_node, ring_left.get_node):.3f}")
+        print(f"modulo moved on leave: {moved_fraction(keys, lambda k: modulo_owner(nodes, k), lambda k: modulo_owner(left, k)):.3f}")
+
+    # balance: share of keys owned by each node
+    counts = {node: 0 for node in nodes}
+    for key in keys:
+        counts[ring.get_node(key)] += 1
+    shares = ", ".join(f"{node}={count / len(keys):.3f}" for node, count in counts.items())
+    print(f"ring balance: {shares}")
+
+if __name__ == "__main__":
+    main()
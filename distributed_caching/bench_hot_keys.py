@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark hot key replication under a Zipfian READ load
+
+    Draws --reads keys from a Zipf(--skew) distribution over --keys keys and
+    routes each READ the way DistributedCache does: to the key's owner on the
+    hash ring, or, once HotKeyTracker reports the key hot, to any one of the
+    --copies nodes holding it. Prints each node's share of the READs with and
+    without replication, how many of the true top keys the tracker found, and
+    what recording an access costs. Does not need Redis or setup.config.
+   how-to:
+        ./bench_hot_keys.py --reads 500000 --keys 100000 --skew 1.1 --nodes 3 --copies 3
+"""
+
+import argparse
+import bisect
+import itertools
+import random
+import time
+from collections import Counter
+
+from hash_ring import HashRing
+from hot_keys import DEFAULT_THRESHOLD, HotKeyTracker
+
+def zipf_keys(keys, skew, reads, seed=7):
+    """reads keys drawn from a Zipf distribution, key 0 the most popular"""
+
+    rng = random.Random(seed)
+    cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, keys + 1)))
+    return [f"key:{bisect.bisect(cumulative, rng.random() * cumulative[-1])}" for _ in range(reads)]
+
+def route(stream, ring, tracker, copies):
+    """READs served per node"""
+
+    rng = random.Random(11)
+    load = Counter()
+    for key in stream:
+        if tracker is not None:
+            tracker.record(key)
+            if copies > 1 and tracker.is_hot(key):
+                load[rng.choice(ring.get_nodes(key, copies))] += 1
+                continue
+        load[ring.get_node(key)] += 1
+    return load
+
+def report(label, load, nodes, reads):
+    """One line of per-node shares and the max/mean imbalance"""
+
+    shares = [load[node] / reads for node in nodes]
+    shares_text = " ".join(f"{node}={share:6.1%}" for node, share in zip(nodes, shares))
+    print(f"{label:22} {shares_text}   max/mean {max(shares) * len(nodes):.2f}")
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reads', type=int, default=500000)
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--copies', type=int, default=3)
+    parser.add_argument('--top-k', type=int, default=100)
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    nodes = [f"node{i + 1}" for i in range(args.nodes)]
+    ring = HashRing(nodes)
+    stream = zipf_keys(args.keys, args.skew, args.reads)
+    print(f"reads={args.reads} keys={args.keys} skew={args.skew} copies={args.copies} "
+          f"top_k={args.top_k} threshold={args.threshold}")
+
+    report("owner only", route(stream, ring, None, 1), nodes, args.reads)
+    tracker = HotKeyTracker(top_k=args.top_k, threshold=args.threshold, decay_interval=3600)
+    start = time.perf_counter()
+    load = route(stream, ring, tracker, args.copies)
+    elapsed = time.perf_counter() - start
+    report("hot keys replicated", load, nodes, args.reads)
+
+    true_top = {key for key, _ in Counter(stream).most_common(args.top_k)}
+    found = {key for key, _ in tracker.top()}
+    hot = [key for key, estimate in tracker.top() if estimate >= args.threshold]
+    print(f"top-{args.top_k} recall {len(true_top & found) / len(true_top):.0%}, {len(hot)} keys hot")
+    print(f"routing with tracking {elapsed / args.reads * 1e6:.2f} us/read")
+
+if __name__ == "__main__":
+    main()
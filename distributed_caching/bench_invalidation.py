@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark the invalidation bus: propagation latency and coalescing
+
+    Starts --subscribers processes listening on the invalidation channel, the
+    way every service instance does, then has --threads threads call
+    invalidate() --calls times in total. Each subscriber timestamps the
+    messages it receives against their "sent" field; the p50/p99 of that is
+    how long an invalidation takes to reach another instance. Coalescing is
+    calls per flush (one DELETE round trip per node and one message each).
+    Needs the Redis nodes in setup.config; it deletes bench:inv:* keys only.
+   how-to:
+        ./bench_invalidation.py --calls 20000 --threads 16 --subscribers 4 --window-ms 5
+"""
+
+import argparse
+import json
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from cache_settings import NEAR_CACHE_CHANNEL, R_NODES, node_redis_config
+from distributed_cache import DistributedCache
+from invalidation import WATERMARKS_KEY, InvalidationBus
+
+def subscriber(node, channel, ready, results):
+    """Receive until the stop message, report the propagation delays in seconds"""
+
+    pubsub = redis.StrictRedis(**node_redis_config(node)).pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(channel)
+    ready.set()
+    delays = []
+    for message in pubsub.listen():
+        received = time.time()
+        payload = json.loads(message["data"])
+        if not isinstance(payload, dict):
+            continue  # key list from an ordinary WRITE/DELETE
+        if payload.get("stop"):
+            break
+        delays.append(received - payload["sent"])
+    results.put(delays)
+
+def percentile(values, fraction):
+    """Nearest rank percentile of values"""
+
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--window-ms', type=float, default=5)
+    parser.add_argument('--prefix-every', type=int, default=100, help='every Nth call invalidates a prefix')
+    args = parser.parse_args()
+
+    cache = DistributedCache(nodes=R_NODES)
+    bus = InvalidationBus(cache, NEAR_CACHE_CHANNEL, window=args.window_ms / 1000).start()
+    publisher = bus.watermark_client()
+
+    ready = [multiprocessing.Event() for _ in range(args.subscribers)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=subscriber, daemon=True,
+                                         args=(cache.nodes[cache.get_node(WATERMARKS_KEY)],
+                                               NEAR_CACHE_CHANNEL, event, results))
+                 for event in ready]
+    for process in processes:
+        process.start()
+    for event in ready:
+        event.wait()
+
+    def call(index):
+        if index % args.prefix_every == 0:
+            return bus.invalidate(prefixes=[f"bench:inv:{index % 10}:"]).result()
+        return bus.invalidate(keys=[f"bench:inv:{index}"]).result()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        list(executor.map(call, range(args.calls)))
+    elapsed = time.perf_counter() - start
+
+    publisher.publish(NEAR_CACHE_CHANNEL, json.dumps({"stop": True}))
+    delays = [delay for _ in processes for delay in results.get()]
+    for process in processes:
+        process.join()
+    publisher.hdel(WATERMARKS_KEY, *[f"bench:inv:{digit}:" for digit in range(10)])
+
+    stats = bus.stats()
+    print(f"calls={args.calls} threads={args.threads} subscribers={args.subscribers} window={args.window_ms}ms")
+    print(f"{args.calls / elapsed:.0f} invalidations/s, {stats['flushes']} flushes, "
+          f"{stats['requested'] / max(stats['flushes'], 1):.1f} calls per flush")
+    if delays:
+        print(f"propagation p50 {percentile(delays, 0.5) * 1000:.2f} ms  "
+              f"p99 {percentile(delays, 0.99) * 1000:.2f} ms over {len(delays)} deliveries")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Stampede test: naive read-through vs ReadThrough under concurrent load
+
+    A fake backend counts its calls and sleeps to simulate a slow query. Many
+    threads read a handful of hot keys with a short TTL for a few seconds,
+    first through the read/miss/load/write pattern middleware.py uses, then
+    through ReadThrough. Fewer backend calls for the same traffic is the win.
+    Needs the Redis from setup.config.
+   how-to:
+        ./bench_read_through.py --threads 50 --seconds 5 --ttl 1
+"""
+
+import argparse
+import threading
+import time
+
+from cache_settings import R_NODES
+from distributed_cache import DistributedCache
+from read_through import ReadThrough
+
+class FakeBackend:
+    def __init__(self, latency):
+        """Slow backend that counts how often it is called"""
+
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, key):
+        """Simulated backend query"""
+
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return {"key": key, "loaded_at": time.time()}
+
+def naive_get(cache, backend, key, ttl):
+    """read -> miss -> fetch_from_backend -> write, with no coordination"""
+
+    response = cache.read(key)
+    if response["status"] == "SUCCESS":
+        return response["value"]
+    value = backend.fetch(key)
+    cache.write(key, value, int(ttl) or 1)
+    return value
+
+def run(name, get, keys, args):
+    """Hammer keys from many threads, report backend calls and latency"""
+
+    latencies = []
+    stop = time.monotonic() + args.seconds
+
+    def reader(offset):
+        count = 0
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            get(keys[(offset + count) % len(keys)])
+            latencies.append(time.perf_counter() - start)
+            count += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return len(latencies), p99
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--keys', type=int, default=5)
+    parser.add_argument('--ttl', type=float, default=1)
+    parser.add_argument('--backend-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    cache = DistributedCache(nodes=R_NODES)
+    print(f"threads={args.threads} seconds={args.seconds} hot keys={args.keys} ttl={args.ttl}s "
+          f"backend latency={args.backend_latency * 1000:.0f}ms")
+
+    for name in ("naive", "read_through"):
+        keys = [f"bench:stampede:{name}:{i}" for i in range(args.keys)]
+        cache.mdelete(keys)
+        backend = FakeBackend(args.backend_latency)
+        if name == "naive":
+            get = lambda key: naive_get(cache, backend, key, args.ttl)
+        else:
+            loader = ReadThrough(cache, ttl=args.ttl, stale_ttl=args.ttl * 5, lock_lease=2)
+            get = lambda key: loader.get(key, lambda: backend.fetch(key))
+        reads, p99 = run(name, get, keys, args)
+        # at most one refresh per key per ttl is the ideal
+        ideal = args.keys * max(1, int(args.seconds / args.ttl))
+        print(f"{name:13} reads={reads:8d} backend calls={backend.calls:6d} (ideal ~{ideal})"
+              f" p99={p99 * 1000:7.2f} ms")
+        cache.mdelete(keys)
+
+if __name__ == "__main__":
+    main()
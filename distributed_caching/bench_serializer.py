@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Benchmark value encodings: encode/decode cost and bytes stored
+
+    Compares the old behaviour (the value's str() as UTF-8, which is what Redis
+    stored before the serializer existed) with each Serializer codec on a few
+    representative payloads. Does not need Redis or setup.config.
+   how-to:
+        ./bench_serializer.py --rounds 2000
+"""
+
+import argparse
+import time
+
+from serializers import Serializer, msgpack, zstandard
+
+def payloads():
+    """Representative cached values"""
+
+    profile = {"id": 123456, "name": "Updated Name", "email": "updated_email@example.com",
+               "age": 30, "tags": ["admin", "beta"], "active": True}
+    return {
+        "short string": "my_value",
+        "user profile": profile,
+        "100 profiles": [dict(profile, id=i) for i in range(100)],
+        "10KB text": "lorem ipsum dolor sit amet " * 400
+    }
+
+def codecs():
+    """Serializer configurations to compare"""
+
+    configs = [("json", "none"), ("json", "zlib")]
+    if zstandard is not None:
+        configs.append(("json", "zstd"))
+    if msgpack is not None:
+        configs += [("msgpack", "none"), ("msgpack", "zlib")]
+        if zstandard is not None:
+            configs.append(("msgpack", "zstd"))
+    return {f"{fmt}+{compression}": Serializer(fmt, compression, compress_min_bytes=256)
+            for fmt, compression in configs}
+
+def time_us(func, arg, rounds):
+    """Average microseconds per call"""
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(arg)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    for name, value in payloads().items():
+        legacy = len(str(value).encode())
+        print(f"\n{name}: legacy str() {legacy} bytes")
+        print(f"  {'codec':14} {'bytes':>7} {'saved':>7} {'encode us':>10} {'decode us':>10}")
+        for codec_name, serializer in codecs().items():
+            data = serializer.dumps(value)
+            assert serializer.loads(data) == value
+            print(f"  {codec_name:14} {len(data):7d} {1 - len(data) / legacy:7.1%}"
+                  f" {time_us(serializer.dumps, value, args.rounds):10.2f}"
+                  f" {time_us(serializer.loads, data, args.rounds):10.2f}")
+
+if __name__ == "__main__":
+    main()
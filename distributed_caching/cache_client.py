@@ -3,6 +3,11 @@
 # ©2024, Ovais Quraishi
 
 """ An example client for the caching service 
+
+    CacheClient is the one to import: it batches, retries and fails fast.
+        client = CacheClient('https://cache:9090/cache', 'https://cache:9090/login', api_key)
+        client.write('my_key', 'my_value')
+        client.read('my_key')  # {'command': 'READ', 'status': 'SUCCESS', 'value': 'my_value', 'etag': '...'}
 """
 
 import jwt
@@ -10,108 +15,402 @@ import logging
 import os
 import redis
 import requests
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Queue
+from requests.adapters import HTTPAdapter
 
 # Import required local modules
 
 from config import get_config
+from latency import LatencyRecorder
+from resilience import CircuitBreaker, backoff_delays, is_retryable_status, was_not_processed
 
 get_config()
 
+class CacheApiClient:
+    def __init__(self, login_url, api_key, client_id="rollama", refresh_margin=30,
+                 timeout=10, pool_maxsize=10, verify=True):
+        """Caching service client that logs in once and reuses its token
+            The access token is cached and refreshed refresh_margin seconds
+            before its exp claim. Requests share one keep-alive Session, so
+            steady-state calls are a single HTTP request over a reused
+            connection. Safe to share between threads.
+        """
+
+        self.login_url = login_url
+        self.login_payload = {
+                              "client_id" : client_id,
+                              "api_key" : api_key,
+                              "grant_type": "client_credentials"
+                             }
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._token = None
+        self._token_exp = 0
+        self._lock = threading.Lock()
+
+    def token(self, force_refresh=False):
+        """Return a valid access token, logging in only when needed"""
+
+        with self._lock:
+            if force_refresh or self._token is None or time.time() > self._token_exp - self.refresh_margin:
+                self._token = get_jwt_token(self.login_url, self.login_payload,
+                                            {"Content-Type": "application/json"},
+                                            session=self.session, timeout=self.timeout)
+                self._token_exp = token_expiry(self._token)
+            return self._token
+
+    def post(self, endpoint_url, payload=None):
+        """POST a JSON payload to a protected endpoint, returns the JSON response
+            A 401 (token revoked or clock skew) triggers one re-login and retry.
+        """
+
+        for attempt in range(2):
+            headers = {
+                       "Authorization": f"Bearer {self.token(force_refresh=attempt > 0)}",
+                       "Content-Type": "application/json"
+                      }
+            response = self.session.post(endpoint_url, json=payload, headers=headers, timeout=self.timeout)
+            if response.status_code != 401:
+                break
+        response.raise_for_status()
+        return response.json()
+
+# single key command -> batch command, and the request field that carries its keys
+BATCH_COMMANDS = {"READ": "MREAD", "WRITE": "MWRITE", "DELETE": "MDELETE"}
+
+class CacheClient:
+    def __init__(self, cache_url, login_url, api_key, batch_window=0.002, max_batch=100,
+                 retries=3, backoff=0.05, failure_threshold=5, reset_timeout=10,
+                 timeout=5, verify=True, pool_maxsize=10):
+        """High level caching service client
+            * read/write/delete calls arriving from different threads within
+              batch_window seconds are sent together as one MREAD/MWRITE/MDELETE
+              (batch_window=0 sends every call on its own)
+            * connection errors, timeouts and 5xx/429 responses are retried
+              with full jitter exponential backoff; WRITE_NX, CAS and INCR
+              only when the service cannot have run them (see send())
+            * failure_threshold consecutive failures open a circuit breaker;
+              calls then raise CircuitOpenError until reset_timeout passes
+            * per command latency histograms, see stats()
+        """
+
+        self.cache_url = cache_url
+        self.api = CacheApiClient(login_url, api_key, timeout=timeout,
+                                  pool_maxsize=pool_maxsize, verify=verify)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency = LatencyRecorder()
+        self._queue = Queue()
+        self._senders = ThreadPoolExecutor(max_workers=pool_maxsize, thread_name_prefix='cache-client')
+        self._dispatcher = None
+        self._dispatcher_lock = threading.Lock()
+
+    def send(self, payload, idempotent=True):
+        """POST one payload with retries behind the circuit breaker
+            A timeout or 5xx may come after the service ran the command, so
+            for idempotent=False only errors that prove it did not (a failed
+            connect, a 429) are retried. Otherwise an INCR could count twice
+            or a WRITE_NX report EXISTS for its own write.
+        """
+
+        self.breaker.before_call()
+        delays = backoff_delays(self.retries, self.backoff)
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.api.post(self.cache_url, payload)
+            except requests.exceptions.HTTPError as e:
+                retryable = is_retryable_status(e.response.status_code)
+                error = e
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                retryable = True
+                error = e
+            except Exception:
+                # a broken response body, a token that cannot be read: still a
+                #   failed call, and a half-open trial has to end either way
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_success()
+                self.latency.observe(payload["command"], time.perf_counter() - start)
+                return response
+
+            if not retryable:
+                # the service answered, it is healthy; the request was bad
+                self.breaker.record_success()
+                raise error
+            if not (idempotent or was_not_processed(error)):
+                break
+            if attempt < self.retries:
+                time.sleep(delays[attempt])
+
+        self.breaker.record_failure()
+        raise error
+
+    def ensure_dispatcher(self):
+        """Start the batching thread on first use"""
+
+        with self._dispatcher_lock:
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self.dispatch, name="cache-client-batcher",
+                                                    daemon=True)
+                self._dispatcher.start()
+
+    def submit(self, request):
+        """Queue a single key request, returns a Future for its response"""
+
+        future = Future()
+        if self.batch_window <= 0:
+            future.set_result(self.send(request))
+            return future
+        self.ensure_dispatcher()
+        self._queue.put((request, future))
+        return future
+
+    def dispatch(self):
+        """Collect queued requests for batch_window seconds, then send them"""
+
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+
+            by_command = {}
+            for request, future in pending:
+                group = (request["command"], tuple(request.get("tags") or ()))
+                by_command.setdefault(group, []).append((request, future))
+            for items in by_command.values():
+                self._senders.submit(self.send_batch, items)
+
+    def send_batch(self, items):
+        """Send same-command requests as one batch command, resolve their futures"""
+
+        try:
+            if len(items) == 1:
+                request, future = items[0]
+                future.set_result(self.send(request))
+                return
+
+            command = items[0][0]["command"]
+            payload = {"command": BATCH_COMMANDS[command], "keys": [request["key"] for request, _ in items]}
+            if command == "WRITE":
+                payload["values"] = [request["value"] for request, _ in items]
+                payload["expire"] = [request.get("expire") for request, _ in items]
+                if items[0][0].get("tags"):
+                    payload["tags"] = items[0][0]["tags"]
+            response = self.send(payload)
+            if response.get("status") != "SUCCESS":
+                raise ValueError(response.get("message", "batch request failed"))
+            for (request, future), result in zip(items, response["results"]):
+                result.pop("key", None)
+                future.set_result(result)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+    def read(self, key):
+        """READ a key"""
+
+        return self.submit({"command": "READ", "key": key}).result()
+
+    def write(self, key, value, expire=None, tags=None):
+        """WRITE a key, expire in seconds (<= 0 never expires)
+            tags (list of strings) let invalidate_tags() delete it later.
+        """
+
+        request = {"command": "WRITE", "key": key, "value": value}
+        if expire is not None:
+            request["expire"] = expire
+        if tags:
+            request["tags"] = list(tags)
+        return self.submit(request).result()
+
+    def delete(self, key):
+        """DELETE a key"""
+
+        return self.submit({"command": "DELETE", "key": key}).result()
+
+    def write_nx(self, key, value, expire=None):
+        """WRITE a key only if it does not exist (status EXISTS otherwise)"""
+
+        request = {"command": "WRITE_NX", "key": key, "value": value}
+        if expire is not None:
+            request["expire"] = expire
+        return self.send(request, idempotent=False)
+
+    def cas(self, key, value, etag, expire=None):
+        """WRITE a key only if it still has the etag a READ returned (status
+            CONFLICT otherwise). The response carries the new etag.
+        """
+
+        request = {"command": "CAS", "key": key, "value": value, "etag": etag}
+        if expire is not None:
+            request["expire"] = expire
+        return self.send(request, idempotent=False)
+
+    def incr(self, key, amount=1, expire=None):
+        """Add amount to the counter at key, returns the new value in "value"
+            expire (seconds) is set when the counter is created.
+        """
+
+        request = {"command": "INCR", "key": key, "amount": amount}
+        if expire is not None:
+            request["expire"] = expire
+        return self.send(request, idempotent=False)
+
+    def mread(self, keys):
+        """READ many keys in one request"""
+
+        return self.send({"command": "MREAD", "keys": list(keys)})
+
+    def mwrite(self, keys, values, expire=None, tags=None):
+        """WRITE many keys in one request, tags apply to every key"""
+
+        payload = {"command": "MWRITE", "keys": list(keys), "values": list(values), "expire": expire}
+        if tags:
+            payload["tags"] = list(tags)
+        return self.send(payload)
+
+    def mdelete(self, keys):
+        """DELETE many keys in one request"""
+
+        return self.send({"command": "MDELETE", "keys": list(keys)})
+
+    def invalidate_tags(self, tags):
+        """Delete every key written with one of tags"""
+
+        return self.send({"command": "INVALIDATE_TAG", "tags": list(tags)})
+
+    def invalidate(self, keys=(), prefixes=()):
+        """Drop keys, and every key under prefixes (ending in ':'), on all
+            service instances. The service coalesces invalidations from all
+            clients into one flush per window.
+        """
+
+        return self.send({"command": "INVALIDATE", "keys": list(keys), "prefixes": list(prefixes)})
+
+    def stats(self):
+        """Latency histograms per command and circuit breaker state"""
+
+        return {"latency": self.latency.snapshot(),
+                "circuit": self.breaker.state,
+                "consecutive_failures": self.breaker.failures}
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+    """Process wide CacheApiClient built from the caching_srvc_* env vars"""
+
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = CacheApiClient(os.environ['caching_srvc_login_url'],
+                                             os.environ['caching_srvc_secret'])
+        return _default_client
+
 def cache_api(endpoint_url, payload=None):
     """Call a protected API endpoint with a JSON payload.
+        Reuses the cached token and connection of default_client().
     """
 
-    caching_srvc_login_url = os.environ['caching_srvc_login_url']
-    caching_srvc_secret = os.environ['caching_srvc_secret']
-    caching_srvc_headers = {"Content-Type": "application/json"}
-    caching_srvc_payload = {
-                            "client_id" : "rollama",
-                            "api_key" : caching_srvc_secret,
-                            "grant_type": "client_credentials"
-                           }
-    curr_token = get_jwt_token(caching_srvc_login_url, caching_srvc_payload, caching_srvc_headers)
-    
-    url = f"{endpoint_url}"
-    headers = {
-               "Authorization": f"Bearer {curr_token}",
-               "Content-Type": "application/json"
-              }
-
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        response_json = response.json()
-        return response_json  # Return the JSON response
+        return default_client().post(endpoint_url, payload)
     except requests.exceptions.RequestException as e:
         print(f"Error calling protected API: {e}")
         raise
 
-def get_jwt_token(srvc_url, srvc_payload, headers):
+def get_jwt_token(srvc_url, srvc_payload, headers, session=None, timeout=10):
     """Fetch JWT token using the provided authentication payload.
     """
 
-    response = requests.post(srvc_url, json=srvc_payload, headers=headers)
+    response = (session or requests).post(srvc_url, json=srvc_payload, headers=headers, timeout=timeout)
     response.raise_for_status()  # Raise error for bad HTTP response
     token_data = response.json()
     
     return token_data['access_token']
 
-def check_and_refresh_token(jwt_token):
-    """Check if a JWT token has expired and refresh it using get_jwt_token if necessary.
+def token_expiry(jwt_token):
+    """Return the exp claim of a JWT token, without verifying its signature.
     """
-    
+
     try:
-        # Decode the token without verifying the signature
         decoded_token = jwt.decode(jwt_token, options={"verify_signature": False})
-
-        # Extract expiration time (exp claim)
-        expiration_time = decoded_token.get("exp")
-
-        if not expiration_time:
-            raise ValueError("Expiration time ('exp') claim not found in the token.")
-
-        # Compare the current time with the expiration time
-        current_time = time.time()
-        
-        if current_time > expiration_time:
-            # Token is expired; fetch a new one using the get_jwt_token function
-            print("Token has expired. Fetching a new token...")
-            return get_jwt_token()
-        
-        # Token is still valid
-        return jwt_token
-    
     except jwt.InvalidTokenError:
-        raise ValueError("Invalid JWT token.")  # Raise an exception for invalid tokens
+        raise ValueError("Invalid JWT token.")
+
+    expiration_time = decoded_token.get("exp")
+    if not expiration_time:
+        raise ValueError("Expiration time ('exp') claim not found in the token.")
+    return expiration_time
+
+def check_and_refresh_token(jwt_token, srvc_url, srvc_payload, headers, margin=0):
+    """Check if a JWT token has expired (or expires within margin seconds) and
+        refresh it using get_jwt_token if necessary.
+    """
+
+    if time.time() > token_expiry(jwt_token) - margin:
+        # Token is expired; fetch a new one using the get_jwt_token function
+        logging.info("Token has expired. Fetching a new token...")
+        return get_jwt_token(srvc_url, srvc_payload, headers)
+
+    # Token is still valid
+    return jwt_token
+
+_redis_client = None
+_redis_client_lock = threading.Lock()
 
 def configure_redis_client() -> redis.StrictRedis:
     """Configure and return a Redis client instance.
-        Meant for direct queries to Redis
+        Meant for direct queries to Redis. The client, and its connection
+        pool, is built once and shared by every caller in the process.
     """
     
-    host = os.environ['redis_host']
-    port = os.environ['redis_port']
-    password = os.environ['redis_password']
-
-    return redis.StrictRedis(host=host, port=port, password=password)
+    global _redis_client
+    with _redis_client_lock:
+        if _redis_client is None:
+            host = os.environ['redis_host']
+            port = os.environ['redis_port']
+            password = os.environ['redis_password']
+            _redis_client = redis.StrictRedis(host=host, port=port, password=password)
+        return _redis_client
 
 def add_key(key):
-    """Add a key to a set in Redis"""
+    """Add a key to a set in Redis
+        One atomic WRITE_NX, so concurrent adds of the same key add it once.
+    """
 
     caching_srvc_crud_url = os.environ['caching_srvc_crud_url']
     
-    if lookup_key(key):
+    data_payload = {"command": "WRITE_NX", "key": key, "value" : "", "expire" : 2592000} #Expires in 30 days
+    json_resp = cache_api(caching_srvc_crud_url, payload=data_payload)
+    if json_resp['status'] == 'SUCCESS':
+        info_message = f'{key} added'
+        logging.info(info_message)
+        return True
+    elif json_resp['status'] == 'EXISTS':
         info_message = f'{key} already exists'
         logging.info(info_message)
         return False
-    else:
-        data_payload = {"command": "WRITE", "key": key, "value" : "", "expire" : 2592000} #Expires in 30 days
-        json_resp = cache_api(caching_srvc_crud_url, payload=data_payload)
-        if json_resp['status'] == 'SUCCESS':
-            info_message = f'{key} added'
-            logging.info(info_message)
-            return True
 
 def del_key(key):
     """Invalidate cache by deleting the key in Redis"""
@@ -146,23 +445,47 @@ def lookup_key(key):
     else:
         return False
 
-def get_set_contents(set_name):
-    """Get contents of a redis set as a list"""
-    
+def iter_set_contents(set_name, count=1000, batch_size=1000, include_legacy_set=True):
+    """Stream the ids stored under set_name, batch_size ids at a time.
+        Ids are the suffixes of the set_name_<id> keys, found with a server side
+        SCAN cursor (count is the SCAN COUNT hint), preceded by the members of
+        the legacy set_name set when include_legacy_set is True. Nothing is
+        materialized beyond one batch; ids present in both places are yielded
+        twice, as get_set_contents always did.
+    """
+
+    client = configure_redis_client()
+    prefix = set_name + '_'
+    batch = []
+
     # this is now left for backwards compatibility
-    old_byte_list = configure_redis_client().smembers(set_name)
-    old_string_list = [z.decode('utf-8') for z in old_byte_list] # bytes to string
-    
+    if include_legacy_set:
+        for member in client.sscan_iter(set_name, count=count):
+            batch.append(member.decode('utf-8'))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
     # now use keys instead of sets
-    byte_list = list(configure_redis_client().scan_iter(set_name + '*'))
-    string_list = [y.decode('utf-8') for y in byte_list] # bytes to string
-    
-    # update list with just the ids 
-    for index, value in enumerate(string_list):
-        if set_name in value:
-            string_list[index] = value.replace(set_name + '_', '')
-    
-    # merge old redis set and new keys list
-    content_list = old_string_list + string_list
-    
-    return content_list
\ No newline at end of file
+    for key in client.scan_iter(match=set_name + '*', count=count):
+        key = key.decode('utf-8')
+        if key == set_name:
+            continue  # the legacy set itself
+        batch.append(key[len(prefix):] if key.startswith(prefix) else key)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def get_set_contents(set_name):
+    """Get contents of a redis set as a list
+        Prefer iter_set_contents for large prefixes.
+    """
+
+    content_list = []
+    for batch in iter_set_contents(set_name):
+        content_list.extend(batch)
+
+    return content_list
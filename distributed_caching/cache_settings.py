@@ -0,0 +1,281 @@
+# cache_settings.py
+# ©2024, Ovais Quraishi
+"""Settings shared by the caching services, read from setup.config
+
+    Constants, Lua scripts and per node connection settings only: importing
+    this module connects to nothing and starts no threads, so caching.py,
+    async_caching.py and the command line tools can all share it.
+"""
+
+from config import get_config
+from hash_ring import DEFAULT_VNODES
+from hot_keys import DEFAULT_THRESHOLD
+from serializers import Serializer
+
+CONFIG = get_config()
+
+REDIS_CONFIG = {
+    "host": CONFIG.get('redis','host'),
+    "port": CONFIG.get('redis','port'),
+    "password": CONFIG.get('redis','password'),
+    "db": CONFIG.get('redis','db'),
+    # values are bytes on the wire, SERIALIZER decodes them
+    "decode_responses": False
+}
+
+R_KEY_EXPIRE_SEC=CONFIG.get('redis', 'key_expire_secs')
+R_VIRTUAL_NODES=CONFIG.getint('redis', 'virtual_nodes', fallback=DEFAULT_VNODES)
+SINGLE_KEY_COMMANDS=("READ", "WRITE", "DELETE", "WRITE_NX", "CAS", "INCR")
+MUTATING_COMMANDS=("WRITE", "DELETE", "WRITE_NX", "CAS", "INCR")
+
+# the scripts below treat a value written at or before the key's prefix
+#   watermark (ms, 0 for none) as absent, as READ does: invalidation.py
+#   stamps values with 0xF5 and their write time in ms, big-endian
+STALE_LUA = """
+local function stale(data, watermark)
+    if watermark == 0 then
+        return false
+    end
+    local written_at = 0
+    if string.byte(data, 1) == 245 then
+        for index = 2, 9 do
+            written_at = written_at * 256 + string.byte(data, index)
+        end
+    end
+    return written_at <= watermark
+end
+"""
+# conditional writes return the etag (SHA1 of the stored bytes, as READ
+#   reports it) of what they stored, nil when they stored nothing
+WRITE_NX_SCRIPT = STALE_LUA + """
+local current = redis.call('get', KEYS[1])
+if current and not stale(current, tonumber(ARGV[3])) then
+    return false
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+else
+    redis.call('set', KEYS[1], ARGV[1])
+end
+return redis.sha1hex(ARGV[1])
+"""
+CAS_SCRIPT = STALE_LUA + """
+local current = redis.call('get', KEYS[1])
+if not current or stale(current, tonumber(ARGV[4])) or redis.sha1hex(current) ~= ARGV[1] then
+    return false
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+else
+    redis.call('set', KEYS[1], ARGV[2])
+end
+return redis.sha1hex(ARGV[2])
+"""
+# counters are stored like any JSON-encoded value (0xF8 header, see
+#   serializers.py, then the digits) behind the stamp ARGV[3], so READ returns
+#   an int. An int WRITE stored, as JSON or msgpack, counts too, and so do
+#   plain digits from before the header byte. A stale or missing counter
+#   starts at 0; the expiry is set when the counter is created, so it counts
+#   over a fixed window
+INCR_SCRIPT = STALE_LUA + """
+-- the int a msgpack body encodes (fixint, or 0xcc-0xd3 and its big-endian
+--   bytes), nil for anything else
+local msgpack_sizes = {[204] = 1, [205] = 2, [206] = 4, [207] = 8, [208] = 1, [209] = 2, [210] = 4, [211] = 8}
+local function msgpack_int(body)
+    local tag = string.byte(body, 1)
+    if not tag then
+        return nil
+    elseif #body == 1 and tag < 128 then
+        return tag
+    elseif #body == 1 and tag >= 224 then
+        return tag - 256
+    end
+    local size = msgpack_sizes[tag]
+    if not size or #body ~= size + 1 then
+        return nil
+    end
+    local value = 0
+    for index = 2, size + 1 do
+        value = value * 256 + string.byte(body, index)
+    end
+    if tag >= 208 and string.byte(body, 2) >= 128 then
+        value = value - 2 ^ (8 * size)
+    end
+    return value
+end
+
+local current = redis.call('get', KEYS[1])
+local value = 0
+if current and not stale(current, tonumber(ARGV[4])) then
+    local body = current
+    if string.byte(body, 1) == 245 then
+        body = string.sub(body, 10)
+    end
+    local header = string.byte(body, 1)
+    if header == 248 then
+        value = tonumber(string.sub(body, 2))
+    elseif header == 249 then
+        value = msgpack_int(string.sub(body, 2))
+    elseif header and header < 248 then
+        value = tonumber(body)
+    else
+        value = nil
+    end
+    if not value or value ~= math.floor(value) then
+        return redis.error_reply('ERR value is not an integer counter')
+    end
+else
+    current = nil
+end
+value = value + tonumber(ARGV[1])
+local stored = ARGV[3] .. string.char(248) .. string.format('%d', value)
+if current then
+    redis.call('set', KEYS[1], stored, 'KEEPTTL')
+else
+    redis.call('set', KEYS[1], stored)
+end
+if tonumber(ARGV[2]) > 0 and redis.call('ttl', KEYS[1]) == -1 then
+    redis.call('expire', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+R_NODES=[node.strip() for node in CONFIG.get('redis', 'nodes', fallback='node1,node2,node3').split(',') if node.strip()]
+# the node list before the last change, set while rebalance.py moves keys to their new owners
+R_PREVIOUS_NODES=[node.strip() for node in CONFIG.get('redis', 'previous_nodes', fallback='').split(',') if node.strip()]
+# ring: this service shards over the nodes above; cluster: a Redis Cluster does the sharding
+R_MODE=CONFIG.get('redis', 'mode', fallback='ring')
+# host:port of some cluster nodes, the client discovers the rest
+R_CLUSTER_NODES=[node.strip() for node in CONFIG.get('redis', 'cluster_nodes', fallback='').split(',') if node.strip()]
+# tries of a MULTI/EXEC that hit a slot being migrated before its requests get the error
+R_CLUSTER_TRANSACTION_RETRIES=CONFIG.getint('redis', 'cluster_transaction_retries', fallback=5)
+
+# connection pool limits, shared by every node
+R_POOL_CONFIG = {
+    "max_connections": CONFIG.getint('redis', 'max_connections', fallback=50),
+    "timeout": CONFIG.getfloat('redis', 'pool_timeout_secs', fallback=5),
+    "socket_timeout": CONFIG.getfloat('redis', 'socket_timeout_secs', fallback=5),
+    "socket_connect_timeout": CONFIG.getfloat('redis', 'socket_connect_timeout_secs', fallback=5)
+}
+
+# read routing across each master's replicas
+R_REPLICA_CONFIG = {
+    "max_lag": CONFIG.getint('redis', 'replica_max_lag_bytes', fallback=1048576),
+    "check_interval": CONFIG.getfloat('redis', 'replica_check_interval_secs', fallback=5),
+    "retry_after": CONFIG.getfloat('redis', 'replica_retry_after_secs', fallback=30)
+}
+
+# how cached values are encoded in Redis
+SERIALIZER = Serializer(fmt=CONFIG.get('serializer', 'format', fallback='msgpack'),
+                        compression=CONFIG.get('serializer', 'compression', fallback='zstd'),
+                        compress_min_bytes=CONFIG.getint('serializer', 'compress_min_bytes', fallback=1024),
+                        level=CONFIG.getint('serializer', 'compress_level', fallback=3))
+
+# values of keys under these prefixes are encrypted at rest
+ENCRYPT_KEY_PREFIXES=tuple(prefix.strip() for prefix in CONFIG.get('encryption', 'key_prefixes', fallback='').split(',')
+                           if prefix.strip())
+
+# optional in-process L1 cache in front of Redis
+NEAR_CACHE_ENABLED=CONFIG.getboolean('near_cache', 'enabled', fallback=False)
+NEAR_CACHE_MAX_SIZE=CONFIG.getint('near_cache', 'max_size', fallback=10000)
+NEAR_CACHE_TTL_SEC=CONFIG.getfloat('near_cache', 'ttl_secs', fallback=5)
+NEAR_CACHE_CHANNEL=CONFIG.get('near_cache', 'invalidation_channel', fallback='cache:invalidate')
+
+# batched key/prefix invalidation announced to every instance
+INVALIDATION_ENABLED=CONFIG.getboolean('invalidation', 'enabled', fallback=False)
+INVALIDATION_CONFIG = {
+    "window": CONFIG.getfloat('invalidation', 'window_ms', fallback=5) / 1000,
+    "max_batch": CONFIG.getint('invalidation', 'max_batch', fallback=1000),
+    "resync_interval": CONFIG.getfloat('invalidation', 'resync_interval_secs', fallback=30)
+}
+
+# hot key detection, and optional copies of hot keys on more nodes
+HOT_KEYS_ENABLED=CONFIG.getboolean('hot_keys', 'enabled', fallback=False)
+HOT_KEYS_CONFIG = {
+    "width": CONFIG.getint('hot_keys', 'sketch_width', fallback=2048),
+    "depth": CONFIG.getint('hot_keys', 'sketch_depth', fallback=4),
+    "top_k": CONFIG.getint('hot_keys', 'top_k', fallback=100),
+    "threshold": CONFIG.getint('hot_keys', 'threshold', fallback=DEFAULT_THRESHOLD),
+    "decay_interval": CONFIG.getfloat('hot_keys', 'decay_interval_secs', fallback=10),
+    "sample_rate": CONFIG.getfloat('hot_keys', 'sample_rate', fallback=1.0)
+}
+HOT_KEY_COPIES=CONFIG.getint('hot_keys', 'copies', fallback=1)
+HOT_KEY_COPY_TTL_SEC=CONFIG.getfloat('hot_keys', 'copy_ttl_secs', fallback=5)
+HOT_COPY_PREFIX="__hot__:"
+
+# WRITE tags: every node keeps one set per tag of its own keys carrying it
+TAG_INDEX_PREFIX="__tag__:"
+# adds members (ARGV[2..]) to a tag index (KEYS[1]) and keeps the index at
+#   least as long as them: ARGV[1] is their longest expiry in seconds, 0 for
+#   never. An index that never expires stays so, one past its TTL is gone with
+#   the keys it listed.
+TAG_INDEX_SCRIPT = """
+local ttl = redis.call('ttl', KEYS[1])
+for first = 2, #ARGV, 500 do
+    redis.call('sadd', KEYS[1], unpack(ARGV, first, math.min(first + 499, #ARGV)))
+end
+local expire = tonumber(ARGV[1])
+if expire <= 0 then
+    redis.call('persist', KEYS[1])
+elseif ttl == -2 or (ttl >= 0 and ttl < expire) then
+    redis.call('expire', KEYS[1], expire)
+end
+return 1
+"""
+# deletes the keys listed in each tag index (KEYS) and the indexes themselves,
+#   returns {keys deleted, keys listed}
+INVALIDATE_TAG_SCRIPT = """
+local deleted = 0
+local listed = {}
+for _, index in ipairs(KEYS) do
+    local members = redis.call('smembers', index)
+    for first = 1, #members, 500 do
+        deleted = deleted + redis.call('del', unpack(members, first, math.min(first + 499, #members)))
+    end
+    for _, member in ipairs(members) do
+        listed[#listed + 1] = member
+    end
+    redis.call('del', index)
+end
+return {deleted, listed}
+"""
+
+# read-through with stampede protection
+READ_THROUGH_CONFIG = {
+    "ttl": CONFIG.getfloat('read_through', 'ttl_secs', fallback=600),
+    "stale_ttl": CONFIG.getfloat('read_through', 'stale_ttl_secs', fallback=60),
+    "lock_lease": CONFIG.getfloat('read_through', 'lock_lease_secs', fallback=10),
+    "beta": CONFIG.getfloat('read_through', 'xfetch_beta', fallback=1.0)
+}
+
+def node_redis_config(node):
+    """Connection settings for a node
+        Non-empty options in the [redis:<node>] section override the ones in [redis]
+    """
+
+    section = f"redis:{node}"
+    if not CONFIG.has_section(section):
+        return dict(REDIS_CONFIG)
+
+    node_config = dict(REDIS_CONFIG)
+    for option in ("host", "port", "password", "db"):
+        value = CONFIG.get(section, option, fallback='')
+        if value:
+            node_config[option] = value
+    return node_config
+
+def replica_redis_configs(node):
+    """Connection settings for each replica of a node
+        [redis:<node>] replicas is a comma separated host:port list; password
+        and db are the node's own.
+    """
+
+    replicas = CONFIG.get(f"redis:{node}", 'replicas', fallback='')
+    node_config = node_redis_config(node)
+    configs = []
+    for replica in replicas.split(','):
+        if not replica.strip():
+            continue
+        host, _, port = replica.strip().rpartition(':')
+        configs.append(dict(node_config, host=host, port=port))
+    return configs
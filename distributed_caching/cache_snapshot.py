@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Dump the cache to a local snapshot file, or warm it back up from one
+
+    dump walks every node with SCAN and fetches each batch of keys with one
+    pipeline of DUMP + PTTL, writing (key, expire at, payload) records to the
+    file as it goes. restore reads the records back one at a time, skips the
+    ones that have expired since, and RESTOREs the rest in per-node pipelines
+    routed by the current hash ring, so a snapshot taken before nodes were
+    added lands on the nodes that own each key now. Neither side holds more
+    than one batch per node in memory.
+
+    The file is a stream of length-prefixed records, zstd compressed (gzip
+    without zstandard). DUMP payloads are Redis-version specific: restore into
+    the same or a newer Redis. Hot key copies are left out. Tag indexes are
+    kept per node, so each one read back is merged into that tag's index on
+    every node; entries for keys a node does not hold are harmless. With
+    [redis] mode=cluster every primary is dumped and the cluster client routes
+    each RESTORE to the primary serving the key's slot.
+
+    how-to:
+        ./cache_snapshot.py dump cache.snap --batch 1000
+        ./cache_snapshot.py restore cache.snap --replace
+"""
+
+import argparse
+import contextlib
+import gzip
+import struct
+import time
+
+import redis
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Import required local modules
+from cache_settings import HOT_COPY_PREFIX, R_CLUSTER_NODES, R_MODE, R_NODES, TAG_INDEX_PREFIX
+from distributed_cache import ClusterCache, DistributedCache
+
+MAGIC = b"DCSNAP1"
+COMPRESSIONS = {b"z": "zstd", b"g": "gzip"}
+RECORD_HEADER = struct.Struct(">IQI")  # key length, expire at (ms since epoch, 0 never), payload length
+
+@contextlib.contextmanager
+def open_snapshot(path, mode):
+    """Open a snapshot for 'wb' or 'rb' as a stream of uncompressed bytes
+        The magic and the compression byte go uncompressed in front.
+    """
+
+    with open(path, mode) as raw:
+        if mode == 'wb':
+            compression = b"z" if zstandard is not None else b"g"
+            raw.write(MAGIC + compression)
+            if compression == b"z":
+                stream = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+            else:
+                stream = gzip.GzipFile(fileobj=raw, mode='wb')
+        else:
+            header = raw.read(len(MAGIC) + 1)
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a cache snapshot")
+            compression = COMPRESSIONS.get(header[len(MAGIC):])
+            if compression == "zstd":
+                if zstandard is None:
+                    raise ValueError(f"{path} is zstd compressed, install zstandard to read it")
+                stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            else:
+                stream = gzip.GzipFile(fileobj=raw, mode='rb')
+        try:
+            yield stream
+        finally:
+            stream.close()
+
+def read_exactly(stream, size):
+    """Read size bytes, fewer only at the end of the stream"""
+
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def read_records(stream):
+    """Yield (key, expire_at_ms, payload) until the end of the stream"""
+
+    while True:
+        header = read_exactly(stream, RECORD_HEADER.size)
+        if not header:
+            return
+        key_length, expire_at, payload_length = RECORD_HEADER.unpack(header)
+        key = read_exactly(stream, key_length)
+        yield key, expire_at, read_exactly(stream, payload_length)
+
+class Progress:
+    def __init__(self, report_every):
+        """Keys and bytes done, printed every report_every seconds"""
+
+        self.report_every = report_every
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.keys = 0
+        self.bytes = 0
+        self.skipped = 0
+
+    def add(self, keys, size, skipped=0):
+        """Count a finished batch"""
+
+        self.keys += keys
+        self.bytes += size
+        self.skipped += skipped
+        now = time.monotonic()
+        if now - self.last_report >= self.report_every:
+            self.last_report = now
+            print(self.summary())
+
+    def summary(self):
+        """Totals and throughput so far"""
+
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (f"keys={self.keys} skipped={self.skipped} {self.bytes / 1e6:.1f} MB "
+                f"{self.keys / elapsed:.0f} keys/s {self.bytes / 1e6 / elapsed:.1f} MB/s")
+
+def dump_batch(client, keys, out):
+    """DUMP + PTTL one batch in one pipeline, write its records
+        Returns (records written, payload bytes, keys gone in the meantime).
+    """
+
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+    now_ms = int(time.time() * 1000)
+    written = size = gone = 0
+    for key, payload, ttl in zip(keys, results[0::2], results[1::2]):
+        if payload is None or ttl == -2:
+            gone += 1
+            continue
+        expire_at = now_ms + ttl if ttl > 0 else 0
+        out.write(RECORD_HEADER.pack(len(key), expire_at, len(payload)) + key + payload)
+        written += 1
+        size += len(key) + len(payload)
+    return written, size, gone
+
+def build_cache():
+    """A plain client for the configured nodes, ring or cluster by [redis] mode"""
+
+    if R_MODE == 'cluster':
+        return ClusterCache(R_CLUSTER_NODES)
+    return DistributedCache(nodes=R_NODES)
+
+def dump(cache, path, batch_size, report_every):
+    """Write every node's keys to path"""
+
+    progress = Progress(report_every)
+    hot_prefix = HOT_COPY_PREFIX.encode()
+    with open_snapshot(path, 'wb') as out:
+        for node, client in cache.shard_clients():
+            cursor = 0
+            while True:
+                cursor, keys = client.scan(cursor, count=batch_size)
+                keys = [key for key in keys if not key.startswith(hot_prefix)]
+                if keys:
+                    progress.add(*dump_batch(client, keys, out))
+                if cursor == 0:
+                    break
+            print(f"{node} done")
+    return progress
+
+def restore_batch(cache, node, records, replace):
+    """RESTORE one node's batch in one pipeline
+        Returns (keys restored, payload bytes, keys that already existed).
+    """
+
+    pipe = cache.redis_clients[node].pipeline(transaction=False)
+    for key, ttl, payload in records:
+        pipe.restore(key, ttl, payload, replace=replace)
+    results = pipe.execute(raise_on_error=False)
+    existing = 0
+    for result in results:
+        if isinstance(result, redis.ResponseError) and 'BUSYKEY' in str(result):
+            existing += 1
+        elif isinstance(result, Exception):
+            raise result
+    size = sum(len(key) + len(payload) for key, _, payload in records)
+    return len(records) - existing, size, existing
+
+def restore_tag_index(cache, index, ttl, payload):
+    """Merge one dumped tag index into the index of the same tag on every node
+        (the tag's one index on a Redis Cluster). Returns the payload bytes.
+    """
+
+    staging = index + b":restoring"
+    if isinstance(cache, ClusterCache):
+        # the staging key may hash to another slot than the index, no SUNIONSTORE
+        client = cache.redis_clients[0]
+        client.restore(staging, ttl, payload, replace=True)
+        members = client.smembers(staging)
+        if members:
+            client.sadd(index, *members)
+        client.delete(staging)
+        return len(index) + len(payload)
+    for client in cache.redis_clients:
+        pipe = client.pipeline(transaction=True)
+        pipe.restore(staging, ttl, payload, replace=True)
+        pipe.sunionstore(index, [index, staging])
+        pipe.delete(staging)
+        pipe.execute()
+    return len(index) + len(payload)
+
+def restore(cache, path, batch_size, replace, report_every):
+    """Load every unexpired record of path into the node that owns it now"""
+
+    progress = Progress(report_every)
+    tag_prefix = TAG_INDEX_PREFIX.encode()
+    batches = {}  # node index -> [(key, ttl ms, payload)]
+    with open_snapshot(path, 'rb') as stream:
+        for key, expire_at, payload in read_records(stream):
+            ttl = 0
+            if expire_at:
+                ttl = expire_at - int(time.time() * 1000)
+                if ttl <= 0:
+                    progress.skipped += 1
+                    continue
+            if key.startswith(tag_prefix):
+                progress.add(1, restore_tag_index(cache, key, ttl, payload))
+                continue
+            node = cache.get_node(key.decode('utf-8'))
+            batch = batches.setdefault(node, [])
+            batch.append((key, ttl, payload))
+            if len(batch) >= batch_size:
+                progress.add(*restore_batch(cache, node, batch, replace))
+                batches[node] = []
+    for node, batch in batches.items():
+        if batch:
+            progress.add(*restore_batch(cache, node, batch, replace))
+    return progress
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('action', choices=['dump', 'restore'])
+    parser.add_argument('path')
+    parser.add_argument('--batch', type=int, default=1000, help='SCAN COUNT and pipeline size')
+    parser.add_argument('--replace', action='store_true', help='restore over keys that already exist')
+    parser.add_argument('--report-every', type=float, default=5, help='seconds between progress lines')
+    args = parser.parse_args()
+
+    cache = build_cache()
+    if args.action == 'dump':
+        progress = dump(cache, args.path, args.batch, args.report_every)
+    else:
+        progress = restore(cache, args.path, args.batch, args.replace, args.report_every)
+    print(f"done: {progress.summary()}")
+
+if __name__ == "__main__":
+    main()
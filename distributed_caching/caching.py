@@ -2,37 +2,31 @@
 # ©2024, Ovais Quraishi
 """A relatively efficient implementation of distributed caching using Redis with a Flask endpoint
 	Implements consistent hashing: ensures even distribution of keys across nodes
+		or, with [redis] mode=cluster, leaves the sharding to a Redis Cluster
 	Implements a client Interface/communication protocol: interact with this service via endpoint,
-		defines a READ/WRITE/DELETE communication protocol
+		defines a READ/WRITE/DELETE communication protocol, plus MREAD/MWRITE/MDELETE batches
+		and the atomic WRITE_NX/CAS/INCR
 	Replication: relies on Redis Server Replication (there are few other options available as well)
 
 	Assumes: for this exercise a redis server with 1 master and 3 replicas
+		READs are spread over a node's replicas, WRITE/DELETE go to the master
 """
 
-import redis
-from hashlib import blake2b
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token
 
 # import required local modules
-from config import get_config
+from cache_settings import (CONFIG, HOT_KEYS_CONFIG, HOT_KEYS_ENABLED, INVALIDATION_ENABLED, NEAR_CACHE_ENABLED,
+                            NEAR_CACHE_MAX_SIZE, NEAR_CACHE_TTL_SEC, R_CLUSTER_NODES, R_MODE, R_NODES)
+from distributed_cache import ClusterCache, DistributedCache
+from hot_keys import HotKeyTracker
+import metrics
+from near_cache import NearCache
 from utils import get_version
 
 # constants
 app = Flask("Caching-Service")
 
-CONFIG = get_config()
-
-REDIS_CONFIG = {
-    "host": CONFIG.get('redis','host'),
-    "port": CONFIG.get('redis','port'),
-    "password": CONFIG.get('redis','password'),
-    "db": CONFIG.get('redis','db'),
-    "decode_responses": CONFIG.get('redis','decode_responses')
-}
-
-R_KEY_EXPIRE_SEC=CONFIG.get('redis', 'key_expire_secs')
-
 app.config.update(
                   JWT_SECRET_KEY=CONFIG.get('service', 'JWT_SECRET_KEY'),
                   SECRET_KEY=CONFIG.get('service', 'APP_SECRET_KEY'),
@@ -40,82 +34,19 @@ app.config.update(
                  )
 jwt = JWTManager(app)
 
-class DistributedCache:
-    def __init__(self, nodes):
-        """Establish connection context"""
-
-        self.nodes = nodes
-        self.redis_clients = [redis.StrictRedis(**REDIS_CONFIG) for _ in nodes]
-
-    def blake2_hash_function(self, key):
-        """Consistent hashing function
-            blake2b is preferred over MD5 for security-sensitive applications
-            where strong collision resistance and performance are required.
-        """
-
-        return int(blake2b(key.encode()).hexdigest(), 16)
-
-    def get_node(self, key):
-        """Use consistent hashing to determine target storage node for a given key"""
-
-        hash_value = self.blake2_hash_function(key)
-        node_index = hash_value % len(self.nodes)
-        return node_index
-
-    def send_request(self, node, request):
-        """Send a request to the specified cache node and receive the response"""
-        
-        if request["command"] == "WRITE":
-            # expire value if present, otherwise default to R_KEY_EXPIRE_SEC
-            if "expire" in request:
-                expire_time = request["expire"]
-                if expire_time <= 0:
-                    expire_time = None
-            else:
-                expire_time = request.get("expire", R_KEY_EXPIRE_SEC)
-            self.redis_clients[node].set(request["key"], request["value"], ex=expire_time)
-            return {"command": request["command"], "status": "SUCCESS", "value": request["value"]}
-        elif request["command"] == "READ":
-            value = self.redis_clients[node].get(request["key"])
-            if value is not None:
-                return {"command": request["command"], "status": "SUCCESS", "value": value}
-            else:
-                return {"command": request["command"], "status": "NOT_FOUND", "message": request["key"] + " Key not found"}
-        elif request["command"] == "DELETE":
-            deleted_count = self.redis_clients[node].delete(request["key"])
-            if deleted_count == 1:
-                return {"command": request["command"], "status": "SUCCESS", "message": request["key"] + " Key deleted"}
-            else:
-                return {"status": "NOT_FOUND", "message": request["key"] + " Key not found"}
-        else:
-            return {"status": "ERROR", "message": request["command"] + " Invalid command"}
-
-
-    def read(self, key):
-        """Send a READ request to the appropriate cache node"""
-        
-        node = self.get_node(key)
-        request = {"command": "READ", "key": key}
-        return self.send_request(node, request)
-
-    def write(self, key, value, expire=None):
-        """Send a WRITE request to the appropriate cache node"""
-        
-        node = self.get_node(key)
-        request = {'command': 'WRITE', 'key': key, 'value': value}
-        if expire is not None:
-            request['expire'] = expire
-        return self.send_request(node, request)
-
-    def delete(self, key):
-        """Send a DELETE request to the appropriate cache node"""
-        
-        node = self.get_node(key)
-        request = {"command": "DELETE", "key": key}
-        return self.send_request(node, request)
-
-# Instantiate the cache with nodes
-cache = DistributedCache(nodes=['node1', 'node2', 'node3'])  # redis node names here
+# Instantiate the cache: sharded over R_NODES by this service, or by a Redis Cluster
+cache_options = {
+    "near_cache": NearCache(NEAR_CACHE_MAX_SIZE, NEAR_CACHE_TTL_SEC) if NEAR_CACHE_ENABLED else None,
+    "hot_keys": HotKeyTracker(**HOT_KEYS_CONFIG) if HOT_KEYS_ENABLED else None,
+    "invalidation_bus": INVALIDATION_ENABLED
+}
+if R_MODE == 'cluster':
+    cache = ClusterCache(R_CLUSTER_NODES, **cache_options)  # see [redis] cluster_nodes in setup.config
+elif R_MODE == 'ring':
+    cache = DistributedCache(nodes=R_NODES, **cache_options)  # redis node names, see [redis] nodes in setup.config
+else:
+    raise ValueError(f"[redis] mode must be ring or cluster, not {R_MODE}")
+metrics.register_cache(cache)
 
 @app.route('/version', methods=['GET'])
 def version():
@@ -133,6 +64,54 @@ def version():
     elif isinstance(response, dict):
         return jsonify(response)
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint
+    """
+
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@app.route('/pool_stats', methods=['GET'])
+@jwt_required()
+def pool_stats():
+    """Redis connection pool utilization per node
+    """
+
+    return jsonify(cache.pool_stats())
+
+@app.route('/near_cache_stats', methods=['GET'])
+@jwt_required()
+def near_cache_stats():
+    """In-process L1 cache hit/miss/eviction counters
+    """
+
+    return jsonify(cache.near_cache_stats())
+
+@app.route('/hot_keys', methods=['GET'])
+@jwt_required()
+def hot_keys():
+    """Hottest keys by estimated recent READs, and which are replicated
+    """
+
+    return jsonify(cache.hot_key_stats())
+
+@app.route('/encryption_stats', methods=['GET'])
+@jwt_required()
+def encryption_stats():
+    """At-rest encryption prefixes and encrypt/decrypt latency
+    """
+
+    return jsonify(cache.encryption_stats())
+
+@app.route('/invalidation_stats', methods=['GET'])
+@jwt_required()
+def invalidation_stats():
+    """Invalidation bus requests, flushes and prefix watermarks
+    """
+
+    return jsonify(cache.invalidation_stats())
+
 @app.route('/login', methods=['POST'])
 def login():
     """Generate JWT
@@ -155,15 +134,57 @@ def cache_request():
     data = request.get_json()
     command = data.get('command')
     key = data.get('key')
+    keys = data.get('keys')
     value = data.get('value')
+    values = data.get('values')
     expire = data.get('expire')
+    prefixes = data.get('prefixes')
+    tags = data.get('tags')
+    etag = data.get('etag')
+    amount = data.get('amount', 1)
+    read_your_writes = bool(data.get('read_your_writes'))
+
+    if command in ('MREAD', 'MWRITE', 'MDELETE') and not (isinstance(keys, list)
+                                                         and all(isinstance(key, str) for key in keys)):
+        return {"status": "ERROR", "message": command + " requires a list of string keys"}
+    if command in ('WRITE', 'MWRITE', 'INVALIDATE_TAG') and tags is not None:
+        try:
+            cache.tag_indexes(tags)
+        except ValueError as e:
+            return {"status": "ERROR", "message": str(e)}
 
     if command == 'READ':
-        return cache.read(key)
+        return cache.read(key, read_your_writes)
     elif command == 'WRITE':
-        return cache.write(key, value, expire)
+        return cache.write(key, value, expire, tags)
     elif command == 'DELETE':
         return cache.delete(key)
+    elif command == 'WRITE_NX':
+        return cache.write_nx(key, value, expire)
+    elif command == 'CAS':
+        if not isinstance(etag, str):
+            return {"status": "ERROR", "message": command + " requires the etag from a READ"}
+        return cache.cas(key, value, etag, expire)
+    elif command == 'INCR':
+        if not isinstance(amount, int) or isinstance(amount, bool):
+            return {"status": "ERROR", "message": command + " amount must be an integer"}
+        return cache.incr(key, amount, expire)
+    elif command == 'MREAD':
+        return cache.mread(keys, read_your_writes)
+    elif command == 'MWRITE':
+        if not isinstance(values, list):
+            return {"status": "ERROR", "message": command + " requires a list of values"}
+        return cache.mwrite(keys, values, expire, tags)
+    elif command == 'MDELETE':
+        return cache.mdelete(keys)
+    elif command == 'INVALIDATE_TAG':
+        return cache.invalidate_tags(tags)
+    elif command == 'INVALIDATE':
+        keys, prefixes = keys or [], prefixes or []
+        if not (isinstance(keys, list) and isinstance(prefixes, list)
+                and all(isinstance(item, str) for item in keys + prefixes)):
+            return {"status": "ERROR", "message": command + " requires lists of string keys and/or prefixes"}
+        return cache.invalidate(keys, prefixes)
     else:
         return {"status": "ERROR", "message": "Invalid command"}
 
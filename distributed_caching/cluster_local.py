@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Run a local multi-process Redis Cluster to try [redis] mode=cluster against
+
+    start launches --primaries x (1 + --replicas) redis-server processes on
+    consecutive ports from --port, each with its own directory under --dir
+    (cluster-local in the temp directory by default), and joins them with redis-cli --cluster create. stop shuts them down.
+    move migrates one hash slot to another primary with the same steps
+    redis-cli --cluster reshard takes (SETSLOT IMPORTING/MIGRATING, MIGRATE in
+    batches, SETSLOT NODE), pausing --pause seconds after each batch, so the
+    service can be watched answering through ASK and MOVED redirects.
+    Needs redis-server and redis-cli on the PATH.
+   how-to:
+        ./cluster_local.py start --port 7000 --primaries 3 --replicas 1
+        # setup.config: [redis] mode=cluster, cluster_nodes=127.0.0.1:7000
+        ./cluster_local.py move --port 7000 --slot 866 --to 7001 --batch 10 --pause 1
+        ./cluster_local.py stop --port 7000 --primaries 3 --replicas 1
+"""
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+import redis
+
+def ports(args):
+    """Every process's port"""
+
+    return list(range(args.port, args.port + args.primaries * (1 + args.replicas)))
+
+def start(args):
+    """Launch the processes and create the cluster"""
+
+    for port in ports(args):
+        directory = os.path.abspath(os.path.join(args.dir, str(port)))
+        os.makedirs(directory, exist_ok=True)
+        subprocess.run(["redis-server", "--port", str(port), "--cluster-enabled", "yes",
+                        "--cluster-config-file", "nodes.conf", "--cluster-node-timeout", "5000",
+                        "--appendonly", "no", "--save", "", "--dir", directory,
+                        "--logfile", os.path.join(directory, "redis.log"), "--daemonize", "yes"], check=True)
+    for port in ports(args):
+        client = redis.StrictRedis(port=port)
+        for _ in range(50):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.1)
+    subprocess.run(["redis-cli", "--cluster", "create"] + [f"127.0.0.1:{port}" for port in ports(args)]
+                   + ["--cluster-replicas", str(args.replicas), "--cluster-yes"], check=True)
+    print(f"cluster_nodes=127.0.0.1:{args.port}")
+
+def stop(args):
+    """Shut every process down, without saving"""
+
+    for port in ports(args):
+        try:
+            redis.StrictRedis(port=port).shutdown(nosave=True)
+        except redis.ConnectionError:
+            pass  # already gone, or the shutdown closed the connection
+    print(f"stopped {len(ports(args))} processes")
+
+def node_ids(client):
+    """{port: node id} of the cluster's primaries"""
+
+    ids = {}
+    for address, node in client.execute_command("CLUSTER NODES").items():
+        if "master" in node["flags"]:
+            ids[int(address.split('@')[0].rpartition(':')[2])] = node["node_id"]
+    return ids
+
+def owner(client, slot):
+    """Port of the primary serving slot"""
+
+    for first, last, primary, *_ in client.execute_command("CLUSTER SLOTS"):
+        if first <= slot <= last:
+            return int(primary[1])
+    raise ValueError(f"slot {slot} is not served")
+
+def move(args):
+    """Migrate one slot to the primary on --to"""
+
+    ids = node_ids(redis.StrictRedis(port=args.port))
+    source_port = owner(redis.StrictRedis(port=args.port), args.slot)
+    if source_port == args.to:
+        print(f"slot {args.slot} is on {args.to} already")
+        return
+    source = redis.StrictRedis(port=source_port)
+    target = redis.StrictRedis(port=args.to)
+
+    target.execute_command("CLUSTER SETSLOT", args.slot, "IMPORTING", ids[source_port])
+    source.execute_command("CLUSTER SETSLOT", args.slot, "MIGRATING", ids[args.to])
+    print(f"slot {args.slot} migrating {source_port} -> {args.to}, clients get ASK for keys moved already")
+    moved = 0
+    while True:
+        keys = source.execute_command("CLUSTER GETKEYSINSLOT", args.slot, args.batch)
+        if not keys:
+            break
+        source.migrate("127.0.0.1", args.to, keys, 0, 5000)
+        moved += len(keys)
+        time.sleep(args.pause)
+    for port in ids:
+        redis.StrictRedis(port=port).execute_command("CLUSTER SETSLOT", args.slot, "NODE", ids[args.to])
+    print(f"slot {args.slot} now on {args.to}, {moved} keys moved, clients get MOVED")
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('action', choices=['start', 'stop', 'move'])
+    parser.add_argument('--port', type=int, default=7000, help='first port')
+    parser.add_argument('--primaries', type=int, default=3)
+    parser.add_argument('--replicas', type=int, default=1, help='replicas per primary')
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'cluster-local'),
+                        help='one directory per process in here')
+    parser.add_argument('--slot', type=int, help='slot to move, see CLUSTER KEYSLOT <key>')
+    parser.add_argument('--to', type=int, help='port of the primary to move the slot to')
+    parser.add_argument('--batch', type=int, default=100, help='keys per MIGRATE')
+    parser.add_argument('--pause', type=float, default=0, help='seconds to wait after each MIGRATE')
+    args = parser.parse_args()
+
+    if args.action == 'start':
+        start(args)
+    elif args.action == 'stop':
+        stop(args)
+    else:
+        if args.slot is None or args.to is None:
+            parser.error("move needs --slot and --to")
+        move(args)
+
+if __name__ == "__main__":
+    main()
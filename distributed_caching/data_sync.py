@@ -12,8 +12,10 @@
 	the corresponding cached data for that user's profile.
 """
 
+import logging
+
 import requests
-import json
+from cache_client import CacheClient
 from config import get_config
 
 # Define the URL of the caching service endpoint with HTTPS
@@ -29,48 +31,74 @@ API_KEY = CONFIG.get('service','SRVC_SHARED_SECRET')
 # Define the URL of the backend data source with HTTPS
 BACKEND_URL = 'https://backend-service-url/profiles'
 
-
-def get_access_token(api_key):
-    """Get JWT token
-    """
-
-    payload = {'api_key': api_key}
-    response = requests.post(LOGIN_URL, json=payload, verify=False)
-    if response.status_code == 200:
-        return response.json().get('access_token')
-    else:
-        return None
+cache_client = CacheClient(CACHE_URL, LOGIN_URL, API_KEY, verify=False)
 
 def update_profile(user_id, new_profile_data, access_token):
-	"""Update user profile data, invalidate cache
-	"""
+    """Update user profile data, invalidate cache
+    """
 
     # 1: Update profile data in the backend data source
     response = update_backend_profile(user_id, new_profile_data, access_token)
     if response.status_code == 200:
         # 2: Invalidate cached profile data in the caching service
-        invalidate_cached_profile(user_id, access_token)
+        if not invalidate_cached_profile(user_id, access_token):
+            logging.warning("profile %s updated, but its cached copy could not be invalidated", user_id)
+            return False
         return True
     else:
         return False
 
 def update_backend_profile(user_id, new_profile_data, access_token):
-	"""Update user profile in backend
-	"""
+    """Update user profile in backend
+    """
 
     url = f"{BACKEND_URL}/{user_id}"
     headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
     response = requests.put(url, headers=headers, json=new_profile_data)
     return response
 
-def invalidate_cached_profile(user_id, access_token):
-	"""Invalidate Cache data
-	"""
+def invalidate_keys(keys):
+    """Drop keys from the cache, True when none of them is left cached
+        INVALIDATE goes through the invalidation bus. A service without it
+        ([invalidation] enabled=false, the default, or async_caching.py)
+        answers ERROR, and the keys are deleted instead.
+    """
 
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    payload = {'command': 'DELETE', 'key': f"profile:{user_id}"}
-    response = requests.post(CACHE_URL, headers=headers, json=payload, verify=False)
-    return response.json()
+    response = cache_client.invalidate(keys=keys)
+    if response.get("status") == "ERROR":
+        response = cache_client.mdelete(keys)
+    return response.get("status") == "SUCCESS"
+
+def invalidate_cached_profile(user_id, access_token=None):
+    """Invalidate Cache data, True on success
+    """
+
+    return invalidate_keys([f"profile:{user_id}"])
+
+def invalidate_cached_profiles(user_ids):
+    """Invalidate many profiles in one request, True on success
+    """
+
+    return invalidate_keys([f"profile:{user_id}" for user_id in user_ids])
+
+def cache_user_data(user_id, key, value, expire=None):
+    """Cache something belonging to a user, tagged so it can all go at once
+    """
+
+    return cache_client.write(key, value, expire, tags=[f"user:{user_id}"])
+
+def invalidate_user_data(user_id):
+    """Invalidate everything cached with cache_user_data for the user, no SCAN
+    """
+
+    return cache_client.invalidate_tags([f"user:{user_id}"])
+
+def invalidate_all_profiles():
+    """Invalidate every cached profile, e.g. after a schema change
+        A prefix watermark, no keyspace scan; needs the invalidation bus.
+    """
+
+    return cache_client.invalidate(prefixes=["profile:"])
 
 if __name__ == "__main__":
     user_id = '123456'
@@ -81,8 +109,8 @@ if __name__ == "__main__":
         # Add other fields as needed
     }
 
-    # get access token
-    access_token = get_access_token(API_KEY)
+    # the caching service token doubles as the backend token in this example
+    access_token = cache_client.api.token()
     if access_token:
         # update user profile
         success = update_profile(user_id, new_profile_data, access_token)
@@ -0,0 +1,1011 @@
+# distributed_cache.py
+# ©2024, Ovais Quraishi
+"""DistributedCache: the READ/WRITE/DELETE protocol over a ring of Redis nodes
+
+    Also CachePipeline for node-grouped batches and ClusterCache for [redis]
+    mode=cluster. Nothing is instantiated here; caching.py builds the service's
+    cache, tools build their own.
+"""
+
+import hashlib
+import json
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+# import required local modules
+from cache_settings import (CAS_SCRIPT, ENCRYPT_KEY_PREFIXES, HOT_COPY_PREFIX, HOT_KEY_COPIES, HOT_KEY_COPY_TTL_SEC,
+                            INCR_SCRIPT, INVALIDATE_TAG_SCRIPT, INVALIDATION_CONFIG, MUTATING_COMMANDS,
+                            NEAR_CACHE_CHANNEL, R_CLUSTER_TRANSACTION_RETRIES, R_KEY_EXPIRE_SEC, R_POOL_CONFIG,
+                            R_PREVIOUS_NODES, R_REPLICA_CONFIG, R_VIRTUAL_NODES, SERIALIZER, SINGLE_KEY_COMMANDS,
+                            TAG_INDEX_PREFIX, TAG_INDEX_SCRIPT, WRITE_NX_SCRIPT, node_redis_config,
+                            replica_redis_configs)
+from encryption import TOKEN_VERSION, decrypt_bytes, encrypt_bytes
+from hash_ring import HashRing
+from invalidation import InvalidationBus, stamp, unstamp
+from latency import LatencyRecorder
+import metrics
+from replicas import ReplicaSet
+
+class DistributedCache:
+    def __init__(self, nodes, vnodes=R_VIRTUAL_NODES, near_cache=None, serializer=SERIALIZER,
+                 encrypt_prefixes=ENCRYPT_KEY_PREFIXES, hot_keys=None, hot_key_copies=HOT_KEY_COPIES,
+                 hot_key_copy_ttl=HOT_KEY_COPY_TTL_SEC, previous_nodes=R_PREVIOUS_NODES,
+                 invalidation_bus=False):
+        """Establish connection context
+            serializer turns values into the bytes stored in Redis and back.
+            Values of keys starting with one of encrypt_prefixes are encrypted
+            after serializing (and compressing) them.
+            near_cache is an optional NearCache consulted before Redis on READ.
+            Local WRITE/DELETE invalidate it and publish the keys on
+            NEAR_CACHE_CHANNEL so the other workers drop their copies too.
+            hot_keys is an optional HotKeyTracker fed by READs. With
+            hot_key_copies > 1 a hot key is also kept, as HOT_COPY_PREFIX + key
+            with a hot_key_copy_ttl expiry, on the next nodes along the ring
+            and single-key READs of it are spread over those nodes. WRITE/DELETE
+            drop the copies this worker knows of; the copy TTL bounds how stale
+            a copy can be otherwise.
+            previous_nodes is the node list before it last changed. Until the
+            keys have been moved (rebalance.py), READs that miss and DELETEs are
+            repeated on a key's previous owner; nodes only in previous_nodes are
+            connected to but own no keys.
+            invalidation_bus starts an InvalidationBus (INVALIDATION_CONFIG)
+            for invalidate(); values are then stamped with their write time.
+            A WRITE with tags also adds its key to the TAG_INDEX_PREFIX + tag
+            set on the key's node, in the same round trip; invalidate_tags()
+            deletes everything listed there. An index expires with the longest
+            lived key added to it, so entries of expired keys go with it; entries
+            of keys deleted meanwhile stay until then.
+        """
+
+        self.nodes = list(nodes) + [node for node in previous_nodes if node not in nodes]
+        self.serializer = serializer
+        self.encrypt_prefixes = tuple(encrypt_prefixes)
+        self.encryption_latency = LatencyRecorder()
+        # one bounded pool per node, shared by every thread in this worker
+        self.pools, self.redis_clients = self.connect([node_redis_config(node) for node in self.nodes])
+        # READs go to the replicas when a node has any, WRITE/DELETE stay on the master
+        self.replica_sets = []
+        self.replica_pools = []
+        self.replica_clients = []
+        for node in self.nodes:
+            configs = replica_redis_configs(node)
+            pools, clients = self.connect(configs)
+            self.replica_sets.append(ReplicaSet(configs, master=node_redis_config(node), **R_REPLICA_CONFIG))
+            self.replica_pools.append(pools)
+            self.replica_clients.append(clients)
+        for replica_set in self.replica_sets:
+            replica_set.start_monitor()
+        self.ring = HashRing(nodes, vnodes=vnodes)
+        self.previous_ring = HashRing(previous_nodes, vnodes=vnodes) if previous_nodes else None
+        self.node_index = {node: index for index, node in enumerate(self.nodes)}
+        # fans node batches out concurrently; shared by every request thread, so
+        #   sized for as many batches in flight as the node pools can serve
+        self.executor = ThreadPoolExecutor(max_workers=len(self.nodes) * R_POOL_CONFIG["max_connections"],
+                                           thread_name_prefix='cache-node')
+        self.hot_keys = hot_keys
+        self.hot_key_copies = min(hot_key_copies, len(nodes))
+        self.hot_key_copy_ttl = hot_key_copy_ttl
+        self.replicated = {}  # hot key -> monotonic time its copies may be dropped
+        self._invalidate_tag_script = self.redis_clients[0].register_script(INVALIDATE_TAG_SCRIPT)
+        self.near_cache = near_cache
+        self.invalidation = None
+        if invalidation_bus:
+            self.invalidation = InvalidationBus(self, NEAR_CACHE_CHANNEL, **INVALIDATION_CONFIG).start()
+        self.listeners = []
+        if near_cache is not None or self.invalidation is not None:
+            self.start_invalidation_listeners()
+
+    def connect(self, configs):
+        """Build one bounded pool and client per connection config"""
+
+        pools = [redis.BlockingConnectionPool(**R_POOL_CONFIG, **config) for config in configs]
+        return pools, [redis.StrictRedis(connection_pool=pool) for pool in pools]
+
+    def read_replica(self, node, requests):
+        """Index of the replica that should serve a batch, None for the master
+            Only pure READ batches without read_your_writes go to a replica.
+        """
+
+        if not self.replica_clients[node]:
+            return None
+        for request in requests:
+            if request["command"] != "READ" or request.get("read_your_writes"):
+                return None
+        return self.replica_sets[node].pick()
+
+    def start_invalidation_listeners(self):
+        """Subscribe to invalidation messages on every node
+            A WRITE/DELETE publishes on the node that owns the key, so every
+            node has to be listened to.
+        """
+
+        def on_invalidate(message):
+            self.apply_invalidation(json.loads(message["data"]))
+
+        for client in self.redis_clients:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{NEAR_CACHE_CHANNEL: on_invalidate})
+            self.listeners.append(pubsub.run_in_thread(sleep_time=1, daemon=True))
+
+    def apply_invalidation(self, payload):
+        """Act on one invalidation message
+            A list of keys from a WRITE/DELETE, or an InvalidationBus message
+            with keys and {prefix: watermark}.
+        """
+
+        if isinstance(payload, list):
+            keys, prefixes = payload, {}
+        else:
+            keys, prefixes = payload["keys"], payload["prefixes"]
+        if self.near_cache is not None:
+            self.near_cache.invalidate(keys)
+            self.near_cache.invalidate_prefixes(prefixes)
+        if self.invalidation is not None and prefixes:
+            self.invalidation.watermarks.update(prefixes)
+
+    def is_stale(self, key, data):
+        """True when a prefix of key was invalidated after data was written"""
+
+        return self.invalidation is not None and self.invalidation.is_stale(key, data)
+
+    def watermark(self, key):
+        """Latest invalidation time in ms of key's prefixes, 0 for none
+            The conditional write scripts treat older values as absent.
+        """
+
+        if self.invalidation is None:
+            return 0
+        return self.invalidation.watermarks.invalidated_at(key)
+
+    def get_node(self, key):
+        """Use consistent hashing to determine target storage node for a given key
+            Looks the key up on the hash ring, so a change in node membership
+            only remaps ~1/N of the keys.
+        """
+
+        return self.node_index[self.ring.get_node(key)]
+
+    def key_client(self, key):
+        """Plain client of the node holding key"""
+
+        return self.redis_clients[self.get_node(key)]
+
+    def shard_clients(self):
+        """(name, client) for every node, for per node work like SCAN and DBSIZE"""
+
+        return list(zip(self.nodes, self.redis_clients))
+
+    def previous_node(self, key):
+        """Index of the node that owned key before the node list changed
+            None when no rebalance is in progress or the owner is unchanged.
+        """
+
+        if self.previous_ring is None:
+            return None
+        previous = self.previous_ring.get_node(key)
+        if previous == self.ring.get_node(key):
+            return None
+        return self.node_index[previous]
+
+    def previous_fallbacks(self, requests, responses):
+        """Requests to repeat on their keys' previous owners, {node: [positions]}
+            READs that missed and every DELETE, so a key not moved yet is
+            neither lost nor left behind.
+        """
+
+        by_node = {}
+        if self.previous_ring is None:
+            return by_node
+        for position, (request, response) in enumerate(zip(requests, responses)):
+            if request["command"] == "DELETE" or (request["command"] == "READ" and response.get("status") == "NOT_FOUND"):
+                previous = self.previous_node(request["key"])
+                if previous is not None:
+                    by_node.setdefault(previous, []).append(position)
+        return by_node
+
+    def merge_fallback(self, response, fallback):
+        """The previous owner's response when the current owner had nothing"""
+
+        if response.get("status") == "NOT_FOUND" and fallback.get("status") == "SUCCESS":
+            return fallback
+        return response
+
+    def expire_time(self, request):
+        """Expire value if present, otherwise default to R_KEY_EXPIRE_SEC"""
+
+        if "expire" in request:
+            expire_time = request["expire"]
+            if expire_time is None or expire_time <= 0:
+                expire_time = None
+        else:
+            expire_time = R_KEY_EXPIRE_SEC
+        return expire_time
+
+    def encode_value(self, key, value):
+        """Bytes to store in Redis for a value
+            Encrypted when the key is under an encrypted prefix. The serializer
+            compresses first, ciphertext would not compress.
+        """
+
+        data = self.serializer.dumps(value)
+        if self.encrypt_prefixes and key.startswith(self.encrypt_prefixes):
+            start = time.perf_counter()
+            data = encrypt_bytes(data)
+            self.encryption_latency.observe("encrypt", time.perf_counter() - start)
+        if self.invalidation is not None:
+            data = stamp(data)
+        metrics.observe_write_size(len(data))
+        return data
+
+    def decode_value(self, data):
+        """Value stored in Redis, decrypted first if it is a Fernet token
+            Decided by the first byte rather than the key prefix, so values
+            written before a prefix was added or after it was removed still read.
+            A write time stamp in front is dropped.
+        """
+
+        data = unstamp(data)[1]
+        if data[:1] == bytes((TOKEN_VERSION,)):
+            start = time.perf_counter()
+            data = decrypt_bytes(data)
+            self.encryption_latency.observe("decrypt", time.perf_counter() - start)
+        return self.serializer.loads(data)
+
+    def issue_command(self, target, request):
+        """Issue the Redis command for a request on a client or a pipeline"""
+
+        if request["command"] == "WRITE":
+            return target.set(request["key"], self.encode_value(request["key"], request["value"]),
+                              ex=self.expire_time(request))
+        elif request["command"] == "READ":
+            return target.get(request["key"])
+        elif request["command"] == "DELETE":
+            return target.delete(request["key"])
+        elif request["command"] == "WRITE_NX":
+            return target.eval(WRITE_NX_SCRIPT, 1, request["key"],
+                               self.encode_value(request["key"], request["value"]), self.expire_time(request) or 0,
+                               self.watermark(request["key"]))
+        elif request["command"] == "CAS":
+            return target.eval(CAS_SCRIPT, 1, request["key"], request["etag"],
+                               self.encode_value(request["key"], request["value"]), self.expire_time(request) or 0,
+                               self.watermark(request["key"]))
+        elif request["command"] == "INCR":
+            return target.eval(INCR_SCRIPT, 1, request["key"], request.get("amount", 1), self.expire_time(request) or 0,
+                               stamp(b"") if self.invalidation is not None else b"", self.watermark(request["key"]))
+
+    def issue_tag_updates(self, pipe, requests):
+        """Queue the tag index additions for tagged WRITEs after the requests
+            Each index is kept at least as long as the longest lived key added.
+        """
+
+        tagged = {}
+        expires = {}  # index -> longest expiry of its new keys, 0 for never
+        for request in requests:
+            if request["command"] == "WRITE":
+                expire = int(self.expire_time(request) or 0)
+                for tag in request.get("tags") or ():
+                    index = TAG_INDEX_PREFIX + tag
+                    tagged.setdefault(index, []).append(request["key"])
+                    longest = expires.get(index, expire)
+                    expires[index] = 0 if 0 in (longest, expire) else max(longest, expire)
+        for index, keys in tagged.items():
+            pipe.eval(TAG_INDEX_SCRIPT, 1, index, expires[index], *keys)
+
+    def build_response(self, request, result):
+        """Turn the raw Redis reply to a request into a protocol response"""
+
+        if request["command"] == "WRITE":
+            return {"command": request["command"], "status": "SUCCESS", "value": request["value"]}
+        elif request["command"] == "READ":
+            if result is not None and not self.is_stale(request["key"], result):
+                return {"command": request["command"], "status": "SUCCESS", "value": self.decode_value(result),
+                        "etag": hashlib.sha1(result).hexdigest()}
+            else:
+                return {"command": request["command"], "status": "NOT_FOUND", "message": request["key"] + " Key not found"}
+        elif request["command"] == "DELETE":
+            if result == 1:
+                return {"command": request["command"], "status": "SUCCESS", "message": request["key"] + " Key deleted"}
+            else:
+                return {"status": "NOT_FOUND", "message": request["key"] + " Key not found"}
+        elif request["command"] == "WRITE_NX":
+            if result is not None:
+                return {"command": request["command"], "status": "SUCCESS", "value": request["value"],
+                        "etag": result.decode('utf-8')}
+            return {"command": request["command"], "status": "EXISTS", "message": request["key"] + " Key exists"}
+        elif request["command"] == "CAS":
+            if result is not None:
+                return {"command": request["command"], "status": "SUCCESS", "value": request["value"],
+                        "etag": result.decode('utf-8')}
+            return {"command": request["command"], "status": "CONFLICT",
+                    "message": request["key"] + " Key changed or missing"}
+        elif request["command"] == "INCR":
+            return {"command": request["command"], "status": "SUCCESS", "value": result}
+
+    def send_request(self, node, request):
+        """Send a request to the specified cache node and receive the response"""
+
+        if request["command"] not in SINGLE_KEY_COMMANDS:
+            return {"status": "ERROR", "message": request["command"] + " Invalid command"}
+
+        if request.get("tags") or (self.near_cache is not None and request["command"] in MUTATING_COMMANDS):
+            # piggyback tag index updates and the invalidation message on the same round trip
+            return self.send_batch(node, [request])[0]
+
+        start = time.perf_counter()
+        replica = self.read_replica(node, [request])
+        try:
+            if replica is None:
+                result = self.issue_command(self.redis_clients[node], request)
+            else:
+                try:
+                    result = self.issue_command(self.replica_clients[node][replica], request)
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    metrics.observe_error(self.nodes[node], e)
+                    self.replica_sets[node].mark_down(replica)
+                    result = self.issue_command(self.redis_clients[node], request)
+        except redis.ResponseError as e:
+            # the command was refused (e.g. INCR of a value that is not a counter), the node is fine
+            metrics.observe_error(self.nodes[node], e)
+            return {"command": request["command"], "status": "ERROR", "message": str(e)}
+        except redis.RedisError as e:
+            metrics.observe_error(self.nodes[node], e)
+            raise
+        metrics.observe_round_trip(self.nodes[node], [request], [result], time.perf_counter() - start)
+        response = self.build_response(request, result)
+        self.update_near_cache([request], [response])
+        return response
+
+    def update_near_cache(self, requests, responses):
+        """Populate the near cache from READs, drop keys that were written or deleted"""
+
+        if self.near_cache is None:
+            return
+
+        invalidated = []
+        for request, response in zip(requests, responses):
+            if request["command"] in MUTATING_COMMANDS:
+                invalidated.append(request["key"])
+            elif request["command"] == "READ" and response.get("status") == "SUCCESS":
+                self.near_cache.put(request["key"], response["value"])
+        if invalidated:
+            self.near_cache.invalidate(invalidated)
+
+    def send_batch(self, node, requests, transaction=False):
+        """Send several requests to one cache node in a single pipelined round trip
+            With transaction=True the batch runs inside MULTI/EXEC on that node.
+            Returns the responses in request order.
+        """
+
+        start = time.perf_counter()
+        replica = self.read_replica(node, requests)
+        if replica is not None:
+            try:
+                results = self.execute_pipeline(self.replica_clients[node][replica], requests, transaction)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                metrics.observe_error(self.nodes[node], e)
+                self.replica_sets[node].mark_down(replica)
+                replica = None
+        if replica is None:
+            try:
+                results = self.execute_pipeline(self.redis_clients[node], requests, transaction)
+            except redis.RedisError as e:
+                metrics.observe_error(self.nodes[node], e)
+                raise
+        metrics.observe_round_trip(self.nodes[node], requests, results, time.perf_counter() - start)
+
+        responses = []
+        for request, result in zip(requests, results):
+            if isinstance(result, Exception):
+                responses.append({"command": request["command"], "status": "ERROR", "message": str(result)})
+            else:
+                responses.append(self.build_response(request, result))
+        self.update_near_cache(requests, responses)
+        return responses
+
+    def execute_pipeline(self, client, requests, transaction=False):
+        """Run requests through one pipeline on client, returns the raw replies"""
+
+        pipe = client.pipeline(transaction=transaction)
+        for request in requests:
+            self.issue_command(pipe, request)
+        self.issue_tag_updates(pipe, requests)
+        if self.near_cache is not None:
+            invalidated = [request["key"] for request in requests if request["command"] in MUTATING_COMMANDS]
+            if invalidated:
+                pipe.publish(NEAR_CACHE_CHANNEL, json.dumps(invalidated))
+        return pipe.execute(raise_on_error=False)
+
+    def send_multi(self, requests, transaction=False):
+        """Group requests by target node and send each group as one batch
+            Node batches are flushed concurrently. Returns the responses in
+            request order, each tagged with its key.
+        """
+
+        by_node = {}
+        for position, request in enumerate(requests):
+            by_node.setdefault(self.get_node(request["key"]), []).append(position)
+
+        def flush(node, positions):
+            return self.send_batch(node, [requests[position] for position in positions], transaction)
+
+        if len(by_node) == 1:
+            node, positions = next(iter(by_node.items()))
+            batches = {node: flush(node, positions)}
+        else:
+            futures = {node: self.executor.submit(flush, node, positions)
+                       for node, positions in by_node.items()}
+            batches = {node: future.result() for node, future in futures.items()}
+
+        responses = [None] * len(requests)
+        for node, positions in by_node.items():
+            for position, response in zip(positions, batches[node]):
+                response["key"] = requests[position]["key"]
+                responses[position] = response
+        for previous, positions in self.previous_fallbacks(requests, responses).items():
+            fallbacks = self.send_batch(previous, [requests[position] for position in positions])
+            for position, fallback in zip(positions, fallbacks):
+                fallback["key"] = requests[position]["key"]
+                responses[position] = self.merge_fallback(responses[position], fallback)
+        self.drop_hot_copies([request["key"] for request in requests if request["command"] in MUTATING_COMMANDS])
+        return responses
+
+    def hot_nodes(self, key):
+        """Indexes of the nodes holding copies of key, its owner first
+            None when the key is not replicated.
+        """
+
+        if self.hot_keys is None or self.hot_key_copies < 2:
+            return None
+        now = time.monotonic()
+        if self.hot_keys.is_hot(key):
+            if key not in self.replicated and len(self.replicated) >= 4 * self.hot_keys.top_k:
+                self.replicated = {hot: until for hot, until in self.replicated.items() if until > now}
+            self.replicated[key] = now + self.hot_key_copy_ttl
+        elif self.replicated.get(key, 0) < now:
+            self.replicated.pop(key, None)
+            return None
+        return [self.node_index[node] for node in self.ring.get_nodes(key, self.hot_key_copies)]
+
+    def read_hot_copy(self, key, node, target):
+        """READ a hot key from its copy on target, falling back to the owner
+            node and refilling the copy on a miss
+        """
+
+        copy_key = HOT_COPY_PREFIX + key
+        client = self.redis_clients[target]
+        try:
+            start = time.perf_counter()
+            raw = client.get(copy_key)
+            metrics.observe_round_trip(self.nodes[target], [{"command": "READ"}], [raw], time.perf_counter() - start)
+            if raw is not None:
+                response = self.build_response({"command": "READ", "key": key}, raw)
+                response.pop("etag", None)  # the copy's bytes, not the key's
+                return response
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            metrics.observe_error(self.nodes[target], e)
+            return self.send_request(node, {"command": "READ", "key": key})
+
+        response = self.send_request(node, {"command": "READ", "key": key})
+        if response["status"] == "SUCCESS":
+            try:
+                client.set(copy_key, self.encode_value(key, response["value"]), px=int(self.hot_key_copy_ttl * 1000))
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                metrics.observe_error(self.nodes[target], e)
+        return response
+
+    def drop_hot_copies(self, keys):
+        """Delete the copies of any replicated key among keys"""
+
+        if not self.replicated:
+            return
+        by_node = {}
+        for key in keys:
+            if key in self.replicated:
+                for node in self.ring.get_nodes(key, self.hot_key_copies)[1:]:
+                    by_node.setdefault(self.node_index[node], []).append(HOT_COPY_PREFIX + key)
+        for node, copy_keys in by_node.items():
+            try:
+                self.redis_clients[node].delete(*copy_keys)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                logging.warning("dropping hot key copies on %s failed, they expire in %ss: %s",
+                                self.nodes[node], self.hot_key_copy_ttl, e)
+
+    def hot_key_stats(self):
+        """Current hot keys and which of them are replicated"""
+
+        if self.hot_keys is None:
+            return {"enabled": False}
+        now = time.monotonic()
+        return dict(self.hot_keys.stats(), enabled=True, copies=self.hot_key_copies,
+                    replicated=sorted(key for key, until in list(self.replicated.items()) if until > now))
+
+    def pipeline(self, transaction=False):
+        """Return a CachePipeline that buffers commands until execute()"""
+
+        return CachePipeline(self, transaction=transaction)
+
+    def pool_usage(self, pool):
+        """Utilization of one connection pool"""
+
+        created = len(pool._connections)
+        idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        return {
+            "host": pool.connection_kwargs.get("host"),
+            "port": pool.connection_kwargs.get("port"),
+            "db": pool.connection_kwargs.get("db"),
+            "max_connections": pool.max_connections,
+            "created": created,
+            "in_use": created - idle,
+            "idle": idle
+        }
+
+    def pool_stats(self):
+        """Connection pool utilization per node, replicas included"""
+
+        stats = {}
+        for index, node in enumerate(self.nodes):
+            stats[node] = self.pool_usage(self.pools[index])
+            if self.replica_pools[index]:
+                stats[node]["replicas"] = [
+                    dict(self.pool_usage(pool), **state)
+                    for pool, state in zip(self.replica_pools[index], self.replica_sets[index].stats())]
+        return stats
+
+    def near_cache_stats(self):
+        """Near cache counters, or just enabled=False when there is none"""
+
+        if self.near_cache is None:
+            return {"enabled": False}
+        return dict(self.near_cache.stats(), enabled=True)
+
+    def encryption_stats(self):
+        """Encrypted key prefixes and the latency encryption adds"""
+
+        return {"key_prefixes": list(self.encrypt_prefixes), "latency": self.encryption_latency.snapshot()}
+
+    def invalidation_stats(self):
+        """Invalidation bus counters, or just enabled=False when there is none"""
+
+        if self.invalidation is None:
+            return {"enabled": False}
+        return dict(self.invalidation.stats(), enabled=True)
+
+    def invalidate(self, keys=(), prefixes=()):
+        """Drop keys, and every key under prefixes, on all instances
+            Goes out with whatever else is invalidated within the bus window.
+        """
+
+        if self.invalidation is None:
+            return {"command": "INVALIDATE", "status": "ERROR", "message": "invalidation bus is not enabled"}
+        try:
+            flushed = self.invalidation.invalidate(keys, prefixes).result()
+        except ValueError as e:
+            return {"command": "INVALIDATE", "status": "ERROR", "message": str(e)}
+        except redis.RedisError as e:
+            return {"command": "INVALIDATE", "status": "ERROR", "message": str(e)}
+        return dict({"command": "INVALIDATE", "status": "SUCCESS"}, **flushed)
+
+    def run_invalidate_tag(self, node, indexes):
+        """Run INVALIDATE_TAG_SCRIPT on one node, returns (deleted, keys listed)"""
+
+        start = time.perf_counter()
+        try:
+            deleted, listed = self._invalidate_tag_script(keys=indexes, client=self.redis_clients[node])
+        except redis.RedisError as e:
+            metrics.observe_error(self.nodes[node], e)
+            raise
+        metrics.observe_round_trip(self.nodes[node], [{"command": "INVALIDATE_TAG"}], [deleted],
+                                   time.perf_counter() - start)
+        return deleted, [key.decode('utf-8') for key in listed]
+
+    def tag_indexes(self, tags):
+        """Tag index keys for tags, ValueError unless tags is a list of strings"""
+
+        if not isinstance(tags, list) or not all(isinstance(tag, str) and tag for tag in tags):
+            raise ValueError("tags must be a list of non-empty strings")
+        return [TAG_INDEX_PREFIX + tag for tag in tags]
+
+    def invalidate_tags(self, tags):
+        """Delete every key written with one of tags
+            One script per node, the nodes concurrently; on each node the tagged
+            keys and the tag indexes go atomically. Nodes only in previous_nodes
+            are included, so this holds during a rebalance.
+        """
+
+        try:
+            indexes = self.tag_indexes(tags)
+        except ValueError as e:
+            return {"command": "INVALIDATE_TAG", "status": "ERROR", "message": str(e)}
+
+        futures = [self.executor.submit(self.run_invalidate_tag, node, indexes) for node in range(len(self.nodes))]
+        deleted = 0
+        keys = []
+        for future in futures:
+            node_deleted, node_keys = future.result()
+            deleted += node_deleted
+            keys.extend(node_keys)
+        if keys:
+            if self.near_cache is not None:
+                self.near_cache.invalidate(keys)
+                self.redis_clients[0].publish(NEAR_CACHE_CHANNEL, json.dumps(keys))
+            self.drop_hot_copies(keys)
+        return {"command": "INVALIDATE_TAG", "status": "SUCCESS", "tags": len(tags), "deleted": deleted}
+
+    def read(self, key, read_your_writes=False):
+        """Send a READ request to the appropriate cache node
+            Answered from the near cache when it holds the key, otherwise from a
+            replica unless read_your_writes asks for the master. A replicated
+            hot key is read from any one of its copies. Only values read from
+            the key itself carry the etag cas() expects.
+        """
+
+        if self.hot_keys is not None:
+            self.hot_keys.record(key)
+
+        if self.near_cache is not None and not read_your_writes:
+            hit, value = self.near_cache.get(key)
+            if hit:
+                return {"command": "READ", "status": "SUCCESS", "value": value}
+
+        node = self.get_node(key)
+        if not read_your_writes:
+            hot_nodes = self.hot_nodes(key)
+            if hot_nodes:
+                target = random.choice(hot_nodes)
+                if target != node:
+                    return self.read_hot_copy(key, node, target)
+        request = {"command": "READ", "key": key}
+        if read_your_writes:
+            request["read_your_writes"] = True
+        response = self.send_request(node, request)
+        for previous in self.previous_fallbacks([request], [response]):
+            response = self.merge_fallback(response, self.send_request(previous, request))
+        return response
+
+    def write(self, key, value, expire=None, tags=None):
+        """Send a WRITE request to the appropriate cache node
+            tags, a list of strings, lets invalidate_tags() find the key.
+        """
+        
+        node = self.get_node(key)
+        request = {'command': 'WRITE', 'key': key, 'value': value}
+        if expire is not None:
+            request['expire'] = expire
+        if tags:
+            request['tags'] = tags
+        response = self.send_request(node, request)
+        self.drop_hot_copies([key])
+        return response
+
+    def write_nx(self, key, value, expire=None):
+        """WRITE only if key does not exist, EXISTS otherwise; one atomic round trip"""
+
+        request = {'command': 'WRITE_NX', 'key': key, 'value': value}
+        if expire is not None:
+            request['expire'] = expire
+        return self.send_conditional(request)
+
+    def cas(self, key, value, etag, expire=None):
+        """WRITE only if key still holds the value READ returned etag for,
+            CONFLICT otherwise. Read with read_your_writes to get the master's
+            current etag.
+        """
+
+        request = {'command': 'CAS', 'key': key, 'value': value, 'etag': etag}
+        if expire is not None:
+            request['expire'] = expire
+        return self.send_conditional(request)
+
+    def incr(self, key, amount=1, expire=None):
+        """Add amount to the integer counter at key (created at 0), returns the
+            new value. expire applies from the counter's creation on.
+        """
+
+        if self.encrypt_prefixes and key.startswith(self.encrypt_prefixes):
+            return {"command": "INCR", "status": "ERROR", "message": key + " is under an encrypted prefix"}
+        request = {'command': 'INCR', 'key': key, 'amount': amount}
+        if expire is not None:
+            request['expire'] = expire
+        return self.send_conditional(request)
+
+    def send_conditional(self, request):
+        """Send a WRITE_NX/CAS/INCR to the key's node"""
+
+        response = self.send_request(self.get_node(request["key"]), request)
+        self.drop_hot_copies([request["key"]])
+        return response
+
+    def delete(self, key):
+        """Send a DELETE request to the appropriate cache node"""
+        
+        node = self.get_node(key)
+        request = {"command": "DELETE", "key": key}
+        response = self.send_request(node, request)
+        for previous in self.previous_fallbacks([request], [response]):
+            response = self.merge_fallback(response, self.send_request(previous, request))
+        self.drop_hot_copies([key])
+        return response
+
+    def mread(self, keys, read_your_writes=False):
+        """READ many keys, one pipelined round trip per node
+            Keys the near cache holds are answered from it, only the rest go
+            to Redis; read_your_writes skips the near cache.
+        """
+
+        results = [None] * len(keys)
+        positions = []
+        pipe = self.pipeline()
+        for position, key in enumerate(keys):
+            if self.hot_keys is not None:
+                self.hot_keys.record(key)
+            if self.near_cache is not None and not read_your_writes:
+                hit, value = self.near_cache.get(key)
+                if hit:
+                    results[position] = {"command": "READ", "status": "SUCCESS", "value": value, "key": key}
+                    continue
+            positions.append(position)
+            pipe.read(key, read_your_writes)
+        for position, response in zip(positions, pipe.execute()):
+            results[position] = response
+        return {"command": "MREAD", "status": "SUCCESS", "results": results}
+
+    def mwrite_items(self, keys, values, expire=None):
+        """Zip MWRITE arguments into (key, value, expire) triples
+            expire is either one value for every key or a list matching keys.
+            Raises ValueError when the lists differ in length.
+        """
+
+        if len(keys) != len(values):
+            raise ValueError("keys and values differ in length")
+        if isinstance(expire, list):
+            if len(expire) != len(keys):
+                raise ValueError("keys and expire differ in length")
+            expires = expire
+        else:
+            expires = [expire] * len(keys)
+        return list(zip(keys, values, expires))
+
+    def mwrite(self, keys, values, expire=None, tags=None):
+        """WRITE many keys, one pipelined round trip per node
+            tags apply to every key.
+        """
+
+        try:
+            items = self.mwrite_items(keys, values, expire)
+        except ValueError as e:
+            return {"command": "MWRITE", "status": "ERROR", "message": str(e)}
+
+        pipe = self.pipeline()
+        for key, value, key_expire in items:
+            pipe.write(key, value, key_expire, tags)
+        return {"command": "MWRITE", "status": "SUCCESS", "results": pipe.execute()}
+
+    def mdelete(self, keys):
+        """DELETE many keys, one pipelined round trip per node"""
+
+        pipe = self.pipeline()
+        for key in keys:
+            pipe.delete(key)
+        return {"command": "MDELETE", "status": "SUCCESS", "results": pipe.execute()}
+
+class CachePipeline:
+    def __init__(self, cache, transaction=False):
+        """Buffer mixed READ/WRITE/DELETE requests for one flush
+            Requests are grouped by node, each node's group goes out as one Redis
+            pipeline and the node groups are sent concurrently. transaction=True
+            makes each node's group atomic (MULTI/EXEC); there is no atomicity
+            across nodes.
+
+            with cache.pipeline() as pipe:
+                pipe.write('a', 1).read('b').delete('c')
+                responses = pipe.execute()
+        """
+
+        self.cache = cache
+        self.transaction = transaction
+        self.requests = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def reset(self):
+        """Drop buffered requests"""
+
+        self.requests = []
+
+    def read(self, key, read_your_writes=False):
+        """Buffer a READ"""
+
+        request = {"command": "READ", "key": key}
+        if read_your_writes:
+            request["read_your_writes"] = True
+        self.requests.append(request)
+        return self
+
+    def write(self, key, value, expire=None, tags=None):
+        """Buffer a WRITE"""
+
+        request = {'command': 'WRITE', 'key': key, 'value': value}
+        if expire is not None:
+            request['expire'] = expire
+        if tags:
+            request['tags'] = tags
+        self.requests.append(request)
+        return self
+
+    def delete(self, key):
+        """Buffer a DELETE"""
+
+        self.requests.append({"command": "DELETE", "key": key})
+        return self
+
+    def execute(self):
+        """Flush buffered requests, returns their responses in order"""
+
+        requests, self.requests = self.requests, []
+        if not requests:
+            return []
+        return self.cache.send_multi(requests, transaction=self.transaction)
+
+class ClusterCache(DistributedCache):
+    def __init__(self, startup_nodes, near_cache=None, serializer=SERIALIZER, encrypt_prefixes=ENCRYPT_KEY_PREFIXES,
+                 hot_keys=None, invalidation_bus=False):
+        """Same protocol as DistributedCache, sharded by a Redis Cluster
+            startup_nodes is a list of host:port. The RedisCluster client finds
+            the other nodes, sends each key to the primary serving its hash
+            slot and follows MOVED/ASK redirects while slots move, so the
+            cluster can be resharded (redis-cli --cluster reshard) under load.
+            The whole cluster is one node ("cluster") here: a batch goes out as
+            one cluster pipeline, which the client splits by cluster node.
+            transaction=True is atomic per hash slot rather than per node; keys
+            sharing a {hash tag} share a slot.
+            READs go to the primaries, the cluster's replicas are there for
+            failover. There are no hot key copies. A tag has one index set,
+            in its own slot; see run_invalidate_tag().
+        """
+
+        self.startup_nodes = [redis.cluster.ClusterNode(host, int(port))
+                              for host, _, port in (node.rpartition(':') for node in startup_nodes)]
+        super().__init__(["cluster"], vnodes=1, near_cache=near_cache, serializer=serializer,
+                         encrypt_prefixes=encrypt_prefixes, hot_keys=hot_keys, hot_key_copies=1, previous_nodes=[],
+                         invalidation_bus=invalidation_bus)
+
+    def connect(self, configs):
+        """One RedisCluster client per connection config, with a pool per
+            cluster node inside it. Those pools are bounded by max_connections
+            but do not wait for a free connection: past it a request fails
+            with MaxConnectionsError.
+        """
+
+        options = {option: value for option, value in R_POOL_CONFIG.items() if option != "timeout"}
+        clients = [redis.RedisCluster(startup_nodes=self.startup_nodes, password=config["password"],
+                                      decode_responses=config["decode_responses"], **options)
+                   for config in configs]
+        return [None] * len(clients), clients
+
+    def get_node(self, key):
+        """Always the one cluster client, it routes by hash slot itself"""
+
+        return 0
+
+    def key_client(self, key):
+        """Plain client of the primary serving key's slot, for pipelines a
+            cluster pipeline refuses (PUBLISH); it does not follow redirects
+        """
+
+        return self.redis_clients[0].get_node_from_key(key).redis_connection
+
+    def shard_clients(self):
+        """(host:port, client) for every primary"""
+
+        return [(node.name, node.redis_connection) for node in self.redis_clients[0].get_primaries()]
+
+    def pool_usage(self, pool):
+        """Utilization of one cluster node's connection pool"""
+
+        created = pool._created_connections
+        idle = len(pool._available_connections)
+        return {
+            "host": pool.connection_kwargs.get("host"),
+            "port": pool.connection_kwargs.get("port"),
+            "db": pool.connection_kwargs.get("db"),
+            "max_connections": pool.max_connections,
+            "created": created,
+            "in_use": created - idle,
+            "idle": idle
+        }
+
+    def pool_stats(self):
+        """Connection pool utilization per primary"""
+
+        return {name: self.pool_usage(client.connection_pool) for name, client in self.shard_clients()}
+
+    def execute_pipeline(self, client, requests, transaction=False):
+        """Run requests through cluster pipelines, returns the raw replies
+            With transaction=True each hash slot's requests go in one MULTI/EXEC,
+            slot after slot. Tag index additions follow outside of those, and
+            the invalidation message, which a cluster pipeline cannot carry,
+            after everything else.
+        """
+
+        pipe = client.pipeline(transaction=False)
+        if transaction:
+            by_slot = {}
+            for position, request in enumerate(requests):
+                by_slot.setdefault(client.keyslot(request["key"]), []).append(position)
+            results = [None] * len(requests)
+            for positions in by_slot.values():
+                replies = self.execute_slot_transaction(client, [requests[position] for position in positions])
+                for position, result in zip(positions, replies):
+                    results[position] = result
+            self.issue_tag_updates(pipe, requests)
+            if len(pipe):
+                pipe.execute(raise_on_error=False)
+        else:
+            for request in requests:
+                self.issue_command(pipe, request)
+            self.issue_tag_updates(pipe, requests)
+            results = pipe.execute(raise_on_error=False)
+        if self.near_cache is not None:
+            invalidated = [request["key"] for request in requests if request["command"] in MUTATING_COMMANDS]
+            if invalidated:
+                client.publish(NEAR_CACHE_CHANNEL, json.dumps(invalidated))
+        return results
+
+    def execute_slot_transaction(self, client, requests):
+        """Run requests sharing a hash slot in one MULTI/EXEC, returns the raw replies
+            While the slot is being migrated the transaction is refused (ASK,
+            TRYAGAIN, or MOVED until the client has the new owner); it is tried
+            again R_CLUSTER_TRANSACTION_RETRIES times with a growing pause, then
+            every request gets the error.
+        """
+
+        for attempt in range(R_CLUSTER_TRANSACTION_RETRIES):
+            pipe = client.pipeline(transaction=True)
+            for request in requests:
+                self.issue_command(pipe, request)
+            try:
+                return pipe.execute(raise_on_error=False)
+            except (redis.exceptions.AskError, redis.exceptions.MovedError, redis.exceptions.TryAgainError) as e:
+                error = e
+                time.sleep(0.05 * (attempt + 1))
+        return [error] * len(requests)
+
+    def run_invalidate_tag(self, node, indexes):
+        """Empty each tag index in one MULTI/EXEC on its slot, then delete the
+            keys they listed through a cluster pipeline; returns (deleted, keys
+            listed). A key tagged while this runs lands in a new index and is
+            kept, but unlike on the ring the keys do not all go atomically.
+        """
+
+        client = self.redis_clients[node]
+        start = time.perf_counter()
+        listed = set()
+        deleted = 0
+        try:
+            for index in indexes:
+                pipe = client.pipeline(transaction=True)
+                pipe.smembers(index)
+                pipe.delete(index)
+                listed.update(pipe.execute()[0])
+            if listed:
+                pipe = client.pipeline(transaction=False)
+                for key in listed:
+                    pipe.delete(key)
+                deleted = sum(pipe.execute())
+        except redis.RedisError as e:
+            metrics.observe_error(self.nodes[node], e)
+            raise
+        metrics.observe_round_trip(self.nodes[node], [{"command": "INVALIDATE_TAG"}], [deleted],
+                                   time.perf_counter() - start)
+        return deleted, [key.decode('utf-8') for key in listed]
@@ -1,44 +1,142 @@
 # encryption.py
 # ©2024, Ovais Quraishi
 
-"""This module provides functions for encrypting and decrypting 
+"""This module provides functions for encrypting and decrypting
     text using the Fernet cryptography library.
+
+    The cipher is built once and cached. The key file may hold several keys,
+    one per line: the first encrypts, all of them decrypt (MultiFernet), so a
+    new key can be put first while tokens made with the old one still decrypt.
+    The file is re-read when its modification time changes, checked at most
+    every KEY_RELOAD_CHECK_SECS seconds.
 """
 
+import base64
 import logging
-from cryptography.fernet import Fernet
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, MultiFernet
 from config import get_config
 
 CONFIG = get_config()
 
-def load_key():
+KEY_FILE = CONFIG.get('service', 'ENCRYPTION_KEY')
+KEY_RELOAD_CHECK_SECS = 5
+# first byte of every Fernet token, never the first byte of a UTF-8 string
+TOKEN_VERSION = 0x80
+# batches at least this large are spread over a thread pool
+PARALLEL_THRESHOLD = 1000
+
+_cipher = None
+_cipher_mtime = None
+_cipher_checked_at = 0.0
+_cipher_lock = threading.Lock()
+_executors = {}  # workers -> ThreadPoolExecutor
+
+def load_key(filename=None):
     """Loads a key used to encrypt and decrypt text.
     """
-    
+
+    filename = filename or KEY_FILE
     try:
-        filename = CONFIG.get('service', 'ENCRYPTION_KEY')
         with open(filename, 'rb') as key_file:
             key = key_file.read()
         return key
     except FileNotFoundError:
         logging.error("%s not found", filename)
 
+def load_keys(filename=None):
+    """Loads every key in the key file, primary key first.
+    """
+
+    key = load_key(filename)
+    if not key:
+        raise ValueError(f"no encryption key in {filename or KEY_FILE}")
+    return [line.strip() for line in key.splitlines() if line.strip()]
+
+def get_cipher():
+    """Returns the cached MultiFernet, rebuilt when the key file changes.
+    """
+
+    global _cipher, _cipher_mtime, _cipher_checked_at
+
+    now = time.monotonic()
+    if _cipher is not None and now - _cipher_checked_at < KEY_RELOAD_CHECK_SECS:
+        return _cipher
+
+    with _cipher_lock:
+        if _cipher is not None and now - _cipher_checked_at < KEY_RELOAD_CHECK_SECS:
+            return _cipher
+        try:
+            mtime = os.stat(KEY_FILE).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if _cipher is None or mtime != _cipher_mtime:
+            _cipher = MultiFernet([Fernet(key) for key in load_keys()])
+            _cipher_mtime = mtime
+        _cipher_checked_at = now
+        return _cipher
+
 def encrypt_text(text):
     """Encrypts a piece of text using the loaded key.
     """
 
-    key = load_key()
-    cipher_suite = Fernet(key)
-    encoded_text = text.encode()
-    encrypted_text = cipher_suite.encrypt(encoded_text)
-    return encrypted_text
+    return get_cipher().encrypt(text.encode())
 
 def decrypt_text(encrypted_text):
     """Decrypts a piece of encrypted text using the loaded key.
     """
 
-    key = load_key()
-    cipher_suite = Fernet(key)
-    decrypted_text = cipher_suite.decrypt(encrypted_text)
-    decoded_text = decrypted_text.decode()
-    return decoded_text
+    return get_cipher().decrypt(encrypted_text).decode()
+
+def encrypt_bytes(data):
+    """Encrypts bytes, returns the token in binary form
+        A quarter smaller than the base64 token, for storing in Redis.
+    """
+
+    return base64.urlsafe_b64decode(get_cipher().encrypt(data))
+
+def decrypt_bytes(token):
+    """Decrypts a token made by encrypt_bytes
+    """
+
+    return get_cipher().decrypt(base64.urlsafe_b64encode(token))
+
+def rotate_text(encrypted_text):
+    """Re-encrypts a token with the primary key.
+    """
+
+    return get_cipher().rotate(encrypted_text)
+
+def _map(func, items, workers):
+    """Map over items, on the thread pool when the batch is large
+        One pool per workers value, kept for the life of the process.
+    """
+
+    workers = workers or os.cpu_count() or 1
+    if len(items) < PARALLEL_THRESHOLD or workers < 2:
+        return [func(item) for item in items]
+
+    with _cipher_lock:
+        executor = _executors.get(workers)
+        if executor is None:
+            executor = _executors[workers] = ThreadPoolExecutor(max_workers=workers,
+                                                                thread_name_prefix='encryption')
+    chunk_size = max(1, len(items) // (workers * 4))
+    return list(executor.map(func, items, chunksize=chunk_size))
+
+def encrypt_many(texts, workers=None):
+    """Encrypts a list of texts, returns the tokens in order.
+    """
+
+    cipher = get_cipher()
+    return _map(lambda text: cipher.encrypt(text.encode()), list(texts), workers)
+
+def decrypt_many(encrypted_texts, workers=None):
+    """Decrypts a list of tokens, returns the texts in order.
+    """
+
+    cipher = get_cipher()
+    return _map(lambda token: cipher.decrypt(token).decode(), list(encrypted_texts), workers)
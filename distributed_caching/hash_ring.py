@@ -0,0 +1,103 @@
+# hash_ring.py
+# ©2024, Ovais Quraishi
+"""Consistent hash ring with virtual nodes
+
+    Every physical node is placed on the ring `vnodes` times. A key is owned by
+    the first token clockwise from the key's own hash, so adding or removing one
+    node only moves the keys that fall between that node's tokens and their
+    predecessors: roughly 1/N of the keyspace.
+"""
+
+from bisect import bisect
+from hashlib import blake2b
+
+DEFAULT_VNODES = 160
+
+def ring_hash(key):
+    """64 bit blake2b hash of a string, used for both keys and node tokens
+    """
+
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        """Build the ring for the given node names"""
+
+        if vnodes < 1:
+            raise ValueError("vnodes must be >= 1")
+
+        self.vnodes = vnodes
+        self._nodes = []
+        self._tokens = []
+        self._owners = []
+        for node in nodes:
+            self.add_node(node, rebuild=False)
+        self._rebuild()
+
+    @property
+    def nodes(self):
+        """Physical node names currently on the ring"""
+
+        return list(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def _rebuild(self):
+        """Recompute the sorted token array and its parallel owner array"""
+
+        points = sorted((ring_hash(f"{node}#{i}"), node)
+                        for node in self._nodes
+                        for i in range(self.vnodes))
+        self._tokens = [token for token, _ in points]
+        self._owners = [node for _, node in points]
+
+    def add_node(self, node, rebuild=True):
+        """Place a node on the ring"""
+
+        if node in self._nodes:
+            raise ValueError(f"{node} is already on the ring")
+        self._nodes.append(node)
+        if rebuild:
+            self._rebuild()
+
+    def remove_node(self, node):
+        """Take a node off the ring"""
+
+        if node not in self._nodes:
+            raise ValueError(f"{node} is not on the ring")
+        self._nodes.remove(node)
+        self._rebuild()
+
+    def get_node(self, key):
+        """Return the name of the node that owns key"""
+
+        if not self._tokens:
+            raise LookupError("hash ring is empty")
+
+        index = bisect(self._tokens, ring_hash(key))
+        if index == len(self._tokens):
+            index = 0  # wrap around
+        return self._owners[index]
+
+    def get_nodes(self, key, count):
+        """Return up to count distinct nodes for key, its owner first, then the
+            next nodes met walking clockwise
+        """
+
+        if not self._tokens:
+            raise LookupError("hash ring is empty")
+
+        count = min(count, len(self._nodes))
+        index = bisect(self._tokens, ring_hash(key))
+        nodes = []
+        for step in range(len(self._tokens)):
+            node = self._owners[(index + step) % len(self._tokens)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
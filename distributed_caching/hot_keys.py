@@ -0,0 +1,133 @@
+# hot_keys.py
+# ©2024, Ovais Quraishi
+"""Hot key detection: Count-Min Sketch plus a bounded top-K
+
+    Every recorded access bumps the key's counters in a Count-Min Sketch, whose
+    estimate never undercounts and overcounts by at most ~2N/width with high
+    probability. Keys whose estimate beats the smallest of the current top-K
+    take its place. Counters are halved every decay_interval seconds, so the
+    ranking follows recent traffic rather than all-time totals.
+
+    A key is hot while it is in the top-K with an estimate of at least
+    threshold accesses.
+"""
+
+import random
+import threading
+import time
+
+from hash_ring import ring_hash
+
+MASK_32 = 0xFFFFFFFF
+# accesses per decay interval that make a top-K key hot, [hot_keys] threshold
+DEFAULT_THRESHOLD = 500
+
+class CountMinSketch:
+    def __init__(self, width=2048, depth=4):
+        """depth rows of width counters"""
+
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def indexes(self, key):
+        """One column per row, derived from a single 64 bit hash (h1 + i*h2)"""
+
+        hashed = ring_hash(key)
+        h1, h2 = hashed & MASK_32, (hashed >> 32) | 1
+        return [(h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Count key, returns its new estimate"""
+
+        estimate = None
+        for row, column in zip(self.rows, self.indexes(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        return estimate
+
+    def estimate(self, key):
+        """Upper bound on how often key was counted"""
+
+        return min(row[column] for row, column in zip(self.rows, self.indexes(key)))
+
+    def halve(self):
+        """Age every counter"""
+
+        self.rows = [[count >> 1 for count in row] for row in self.rows]
+
+class HotKeyTracker:
+    def __init__(self, width=2048, depth=4, top_k=100, threshold=DEFAULT_THRESHOLD, decay_interval=10, sample_rate=1.0):
+        """Track the top_k most accessed keys
+            sample_rate < 1 records only that fraction of accesses (estimates
+            are scaled back up), for when even the sketch update is too much.
+        """
+
+        self.sketch = CountMinSketch(width, depth)
+        self.top_k = top_k
+        self.threshold = threshold
+        self.decay_interval = decay_interval
+        self.sample_rate = sample_rate
+        self._weight = max(1, round(1 / sample_rate)) if sample_rate < 1 else 1
+        self._top = {}  # key -> estimate
+        self._min_key = None
+        self._decay_at = time.monotonic() + decay_interval
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def _refresh_min(self):
+        """Find the top-K entry with the lowest estimate"""
+
+        self._min_key = min(self._top, key=self._top.get) if self._top else None
+
+    def record(self, key):
+        """Count one access to key"""
+
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._decay_at:
+                self.sketch.halve()
+                self._top = {top_key: count >> 1 for top_key, count in self._top.items() if count > 1}
+                self._refresh_min()
+                self._decay_at = now + self.decay_interval
+            self.recorded += 1
+            estimate = self.sketch.add(key, self._weight)
+
+            if key in self._top:
+                self._top[key] = estimate
+                if key == self._min_key:
+                    self._refresh_min()
+            elif len(self._top) < self.top_k:
+                self._top[key] = estimate
+                if self._min_key is None or estimate < self._top[self._min_key]:
+                    self._min_key = key
+            elif estimate > self._top[self._min_key]:
+                del self._top[self._min_key]
+                self._top[key] = estimate
+                self._refresh_min()
+
+    def is_hot(self, key):
+        """True while key is in the top-K with at least threshold accesses"""
+
+        return self._top.get(key, 0) >= self.threshold
+
+    def top(self, count=None):
+        """[(key, estimate)] hottest first"""
+
+        with self._lock:
+            ranked = sorted(self._top.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:count] if count else ranked
+
+    def stats(self):
+        """Settings, accesses recorded and the current top-K"""
+
+        return {
+            "top_k": self.top_k,
+            "threshold": self.threshold,
+            "sample_rate": self.sample_rate,
+            "recorded": self.recorded,
+            "hot": [{"key": key, "estimate": estimate} for key, estimate in self.top() if estimate >= self.threshold]
+        }
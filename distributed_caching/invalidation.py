@@ -0,0 +1,221 @@
+# invalidation.py
+# ©2024, Ovais Quraishi
+"""Invalidation bus: batched, coalesced key and prefix invalidation
+
+    invalidate(keys, prefixes) queues the work and returns a Future. A
+    dispatcher thread collects everything queued within `window` seconds,
+    drops duplicates and flushes it in one go:
+        * keys are deleted, one pipelined round trip per node
+        * each prefix gets a watermark (now, in ms) in the WATERMARKS_KEY hash
+        * one message on the channel tells every instance to drop those keys
+          and prefixes from its near cache and to record the watermarks
+
+    Prefix invalidation touches no keys, so there is no keyspace scan. While
+    the bus is on, stored values are stamped with the time they were written;
+    a READ of a key written at or before the watermark of one of its prefixes
+    is answered as a miss, and the value is left to expire or be overwritten.
+    Prefixes end with ':' and a key is checked against each of its
+    ':'-terminated prefixes, one dict lookup apiece. Writers' and
+    invalidators' clocks are assumed to agree to within a few milliseconds.
+
+    Pub/sub does not redeliver, so the watermarks are reloaded every
+    resync_interval seconds in case a message was missed.
+"""
+
+import json
+import logging
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+import redis
+
+WATERMARKS_KEY = "cache:invalidated_prefixes"
+# 0xF5 never starts a UTF-8 string, a serializer header or a Fernet token
+STAMP_MARKER = b"\xf5"
+STAMP = struct.Struct(">Q")
+STAMP_SIZE = 1 + STAMP.size
+
+def stamp(data, written_at=None):
+    """Prefix stored bytes with their write time in ms"""
+
+    if written_at is None:
+        written_at = int(time.time() * 1000)
+    return STAMP_MARKER + STAMP.pack(written_at) + data
+
+def unstamp(data):
+    """Split stored bytes into (write time in ms, 0 if unstamped, the rest)"""
+
+    if data[:1] == STAMP_MARKER:
+        return STAMP.unpack_from(data, 1)[0], data[STAMP_SIZE:]
+    return 0, data
+
+class PrefixWatermarks:
+    def __init__(self):
+        """Latest invalidation time in ms per prefix"""
+
+        self._marks = {}
+
+    def __len__(self):
+        return len(self._marks)
+
+    def update(self, marks):
+        """Merge {prefix: ms}, keeping the later time for each prefix"""
+
+        merged = dict(self._marks)
+        for prefix, invalidated_at in marks.items():
+            if invalidated_at > merged.get(prefix, 0):
+                merged[prefix] = invalidated_at
+        self._marks = merged
+
+    def invalidated_at(self, key):
+        """Latest watermark among key's ':'-terminated prefixes, 0 for none"""
+
+        marks = self._marks
+        if not marks:
+            return 0
+        latest = 0
+        index = key.find(':')
+        while index != -1:
+            invalidated_at = marks.get(key[:index + 1], 0)
+            if invalidated_at > latest:
+                latest = invalidated_at
+            index = key.find(':', index + 1)
+        return latest
+
+class InvalidationBus:
+    def __init__(self, cache, channel, window=0.005, max_batch=1000, resync_interval=30):
+        """Invalidations for cache, announced on channel
+            Everything queued within window seconds (up to max_batch calls)
+            is flushed together.
+        """
+
+        self.cache = cache
+        self.channel = channel
+        self.window = window
+        self.max_batch = max_batch
+        self.resync_interval = resync_interval
+        self.watermarks = PrefixWatermarks()
+        self._queue = Queue()
+        self._dispatcher = None
+        self.requested = 0
+        self.flushed_keys = 0
+        self.flushed_prefixes = 0
+        self.flushes = 0
+
+    def start(self):
+        """Load the watermarks and start the dispatcher thread"""
+
+        self.resync()
+        self._dispatcher = threading.Thread(target=self.dispatch, name="invalidation-bus", daemon=True)
+        self._dispatcher.start()
+        return self
+
+    def watermark_client(self):
+        """Client for the node holding WATERMARKS_KEY"""
+
+        return self.cache.key_client(WATERMARKS_KEY)
+
+    def resync(self):
+        """Reload every watermark from Redis"""
+
+        try:
+            marks = self.watermark_client().hgetall(WATERMARKS_KEY)
+        except redis.RedisError as e:
+            logging.warning("loading invalidation watermarks failed: %s", e)
+            return
+        self.watermarks.update({prefix.decode('utf-8'): int(invalidated_at)
+                                for prefix, invalidated_at in marks.items()})
+
+    def is_stale(self, key, data):
+        """True when stored bytes were written before a prefix of key was invalidated"""
+
+        invalidated_at = self.watermarks.invalidated_at(key)
+        if not invalidated_at:
+            return False
+        return unstamp(data)[0] <= invalidated_at
+
+    def invalidate(self, keys=(), prefixes=()):
+        """Queue keys and prefixes, returns a Future for {"keys", "prefixes"}
+            counts of what the flush they went out in covered.
+            Raises ValueError for a prefix that does not end with ':'.
+        """
+
+        prefixes = list(prefixes)
+        for prefix in prefixes:
+            if not prefix.endswith(':'):
+                raise ValueError(f"prefix {prefix} must end with ':'")
+        future = Future()
+        self._queue.put((list(keys), prefixes, future))
+        return future
+
+    def dispatch(self):
+        """Collect queued invalidations for window seconds, then flush them"""
+
+        resync_at = time.monotonic() + self.resync_interval
+        while True:
+            try:
+                pending = [self._queue.get(timeout=max(resync_at - time.monotonic(), 0.001))]
+            except Empty:
+                pending = []
+            if pending:
+                deadline = time.monotonic() + self.window
+                while len(pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        pending.append(self._queue.get(timeout=remaining))
+                    except Empty:
+                        break
+                self.flush(pending)
+            if time.monotonic() >= resync_at:
+                self.resync()
+                resync_at = time.monotonic() + self.resync_interval
+
+    def flush(self, pending):
+        """Apply and announce one window of invalidations, resolve their futures"""
+
+        keys = set()
+        prefixes = set()
+        for item_keys, item_prefixes, _ in pending:
+            keys.update(item_keys)
+            prefixes.update(item_prefixes)
+        try:
+            if keys:
+                self.cache.send_multi([{"command": "DELETE", "key": key} for key in keys])
+            invalidated_at = int(time.time() * 1000)
+            marks = {prefix: invalidated_at for prefix in prefixes}
+            client = self.watermark_client()
+            pipe = client.pipeline(transaction=False)
+            if marks:
+                pipe.hset(WATERMARKS_KEY, mapping=marks)
+            pipe.publish(self.channel, json.dumps({"keys": sorted(keys), "prefixes": marks, "sent": time.time()}))
+            pipe.execute()
+            self.watermarks.update(marks)
+        except Exception as e:
+            for _, _, future in pending:
+                future.set_exception(e)
+            return
+
+        self.requested += len(pending)
+        self.flushes += 1
+        self.flushed_keys += len(keys)
+        self.flushed_prefixes += len(prefixes)
+        result = {"keys": len(keys), "prefixes": len(prefixes)}
+        for _, _, future in pending:
+            future.set_result(result)
+
+    def stats(self):
+        """Requests, flushes and what they covered"""
+
+        return {
+            "requested": self.requested,
+            "flushes": self.flushes,
+            "keys": self.flushed_keys,
+            "prefixes": self.flushed_prefixes,
+            "watermarks": len(self.watermarks),
+            "window": self.window
+        }
@@ -0,0 +1,80 @@
+# latency.py
+# ©2024, Ovais Quraishi
+"""Fixed bucket latency histograms
+"""
+
+import bisect
+import threading
+
+# upper bounds in seconds, the last bucket catches everything slower
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class LatencyHistogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """Counts observations per bucket, cheap enough for every call"""
+
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        """Record one latency"""
+
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given percentile"""
+
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = fraction * self.count
+            seen = 0
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank:
+                    return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        """Counts per bucket plus summary figures"""
+
+        with self._lock:
+            buckets = {f"le_{bound}": count for bound, count in zip(self.buckets, self.counts)}
+            buckets["le_inf"] = self.counts[-1]
+            count, total = self.count, self.total
+        return {
+            "count": count,
+            "mean": total / count if count else 0.0,
+            "p50": self.percentile(0.50),
+            "p99": self.percentile(0.99),
+            "buckets": buckets
+        }
+
+class LatencyRecorder:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """One LatencyHistogram per label, created on first use"""
+
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label, seconds):
+        """Record one latency under label"""
+
+        histogram = self.histograms.get(label)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(label, LatencyHistogram(self.buckets))
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        """Snapshot of every histogram by label"""
+
+        return {label: histogram.snapshot() for label, histogram in list(self.histograms.items())}
@@ -0,0 +1,138 @@
+# metrics.py
+# ©2024, Ovais Quraishi
+"""Prometheus metrics for the caching service
+
+    Recorded on every Redis round trip made by DistributedCache:
+        cache_command_seconds{command,node}  - READ/WRITE/DELETE, PIPELINE for batches
+        cache_reads_total{node,result}       - result is hit or miss
+        cache_payload_bytes{command}         - stored value sizes, as written and as read
+        cache_redis_errors_total{node,error} - connection errors and per-command errors
+    Read at scrape time, so they cost nothing per request:
+        cache_pool_connections{node,replica,state}, cache_pool_max_connections{node,replica}
+        cache_node_keys{node}                - DBSIZE of each node's master
+
+    Under gunicorn set PROMETHEUS_MULTIPROC_DIR to a directory shared by the
+    workers (emptied before start) so /metrics adds up every worker's counters
+    and histograms; the pool gauges are the answering worker's own.
+"""
+
+import logging
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily
+
+# a Redis round trip is usually well under a millisecond
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+COMMAND_SECONDS = Histogram('cache_command_seconds', 'Redis round trip per command and node',
+                            ['command', 'node'], buckets=LATENCY_BUCKETS)
+READS = Counter('cache_reads', 'READ results per node', ['node', 'result'])
+PAYLOAD_BYTES = Histogram('cache_payload_bytes', 'Size of values stored in Redis',
+                          ['command'], buckets=SIZE_BUCKETS)
+REDIS_ERRORS = Counter('cache_redis_errors', 'Redis errors per node and type', ['node', 'error'])
+
+# label children are looked up once, .labels() takes a lock on every call
+_children = {}
+_collectors = []
+
+def child(metric, *labels):
+    """Cached metric.labels(*labels)"""
+
+    key = (metric, labels)
+    labelled = _children.get(key)
+    if labelled is None:
+        labelled = _children.setdefault(key, metric.labels(*labels))
+    return labelled
+
+def observe_round_trip(node, requests, results, seconds):
+    """Record one round trip to node: latency, READ hits/misses, READ sizes
+        and per-command errors
+    """
+
+    command = requests[0]["command"] if len(requests) == 1 else "PIPELINE"
+    child(COMMAND_SECONDS, command, node).observe(seconds)
+    for request, result in zip(requests, results):
+        if isinstance(result, Exception):
+            child(REDIS_ERRORS, node, type(result).__name__).inc()
+        elif request["command"] == "READ":
+            if result is None:
+                child(READS, node, "miss").inc()
+            else:
+                child(READS, node, "hit").inc()
+                child(PAYLOAD_BYTES, "READ").observe(len(result))
+
+def observe_write_size(size):
+    """Record the size of one value as written"""
+
+    child(PAYLOAD_BYTES, "WRITE").observe(size)
+
+def observe_error(node, error):
+    """Record a Redis error that failed a whole round trip"""
+
+    child(REDIS_ERRORS, node, type(error).__name__).inc()
+
+class CacheCollector:
+    def __init__(self, cache, key_counts=True):
+        """Connection pool gauges and, with key_counts, DBSIZE per node
+            key_counts needs blocking clients, the asyncio cache turns it off.
+        """
+
+        self.cache = cache
+        self.key_counts = key_counts
+
+    def describe(self):
+        """Nothing to declare up front, keeps register() from scraping Redis"""
+
+        return []
+
+    def collect(self):
+        """Called by the registry on every scrape"""
+
+        connections = GaugeMetricFamily('cache_pool_connections', 'Pool connections by state',
+                                        labels=['node', 'replica', 'state'])
+        max_connections = GaugeMetricFamily('cache_pool_max_connections', 'Pool size limit',
+                                            labels=['node', 'replica'])
+        for node, usage in self.cache.pool_stats().items():
+            pools = [("", usage)]
+            pools += [(f"{replica['host']}:{replica['port']}", replica) for replica in usage.get("replicas", [])]
+            for replica, pool in pools:
+                for state in ("in_use", "idle"):
+                    connections.add_metric([node, replica, state], pool[state])
+                max_connections.add_metric([node, replica], pool["max_connections"])
+        yield connections
+        yield max_connections
+
+        if self.key_counts:
+            keys = GaugeMetricFamily('cache_node_keys', 'Keys held by each node', labels=['node'])
+            for node, client in self.cache.shard_clients():
+                try:
+                    keys.add_metric([node], client.dbsize())
+                except Exception as e:
+                    logging.warning("dbsize on %s failed: %s", node, e)
+            yield keys
+
+def register_cache(cache, key_counts=True):
+    """Export a cache's scrape-time gauges, replacing the cache exported before
+        One cache per process is exported; registering again, e.g. after
+        rebuilding the cache, must not leave the old one's gauges behind.
+    """
+
+    while _collectors:
+        REGISTRY.unregister(_collectors.pop())
+    collector = CacheCollector(cache, key_counts)
+    REGISTRY.register(collector)
+    _collectors.append(collector)
+
+def render():
+    """Current metrics in the text exposition format, returns (body, content type)"""
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        for collector in _collectors:
+            registry.register(collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -4,7 +4,8 @@
 """
 
 import requests
-import json
+from backend_loader import CachedLoader, NotFound, WriteBehind
+from cache_client import CacheClient
 from config import get_config
 
 # disable SSL certificate verification (for development only)
@@ -14,76 +15,61 @@ requests.packages.urllib3.disable_warnings()
 CACHE_URL = 'https://localhost:8000/cache'
 LOGIN_URL = 'https://localhost:8000/login'
 
+# Define the URL of the backend data source
+BACKEND_URL = 'https://backend-service-url/data'
+
 CONFIG = get_config()
 
-# API key 
+# API key
 API_KEY = CONFIG.get('service','SRVC_SHARED_SECRET')
 
-def get_access_token(api_key):
-    """Get JWT token
-    """
+cache_client = CacheClient(CACHE_URL, LOGIN_URL, API_KEY, verify=False)
+backend = requests.Session()
+backend.verify = False
 
-    payload = {'api_key': api_key}
-    response = requests.post(LOGIN_URL, json=payload, verify=False)
-    if response.status_code == 200:
-        return response.json().get('access_token')
-    else:
-        return None
+# 10 minutes +/- 10% for data, 30 seconds for ids the backend does not have
+loader = CachedLoader(cache_client, ttl=600, jitter=0.1, negative_ttl=30)
 
-def write_to_cache(key, value, access_token):
-    """Write data to the cache
+@loader.cached(lambda key: key)
+def fetch_from_backend(key):
+    """Get data from backend
     """
 
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    payload = {'command': 'WRITE', 'key': key, 'value': value}
-    response = requests.post(CACHE_URL, headers=headers, json=payload, verify=False)
+    response = backend.get(BACKEND_URL + '/' + key, timeout=10)
+    if response.status_code == 404:
+        raise NotFound(key)
+    response.raise_for_status()
     return response.json()
 
-def read_from_cache(key, access_token):
-    """Read data from the cache
+def write_to_backend(batch):
+    """Store a batch of {key: data} in the backend
     """
 
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    payload = {'command': 'READ', 'key': key}
-    response = requests.post(CACHE_URL, headers=headers, json=payload, verify=False)
-    return response.json()
-
-def fetch_from_backend(key):
-	"""Get data from backend
-	"""
+    response = backend.post(BACKEND_URL + '/batch', json=batch, timeout=10)
+    response.raise_for_status()
 
-    #TODO 
-    pass
-    response = requests.get(BACKEND_URL + '/' + key, verify=False)
-    return response
+# cache now, backend writes batched every 50ms
+write_behind = WriteBehind(cache_client, write_to_backend, ttl=600, window=0.05)
 
 def get_data_from_cache_or_backend(key):
-	"""Get data from cache or the backend
-	"""
-
-    access_token = get_access_token(API_KEY)
-    if access_token:
-        cache_response = read_from_cache(key, access_token)
-        if cache_response.get('status') == 'SUCCESS':
-            return cache_response['value']
-        else:
-            backend_response = fetch_from_backend(key)
-            if backend_response.status_code == 200:
-                cache_response = write_to_cache(key, backend_response.json(), access_token)
-                if cache_response.get('status') == 'SUCCESS':
-                    return backend_response.json()
-                else:
-                    return None  # Failed to cache data
-            else:
-                return None  # Failed to fetch data from backend
-    else:
-        return None  # Failed to obtain access token
+    """Get data from cache or the backend, None when the backend has none
+    """
+
+    try:
+        return fetch_from_backend(key)
+    except NotFound:
+        return None
+
+def save_data(key, data):
+    """Update data: readable from the cache at once, persisted in the background
+    """
+
+    return write_behind.write(key, data)
 
 if __name__ == "__main__":
     key = 'example_key'
-    data = get_data_from_cache_or_backend(key) #TODO
+    data = get_data_from_cache_or_backend(key)
     if data is not None:
         print("Data:", data)
     else:
         print("Failed to retrieve data.")
-
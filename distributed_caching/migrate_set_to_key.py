@@ -1,76 +1,176 @@
 #!/usr/bin/env python3
 # ©2024, Ovais Quraishi
 
-"""Copy contents of a given Redis Set to a Key"""
-
+"""Copy contents of a given Redis Set to a Key
+
+    Each member m of the set becomes an empty string key <set_name>_m. Members
+    are streamed with SSCAN, and each batch is written with one pipeline of
+    SET NX: a key that already exists is left alone and counted, so no separate
+    existence check is needed. A bounded number of workers share one
+    connection pool. The SSCAN cursor is checkpointed to a file so an
+    interrupted run can --resume; batches are idempotent, so redoing the one
+    in flight at the time of the interruption is harmless.
+
+    how-to:
+        ./migrate_set_to_key.py comment_id --workers 8 --batch 1000
+        ./migrate_set_to_key.py comment_id --resume
+"""
+
+import argparse
 import asyncio
-import redis
+import json
+import time
+from pathlib import Path
+
+import redis.asyncio as aredis
 
 # Import required local modules
 from config import get_config
 
 CONFIG = get_config()
 
-def redis_client() -> redis.StrictRedis:
-    """Configure and return a Redis client instance."""
+def redis_client(max_connections) -> aredis.StrictRedis:
+    """Configure and return a Redis client backed by one bounded pool."""
 
     host = CONFIG.get('redis','host')
     port = CONFIG.get('redis','port')
     password = CONFIG.get('redis','password')
 
-    return redis.StrictRedis(host=host, port=port, password=password)
-
-def get_set_values(set_name):
-    """Get Set values, and return a pythonic list"""
-
-    byte_list = redis_client().smembers(set_name)
-    string_list = [set_name + '_' + z.decode("utf-8") for z in byte_list]  # bytes to string
-
-    return string_list
-
-def get_key(key):
-    """Read key"""
-
-    a_key = redis_client().get(key)
-
-    return a_key
-
-async def add_key(key):
-    """Add Key"""
-
-    redis_client().set(key, '')
-
-    return
-
-async def worker(a_val):
-    """Async function"""
-
-    if get_key(a_val) is not None:
-        print('Key Already Exists:', a_val)
-    else:
-        await add_key(a_val)
-        if get_key(a_val) is not None:
-            print('Key Added:', a_val)
-        else:
-            print('Key Not Found:', a_val)
-
-
-async def main():
+    pool = aredis.BlockingConnectionPool(host=host, port=port, password=password,
+                                         max_connections=max_connections)
+    return aredis.StrictRedis(connection_pool=pool)
+
+class Checkpoint:
+    def __init__(self, path, set_name):
+        """SSCAN cursor below which every batch has been written, and the
+            added/existing counts of exactly those batches
+        """
+
+        self.path = Path(path)
+        self.set_name = set_name
+        self.cursor = 0
+        self.added = 0
+        self.existing = 0
+
+    def load(self):
+        """Pick up where a previous run stopped"""
+
+        if self.path.exists():
+            state = json.loads(self.path.read_text())
+            if state.get('set_name') == self.set_name:
+                self.cursor = state['cursor']
+                self.added = state['added']
+                self.existing = state['existing']
+
+    def save(self):
+        """Write the checkpoint atomically"""
+
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'set_name': self.set_name, 'cursor': self.cursor,
+                                        'added': self.added, 'existing': self.existing}))
+        tmp_path.replace(self.path)
+
+    def clear(self):
+        """Migration finished, nothing to resume"""
+
+        if self.path.exists():
+            self.path.unlink()
+
+async def producer(client, set_name, start_cursor, batch_size, queue, workers):
+    """SSCAN the set, queue (sequence, next_cursor, members) batches"""
+
+    cursor = start_cursor
+    sequence = 0
+    while True:
+        cursor, members = await client.sscan(set_name, cursor, count=batch_size)
+        if members:
+            await queue.put((sequence, cursor, members))
+            sequence += 1
+        if cursor == 0:
+            break
+    for _ in range(workers):
+        await queue.put(None)
+
+async def worker(client, set_name, queue, done):
+    """Write each batch with one pipeline of SET NX"""
+
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        sequence, cursor, members = item
+        async with client.pipeline(transaction=False) as pipe:
+            for member in members:
+                pipe.set(f"{set_name}_{member.decode('utf-8')}", '', nx=True)
+            results = await pipe.execute()
+        added = sum(1 for result in results if result)
+        done(sequence, cursor, added, len(results) - added)
+
+async def migrate(set_name, batch_size, workers, checkpoint, report_every):
+    """Run the migration, returns (seconds, keys processed)"""
+
+    client = redis_client(max_connections=workers + 1)
+    queue = asyncio.Queue(maxsize=workers * 2)
+    start = time.monotonic()
+    start_count = checkpoint.added + checkpoint.existing
+    finished = {}  # sequence -> (cursor, added, existing), for batches done out of order
+    state = {'next': 0, 'last_report': start}
+
+    def done(sequence, cursor, added, existing):
+        finished[sequence] = (cursor, added, existing)
+        # only move the checkpoint past batches that are all written, and only
+        #   count those, so a resumed run does not count later batches twice
+        advanced = False
+        while state['next'] in finished:
+            checkpoint.cursor, batch_added, batch_existing = finished.pop(state['next'])
+            checkpoint.added += batch_added
+            checkpoint.existing += batch_existing
+            state['next'] += 1
+            advanced = True
+        now = time.monotonic()
+        if advanced and now - state['last_report'] >= report_every:
+            checkpoint.save()
+            state['last_report'] = now
+            processed = checkpoint.added + checkpoint.existing - start_count
+            print(f"added={checkpoint.added} existing={checkpoint.existing} "
+                  f"{processed / (now - start):.0f} keys/s")
+
+    try:
+        await asyncio.gather(producer(client, set_name, checkpoint.cursor, batch_size, queue, workers),
+                             *(worker(client, set_name, queue, done) for _ in range(workers)))
+    finally:
+        await client.aclose()
+    return time.monotonic() - start, checkpoint.added + checkpoint.existing - start_count
+
+def main():
     """Main"""
 
-    # get set values as a pythonic list
-    set_list = get_set_values('comment_id')
-
-    tasks = []
-
-    for a_val in set_list:
-        task = asyncio.create_task(worker(a_val))
-        tasks.append(task)
-
-    await asyncio.gather(*tasks)
-
-if __name__ == "__main__":
-    # run the program using the asyncio event loop 
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('set_name', nargs='?', default='comment_id')
+    parser.add_argument('--batch', type=int, default=1000, help='SSCAN COUNT and pipeline size')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--checkpoint', default=None, help='defaults to .migrate_<set_name>.json')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint')
+    parser.add_argument('--report-every', type=float, default=5, help='seconds between progress lines')
+    args = parser.parse_args()
+
+    checkpoint = Checkpoint(args.checkpoint or f".migrate_{args.set_name}.json", args.set_name)
+    if args.resume:
+        checkpoint.load()
+        print(f"resuming {args.set_name} at cursor {checkpoint.cursor}")
+
+    # run the program using the asyncio event loop
     #  started at the top level.
+    try:
+        elapsed, processed = asyncio.run(migrate(args.set_name, args.batch, args.workers,
+                                                 checkpoint, args.report_every))
+    except (KeyboardInterrupt, Exception):
+        checkpoint.save()
+        print(f"stopped at cursor {checkpoint.cursor}, rerun with --resume")
+        raise
+    checkpoint.clear()
+    print(f"done: added={checkpoint.added} existing={checkpoint.existing} "
+          f"{processed / elapsed if elapsed else 0:.0f} keys/s")
 
-    asyncio.run(main())
+if __name__ == "__main__":
+    main()
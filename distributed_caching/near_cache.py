@@ -0,0 +1,95 @@
+# near_cache.py
+# ©2024, Ovais Quraishi
+"""Bounded in-process (L1) cache that sits in front of the Redis tier
+
+    LRU eviction with a per-entry TTL. The TTL caps how long a worker can serve
+    a value that another worker has since changed, should an invalidation
+    message be missed.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+class NearCache:
+    def __init__(self, max_size=10000, ttl=5):
+        """max_size entries, each kept for at most ttl seconds"""
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return (True, value) on a hit, (False, None) on a miss"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entry when full"""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """Drop keys, missing keys are ignored"""
+
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate_prefixes(self, prefixes):
+        """Drop every key starting with one of prefixes"""
+
+        prefixes = tuple(prefixes)
+        if not prefixes:
+            return
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefixes)]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop everything"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Hit/miss/eviction counters"""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
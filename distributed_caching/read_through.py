@@ -0,0 +1,137 @@
+# read_through.py
+# ©2024, Ovais Quraishi
+"""Read-through caching with stampede protection
+
+    ReadThrough.get(key, loader) returns the cached value, calling loader() to
+    fill the cache only when needed, and makes sure a hot key expiring does not
+    send every caller to the backend at once:
+
+    * single-flight: only the caller holding a short Redis lock (SET NX PX,
+      released with a compare-and-delete script) runs the loader; the others
+      wait for its result instead of loading themselves
+    * stale-while-revalidate: entries live in Redis stale_ttl seconds past
+      their logical expiry; while one caller refreshes, the rest get the stale
+      value immediately
+    * XFetch probabilistic early expiration: each read refreshes early with a
+      probability that grows as expiry nears and with how long the loader took
+      (delta), so refreshes spread out before the entry goes stale
+
+    Entries are stored as {"value", "delta", "expiry"} envelopes through the
+    cache's value encoding (serializer, plus encryption for encrypted key
+    prefixes), so keys managed here are meant to be read here.
+
+    This is a library for processes that hold a DistributedCache and own the
+    loader, such as a worker next to the backend; the loader is code, so there
+    is no /cache command for it. HTTP clients of the service use
+    backend_loader.CachedLoader instead.
+
+        from cache_settings import READ_THROUGH_CONFIG, R_NODES
+        from distributed_cache import DistributedCache
+        read_through = ReadThrough(DistributedCache(R_NODES), **READ_THROUGH_CONFIG)
+        profile = read_through.get(f"profile:{user_id}", lambda: load_profile(user_id))
+"""
+
+import math
+import random
+import time
+import uuid
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class ReadThrough:
+    def __init__(self, cache, ttl=600, stale_ttl=60, lock_lease=10, beta=1.0, poll_interval=0.05):
+        """cache is a DistributedCache; times are in seconds
+            lock_lease bounds how long a crashed loader can block a key, and how
+            long waiters wait before loading themselves.
+        """
+
+        self.cache = cache
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lock_lease = lock_lease
+        self.beta = beta
+        self.poll_interval = poll_interval
+        self._release_script = cache.redis_clients[0].register_script(RELEASE_LOCK_SCRIPT)
+
+    def lock_key(self, key):
+        """Lock guarding the refresh of key"""
+
+        return f"{key}:lock"
+
+    def acquire(self, client, key):
+        """Try to take the refresh lock, returns the lock token or None"""
+
+        token = uuid.uuid4().hex
+        if client.set(self.lock_key(key), token, nx=True, px=int(self.lock_lease * 1000)):
+            return token
+        return None
+
+    def release(self, client, key, token):
+        """Drop the refresh lock if we still own it"""
+
+        self._release_script(keys=[self.lock_key(key)], args=[token], client=client)
+
+    def fetch(self, client, key):
+        """Read the envelope stored for key, None on a miss or once invalidated"""
+
+        raw = client.get(key)
+        if raw is None or self.cache.is_stale(key, raw):
+            return None
+        return self.cache.decode_value(raw)
+
+    def should_refresh(self, entry, now):
+        """XFetch: refresh early with probability rising towards expiry"""
+
+        return now - entry["delta"] * self.beta * math.log(1.0 - random.random()) >= entry["expiry"]
+
+    def load(self, client, key, loader, ttl):
+        """Call loader and store its value with the time it took"""
+
+        start = time.time()
+        value = loader()
+        delta = time.time() - start
+        entry = {"value": value, "delta": delta, "expiry": time.time() + ttl}
+        client.set(key, self.cache.encode_value(key, entry), px=int((ttl + self.stale_ttl) * 1000))
+        return value
+
+    def get(self, key, loader, ttl=None):
+        """Return the value for key, loading it through loader() when needed"""
+
+        ttl = self.ttl if ttl is None else ttl
+        client = self.cache.redis_clients[self.cache.get_node(key)]
+
+        entry = self.fetch(client, key)
+        if entry is not None:
+            if not self.should_refresh(entry, time.time()):
+                return entry["value"]
+            token = self.acquire(client, key)
+            if token is None:
+                # someone else is refreshing: serve what we have
+                return entry["value"]
+            try:
+                return self.load(client, key, loader, ttl)
+            finally:
+                self.release(client, key, token)
+
+        token = self.acquire(client, key)
+        if token is not None:
+            try:
+                return self.load(client, key, loader, ttl)
+            finally:
+                self.release(client, key, token)
+
+        # cold miss while another caller loads: wait for its result
+        deadline = time.monotonic() + self.lock_lease
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            entry = self.fetch(client, key)
+            if entry is not None:
+                return entry["value"]
+            if not client.exists(self.lock_key(key)):
+                break  # loader gave up without storing anything
+        return self.load(client, key, loader, ttl)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# ©2024, Ovais Quraishi
+"""Move keys to their new owners after the node list changed
+
+    Scans every node of the old and new lists and looks each key up on the new
+    hash ring. Keys that belong elsewhere are moved in pipelined batches: DUMP +
+    PTTL on the source, RESTORE without REPLACE on the owner, then one script
+    on the source deletes each key only if it still dumps the same. A key the
+    owner already holds (BUSYKEY) was written there since the change and is
+    newer, so the source copy is just dropped. A key written or deleted on the
+    source meanwhile is left there, counted as changed, and its copy is taken
+    off the owner again. Tag index sets are per node: members whose key moved
+    are moved to the same tag's index on the key's new node. Nodes are scanned
+    concurrently.
+
+    Every key is on its source, its owner or both for the whole move, so the
+    service keeps serving: list the old nodes in [redis] previous_nodes (and
+    the new ones in nodes), and READs that miss, and DELETEs, are repeated on
+    a key's old owner. Clear previous_nodes once this has finished; run it
+    again first if it reported changed keys.
+
+    Not for [redis] mode=cluster: a Redis Cluster is resharded with
+    redis-cli --cluster reshard/rebalance while the service keeps serving.
+
+    how-to:
+        ./rebalance.py --old node1,node2,node3 --new node1,node2,node3,node4
+        ./rebalance.py   # old/new from [redis] previous_nodes and nodes
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+# Import required local modules
+from cache_settings import HOT_COPY_PREFIX, R_MODE, R_NODES, R_PREVIOUS_NODES, TAG_INDEX_PREFIX
+from distributed_cache import DistributedCache
+
+# deletes each key (KEYS) whose DUMP still equals its payload (ARGV), returns 1
+#   per deleted key and 0 per key that changed since it was dumped
+DELETE_UNCHANGED_SCRIPT = """
+local deleted = {}
+for index, key in ipairs(KEYS) do
+    if redis.call('dump', key) == ARGV[index] then
+        redis.call('del', key)
+        deleted[index] = 1
+    else
+        deleted[index] = 0
+    end
+end
+return deleted
+"""
+
+class Progress:
+    def __init__(self, report_every):
+        """Counters shared by the node scanners"""
+
+        self.report_every = report_every
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.scanned = 0
+        self.moved = 0
+        self.existing = 0
+        self.changed = 0
+        self._lock = threading.Lock()
+
+    def add(self, scanned, moved=0, existing=0, changed=0):
+        """Count a finished batch"""
+
+        with self._lock:
+            self.scanned += scanned
+            self.moved += moved
+            self.existing += existing
+            self.changed += changed
+            now = time.monotonic()
+            if now - self.last_report >= self.report_every:
+                self.last_report = now
+                print(self.summary())
+
+    def summary(self):
+        """Totals, throughput and the fraction of keys that were misplaced"""
+
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        misplaced = self.moved + self.existing
+        fraction = misplaced / self.scanned if self.scanned else 0
+        return (f"scanned={self.scanned} moved={self.moved} already_there={self.existing} "
+                f"changed_during_move={self.changed} misplaced {fraction:.1%} {self.moved / elapsed:.0f} moved keys/s")
+
+def move_batch(cache, source, target, keys):
+    """Move keys from node index source to target
+        Returns (keys moved, keys the target already held, keys that changed
+        on the source after they were dumped and were left there).
+    """
+
+    source_client = cache.redis_clients[source]
+    target_client = cache.redis_clients[target]
+    pipe = source_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+
+    present = [(key, payload, ttl) for key, payload, ttl in zip(keys, results[0::2], results[1::2])
+               if payload is not None and ttl != -2]
+    if not present:
+        return 0, 0, 0
+
+    # copy first: the key stays readable on the source until the owner has it
+    pipe = target_client.pipeline(transaction=False)
+    for key, payload, ttl in present:
+        pipe.restore(key, max(ttl, 0), payload)
+    restored, existing, failed = [], [], []
+    for item, result in zip(present, pipe.execute(raise_on_error=False)):
+        if isinstance(result, redis.ResponseError) and 'BUSYKEY' in str(result):
+            existing.append(item)  # written on the owner since the change, newer
+        elif isinstance(result, Exception):
+            failed.append(result)
+        else:
+            restored.append(item)
+
+    # then drop the source copy, but only if it is still exactly what was
+    #   copied: a write or delete that reached the source meanwhile wins
+    settled = restored + existing
+    if not settled:
+        raise failed[0]
+    delete_unchanged = source_client.register_script(DELETE_UNCHANGED_SCRIPT)
+    deleted = delete_unchanged(keys=[key for key, _, _ in settled], args=[payload for _, payload, _ in settled])
+    stale_copies = [item for item, was_deleted in zip(restored, deleted) if not was_deleted]
+    if stale_copies:
+        # the owner must not serve the copy of a value that changed, or of a
+        #   key that was deleted, on the source; it is reread from there
+        delete_unchanged = target_client.register_script(DELETE_UNCHANGED_SCRIPT)
+        delete_unchanged(keys=[key for key, _, _ in stale_copies], args=[payload for _, payload, _ in stale_copies])
+    if failed:
+        raise failed[0]
+    return sum(deleted[:len(restored)]), sum(deleted[len(restored):]), len(settled) - sum(deleted)
+
+def move_tag_index(cache, source, index):
+    """Move the members of one tag index on node source to the same index on
+        their owners. Returns the number of members moved.
+    """
+
+    client = cache.redis_clients[source]
+    by_target = {}
+    for member in client.smembers(index):
+        target = cache.get_node(member.decode('utf-8'))
+        if target != source:
+            by_target.setdefault(target, []).append(member)
+    for target, members in by_target.items():
+        cache.redis_clients[target].sadd(index, *members)
+        client.srem(index, *members)
+    return sum(len(members) for members in by_target.values())
+
+def rebalance_node(cache, source, batch_size, progress):
+    """SCAN one node, move every key whose owner is now another node"""
+
+    client = cache.redis_clients[source]
+    hot_prefix = HOT_COPY_PREFIX.encode()
+    tag_prefix = TAG_INDEX_PREFIX.encode()
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, count=batch_size)
+        by_target = {}
+        for key in keys:
+            if key.startswith(hot_prefix):
+                continue  # hot key copies live off their owner on purpose
+            if key.startswith(tag_prefix):
+                move_tag_index(cache, source, key)
+                continue
+            target = cache.get_node(key.decode('utf-8'))
+            if target != source:
+                by_target.setdefault(target, []).append(key)
+        moved = existing = changed = 0
+        for target, misplaced in by_target.items():
+            batch_moved, batch_existing, batch_changed = move_batch(cache, source, target, misplaced)
+            moved += batch_moved
+            existing += batch_existing
+            changed += batch_changed
+        progress.add(len(keys), moved, existing, changed)
+        if cursor == 0:
+            return
+
+def rebalance(old_nodes, new_nodes, batch_size, report_every):
+    """Move keys from the old layout to the new one, returns the Progress"""
+
+    cache = DistributedCache(nodes=new_nodes, previous_nodes=old_nodes)
+    progress = Progress(report_every)
+    with ThreadPoolExecutor(max_workers=len(cache.nodes)) as executor:
+        futures = [executor.submit(rebalance_node, cache, source, batch_size, progress)
+                   for source in range(len(cache.nodes))]
+        for future in futures:
+            future.result()
+    return progress
+
+def main():
+    """Main"""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--old', default=','.join(R_PREVIOUS_NODES), help='node list before the change')
+    parser.add_argument('--new', default=','.join(R_NODES), help='node list after the change')
+    parser.add_argument('--batch', type=int, default=1000, help='SCAN COUNT and pipeline size')
+    parser.add_argument('--report-every', type=float, default=5, help='seconds between progress lines')
+    args = parser.parse_args()
+
+    if R_MODE == 'cluster':
+        parser.error("[redis] mode=cluster: the cluster moves its own slots, use redis-cli --cluster reshard")
+    old_nodes = [node.strip() for node in args.old.split(',') if node.strip()]
+    new_nodes = [node.strip() for node in args.new.split(',') if node.strip()]
+    if not old_nodes or not new_nodes:
+        parser.error("both the old and the new node list are needed")
+
+    progress = rebalance(old_nodes, new_nodes, args.batch, args.report_every)
+    print(f"done: {progress.summary()}")
+
+if __name__ == "__main__":
+    main()
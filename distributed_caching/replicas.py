@@ -0,0 +1,119 @@
+# replicas.py
+# ©2024, Ovais Quraishi
+"""Read routing across the Redis replicas of one master
+
+    Reads are spread round-robin over the replicas that are healthy. A replica
+    is skipped while it is marked down after a connection error, or while a
+    background check finds its replication link down or its offset more than
+    max_lag bytes behind the master's. When no replica is usable the caller
+    reads from the master.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+import redis
+
+class ReplicaSet:
+    def __init__(self, configs, master=None, max_lag=1048576, check_interval=5, retry_after=30):
+        """configs holds one redis connection dict per replica, master the
+            master's; without master only the replication link is checked
+        """
+
+        self.configs = configs
+        self.master = master
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self._down_until = [0.0] * len(configs)
+        self._lagging = [False] * len(configs)
+        self._counter = itertools.count()
+        self._monitor = None
+
+    def __len__(self):
+        return len(self.configs)
+
+    def usable(self, index):
+        """A replica is usable when it is neither marked down nor lagging"""
+
+        return not self._lagging[index] and self._down_until[index] <= time.monotonic()
+
+    def pick(self):
+        """Index of the next usable replica, round-robin, or None"""
+
+        if not self.configs:
+            return None
+        start = next(self._counter)
+        for offset in range(len(self.configs)):
+            index = (start + offset) % len(self.configs)
+            if self.usable(index):
+                return index
+        return None
+
+    def mark_down(self, index):
+        """Skip a replica for retry_after seconds"""
+
+        logging.warning("replica %s:%s marked down for %ss",
+                        self.configs[index].get("host"), self.configs[index].get("port"), self.retry_after)
+        self._down_until[index] = time.monotonic() + self.retry_after
+
+    def check(self, clients, master_client=None):
+        """Refresh the lagging flag of every replica from INFO replication
+            A replica lags when its link is down or the replication offset it
+            has processed is more than max_lag bytes behind the master's. The
+            master is asked first, so a replica is never judged against an
+            offset it could not have reached yet.
+        """
+
+        master_offset = None
+        if master_client is not None:
+            try:
+                master_offset = master_client.info("replication").get("master_repl_offset")
+            except redis.RedisError as e:
+                logging.warning("master %s:%s offset check failed: %s",
+                                self.master.get("host"), self.master.get("port"), e)
+        for index, client in enumerate(clients):
+            try:
+                info = client.info("replication")
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.mark_down(index)
+                continue
+            except redis.RedisError as e:
+                logging.warning("replica %s:%s lag check failed: %s",
+                                self.configs[index].get("host"), self.configs[index].get("port"), e)
+                continue
+            link_up = info.get("master_link_status") == "up"
+            behind = 0
+            if master_offset is not None:
+                behind = master_offset - info.get("slave_repl_offset", 0)
+            self._lagging[index] = not link_up or behind > self.max_lag
+
+    def start_monitor(self):
+        """Check replica lag every check_interval seconds in a daemon thread
+            Uses its own sync clients, so it serves the asyncio cache as well.
+        """
+
+        if not self.configs or self._monitor is not None:
+            return
+
+        clients = [redis.StrictRedis(**config) for config in self.configs]
+        master_client = redis.StrictRedis(**self.master) if self.master else None
+
+        def monitor():
+            while True:
+                self.check(clients, master_client)
+                time.sleep(self.check_interval)
+
+        self._monitor = threading.Thread(target=monitor, name="replica-monitor", daemon=True)
+        self._monitor.start()
+
+    def stats(self):
+        """Per replica routing state"""
+
+        return [{"host": config.get("host"),
+                 "port": config.get("port"),
+                 "lagging": self._lagging[index],
+                 "down": self._down_until[index] > time.monotonic()}
+                for index, config in enumerate(self.configs)]
@@ -0,0 +1,93 @@
+# resilience.py
+# ©2024, Ovais Quraishi
+"""Retry and circuit breaker helpers shared by the caching service clients
+"""
+
+import random
+import threading
+import time
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the service while the circuit is open"""
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        """Opens after failure_threshold consecutive failures
+            While open every call fails fast. After reset_timeout seconds one
+            trial call is let through (half-open): success closes the circuit,
+            failure opens it again.
+        """
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """closed, open or half_open"""
+
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through"""
+
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return
+            raise CircuitOpenError("caching service circuit is open")
+
+    def record_success(self):
+        """Close the circuit"""
+
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        """Count a failure, open the circuit at the threshold"""
+
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+def backoff_delays(retries, base=0.05, cap=2.0):
+    """Full jitter exponential backoff: one delay per retry"""
+
+    return [random.uniform(0, min(cap, base * 2 ** attempt)) for attempt in range(retries)]
+
+def is_retryable_status(status_code):
+    """Server side and throttling errors are worth retrying, client errors are not"""
+
+    return status_code >= 500 or status_code == 429
+
+def was_not_processed(error):
+    """True when the service cannot have acted on the request: the connection
+        was never made (refused, or timed out while connecting) or the
+        request was throttled with a 429. Only these are safe to retry for a
+        call that is not idempotent.
+    """
+
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code == 429
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", error.args[0]), NewConnectionError)
+    return False
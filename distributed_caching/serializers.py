@@ -0,0 +1,113 @@
+# serializers.py
+# ©2024, Ovais Quraishi
+"""Binary-safe value encoding for cached payloads
+
+    Every stored value starts with one header byte, 0b11111ccf:
+        f  - format: 0 JSON, 1 msgpack
+        cc - compression: 0 none, 1 zlib, 2 zstd
+    Header bytes 0xF8-0xFF never start a UTF-8 string, so values written before
+    this encoding existed (plain UTF-8 text) are told apart and returned as str.
+
+    msgpack and zstandard are optional: without them the serializer falls back
+    to JSON and zlib.
+
+    One Serializer is shared by every thread of the service. zstd compressors
+    and decompressors are not thread-safe, so each thread gets its own pair.
+"""
+
+import json
+import logging
+import threading
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER_BASE = 0xF8
+FORMATS = {'json': 0, 'msgpack': 1}
+COMPRESSIONS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+class Serializer:
+    def __init__(self, fmt='msgpack', compression='zstd', compress_min_bytes=1024, level=3):
+        """Values at least compress_min_bytes long once encoded are compressed"""
+
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown format {fmt}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown compression {compression}")
+        if fmt == 'msgpack' and msgpack is None:
+            logging.warning("msgpack is not installed, falling back to json")
+            fmt = 'json'
+        if compression == 'zstd' and zstandard is None:
+            logging.warning("zstandard is not installed, falling back to zlib")
+            compression = 'zlib'
+
+        self.fmt = fmt
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        self.level = level
+        self._local = threading.local()
+
+    def zstd(self):
+        """This thread's (ZstdCompressor, ZstdDecompressor)"""
+
+        pair = getattr(self._local, 'zstd', None)
+        if pair is None:
+            pair = self._local.zstd = (zstandard.ZstdCompressor(level=self.level), zstandard.ZstdDecompressor())
+        return pair
+
+    def encode(self, value):
+        """Turn a JSON-compatible value into bytes"""
+
+        if self.fmt == 'msgpack':
+            return msgpack.packb(value, use_bin_type=True)
+        return json.dumps(value, separators=(',', ':')).encode()
+
+    def dumps(self, value):
+        """Encode, compress if large enough, and prefix the header byte"""
+
+        payload = self.encode(value)
+        compression = 'none'
+        if self.compression != 'none' and len(payload) >= self.compress_min_bytes:
+            if self.compression == 'zstd':
+                compressed = self.zstd()[0].compress(payload)
+            else:
+                compressed = zlib.compress(payload, self.level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                compression = self.compression
+
+        header = HEADER_BASE | (COMPRESSIONS[compression] << 1) | FORMATS[self.fmt]
+        return bytes((header,)) + payload
+
+    def loads(self, data):
+        """Decode whatever dumps produced, whichever codec wrote it"""
+
+        if data is None:
+            return None
+        if not data or data[0] < HEADER_BASE:
+            # written before the header byte existed
+            return data.decode('utf-8', errors='replace')
+
+        header = data[0]
+        payload = data[1:]
+        compression = (header >> 1) & 0b11
+        if compression == COMPRESSIONS['zstd']:
+            if zstandard is None:
+                raise ValueError("value is zstd compressed but zstandard is not installed")
+            payload = self.zstd()[1].decompress(payload)
+        elif compression == COMPRESSIONS['zlib']:
+            payload = zlib.decompress(payload)
+
+        if header & 1:
+            if msgpack is None:
+                raise ValueError("value is msgpack encoded but msgpack is not installed")
+            return msgpack.unpackb(payload, raw=False)
+        return json.loads(payload)
@@ -3,12 +3,13 @@
    how-to:
         ./test_app.py
         Write Response: {'command': 'WRITE', 'status': 'SUCCESS', 'value': 'my_value'}
-        Read Response: {'command': 'READ', 'status': 'SUCCESS', 'value': 'my_value'}
+        Read Response: {'command': 'READ', 'status': 'SUCCESS', 'value': 'my_value',
+                        'etag': '<sha1 of the stored value, for CAS>'}
         Delete Response: {'command': 'DELETE', 'message': 'my_key Key deleted', 'status': 'SUCCESS'}
 """
 
 import requests
-import json
+from cache_client import CacheClient
 from config import get_config
 
 # disable SSL certificate verification (for development only)
@@ -20,73 +21,23 @@ LOGIN_URL = 'https://localhost:8000/login'
 
 CONFIG = get_config()
 
-def get_access_token(api_key):
-    """Get JWT token
-    """
-
-    payload = {
-        'api_key': api_key
-    }
-    response = requests.post(LOGIN_URL, json=payload, verify=False)
-    if response.status_code == 200:
-        return response.json().get('access_token')
-    else:
-        return None
-
-def write_to_cache(key, value, access_token):
-    """Write data to the cache
-    """
-
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    payload = {
-        'command': 'WRITE',
-        'key': key,
-        'value': value
-    }
-    response = requests.post(CACHE_URL, headers=headers, json=payload, verify=False)
-    return response.json()
-
-def read_from_cache(key, access_token):
-    """Read data from the cache
-    """
-
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    payload = {
-        'command': 'READ',
-        'key': key
-    }
-    response = requests.post(CACHE_URL, headers=headers, json=payload, verify=False)
-    return response.json()
-
-def delete_from_cache(key, access_token):
-    """Delete data from the cache
-    """
-
-    headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
-    payload = {
-        'command': 'DELETE',
-        'key': key
-    }
-    response = requests.post(CACHE_URL, headers=headers, json=payload, verify=False)
-    return response.json()
-
 if __name__ == "__main__":
 
     api_key = CONFIG.get('service','SRVC_SHARED_SECRET')
 
-    # get JWT token
-    access_token = get_access_token(api_key)
-    if access_token:
+    # logs in on first use and reuses the JWT afterwards
+    client = CacheClient(CACHE_URL, LOGIN_URL, api_key, verify=False)
+    try:
         # write data to the cache
-        write_response = write_to_cache('my_key', 'my_value', access_token)
+        write_response = client.write('my_key', 'my_value')
         print("Write Response:", write_response)
 
         # read data from the cache
-        read_response = read_from_cache('my_key', access_token)
+        read_response = client.read('my_key')
         print("Read Response:", read_response)
 
         # delete data from the cache
-        delete_response = delete_from_cache('my_key', access_token)
+        delete_response = client.delete('my_key')
         print("Delete Response:", delete_response)
-    else:
-        print("Failed to obtain access token.")
+    except requests.exceptions.RequestException as e:
+        print("Caching service request failed:", e)
@@ -0,0 +1,94 @@
+# conftest.py
+# ©2024, Ovais Quraishi
+"""Shared fixtures: the caching modules on fakeredis, one fake server per node
+
+    test.config is loaded instead of setup.config, so nothing here needs a
+    Redis server. pip install pytest fakeredis, then run python -m pytest
+    from distributed_caching.
+"""
+
+import hashlib
+import os
+import sys
+
+import fakeredis
+import pytest
+from fakeredis.commands_mixins.scripting_mixin import ScriptingCommandsMixin
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import config  # noqa: E402
+
+config.CONFIG_FILE = os.path.join(TESTS_DIR, 'test.config')
+
+NODES = ["node1", "node2", "node3"]
+
+_server_runtime = ScriptingCommandsMixin._get_server_runtime
+
+def _server_runtime_with_sha1hex(self, server):
+    """fakeredis's Lua runtime has no redis.sha1hex, the etag scripts need it"""
+
+    runtime = _server_runtime(self, server)
+    if not getattr(server, "_sha1hex_added", False):
+        server._sha1hex_added = True
+        runtime.globals().redis.sha1hex = lambda data: hashlib.sha1(data).hexdigest().encode()
+    return runtime
+
+ScriptingCommandsMixin._get_server_runtime = _server_runtime_with_sha1hex
+
+@pytest.fixture
+def fake_servers(monkeypatch):
+    """{(host, port): FakeServer}, DistributedCache.connect() hands out clients of these"""
+
+    from distributed_cache import DistributedCache
+
+    servers = {}
+
+    def connect(self, configs):
+        clients = [fakeredis.FakeStrictRedis(server=servers.setdefault((config["host"], str(config["port"])),
+                                                                       fakeredis.FakeServer()))
+                   for config in configs]
+        return [client.connection_pool for client in clients], clients
+
+    monkeypatch.setattr(DistributedCache, "connect", connect)
+    return servers
+
+@pytest.fixture
+def make_cache(fake_servers):
+    """Build DistributedCache instances on the fake servers, stopped after the test"""
+
+    from distributed_cache import DistributedCache
+
+    caches = []
+
+    def make(**options):
+        options.setdefault("nodes", NODES)
+        cache = DistributedCache(**options)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        for listener in cache.listeners:
+            listener.stop()
+        cache.executor.shutdown(wait=False)
+
+@pytest.fixture
+def service(make_cache, monkeypatch):
+    """Flask test client of caching.py on a fresh cache, with a bearer token"""
+
+    import caching
+    from flask_jwt_extended import create_access_token
+
+    monkeypatch.setattr(caching, "cache", make_cache())
+    with caching.app.app_context():
+        token = create_access_token(identity="tester")
+    client = caching.app.test_client()
+
+    def post(payload):
+        response = client.post('/cache', json=payload, headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        return response.get_json()
+
+    return post
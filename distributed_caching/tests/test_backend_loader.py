@@ -0,0 +1,54 @@
+# test_backend_loader.py
+# ©2024, Ovais Quraishi
+"""CachedLoader and WriteBehind on a fakeredis cache"""
+
+import pytest
+
+from backend_loader import CachedLoader, WriteBehind
+
+class FlakyBackend:
+    """write_batch that fails its first `failures` calls"""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.batches = []
+
+    def __call__(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("backend down")
+        self.batches.append(dict(batch))
+
+def test_write_behind_retries_a_failed_batch(make_cache):
+    cache = make_cache()
+    backend = FlakyBackend(failures=2)
+    behind = WriteBehind(cache, backend, window=0.001, retries=3, backoff=0)
+    assert behind.write("item:1", {"n": 1}).result(timeout=5) == 1
+    assert backend.batches == [{"item:1": {"n": 1}}]
+    assert cache.read("item:1")["value"] == {"n": 1}
+    stats = behind.stats()
+    assert (stats["retried_batches"], stats["failed_batches"], stats["written"]) == (2, 0, 1)
+
+def test_write_behind_drops_keys_the_backend_never_got(make_cache):
+    cache = make_cache()
+    cache.write("item:2", "untouched")
+    behind = WriteBehind(cache, FlakyBackend(failures=10), window=0.001, retries=1, backoff=0)
+    future = behind.write("item:1", "lost")
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5)
+    assert cache.read("item:1")["status"] == "NOT_FOUND"
+    assert cache.read("item:2")["value"] == "untouched"
+    stats = behind.stats()
+    assert (stats["failed_batches"], stats["invalidated"]) == (1, 1)
+
+def test_loader_calls_the_backend_when_a_cache_batch_fails():
+    class RefusedBatches:
+        def read(self, key):
+            raise ValueError("MREAD requires a list of string keys")
+
+        def write(self, key, value, expire=None):
+            raise ValueError("MWRITE requires a list of string keys")
+
+    loader = CachedLoader(RefusedBatches())
+    assert loader.get("item:1", lambda: "from backend") == "from backend"
+    assert loader.stats()["cache_errors"] == 1
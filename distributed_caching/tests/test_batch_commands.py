@@ -0,0 +1,29 @@
+# test_batch_commands.py
+# ©2024, Ovais Quraishi
+"""MREAD/MWRITE/MDELETE through the /cache endpoint"""
+
+import pytest
+
+def test_mwrite_mread_mdelete_round_trip(service):
+    keys = [f"batch:{index}" for index in range(20)]
+    response = service({"command": "MWRITE", "keys": keys, "values": list(range(20))})
+    assert response["status"] == "SUCCESS"
+    assert [result["key"] for result in response["results"]] == keys
+
+    response = service({"command": "MREAD", "keys": keys + ["batch:missing"]})
+    assert [result.get("value") for result in response["results"]] == list(range(20)) + [None]
+    assert response["results"][-1]["status"] == "NOT_FOUND"
+
+    response = service({"command": "MDELETE", "keys": keys})
+    assert all(result["status"] == "SUCCESS" for result in response["results"])
+    assert service({"command": "READ", "key": "batch:3"})["status"] == "NOT_FOUND"
+
+def test_mwrite_lengths_must_match(service):
+    response = service({"command": "MWRITE", "keys": ["a", "b"], "values": [1]})
+    assert response == {"command": "MWRITE", "status": "ERROR", "message": "keys and values differ in length"}
+
+@pytest.mark.parametrize("command", ["MREAD", "MWRITE", "MDELETE"])
+@pytest.mark.parametrize("keys", ["a", None, [1, None], ["a", 2], [["a"]]])
+def test_batch_keys_must_be_a_list_of_strings(service, command, keys):
+    response = service({"command": command, "keys": keys, "values": [1, 2]})
+    assert response == {"status": "ERROR", "message": command + " requires a list of string keys"}
@@ -0,0 +1,111 @@
+# test_cache_client.py
+# ©2024, Ovais Quraishi
+"""CacheClient retries and circuit breaker, without a service"""
+
+import json
+import time
+
+import pytest
+import requests
+
+from cache_client import CacheClient
+from resilience import CircuitBreaker, CircuitOpenError
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+@pytest.fixture
+def client(monkeypatch):
+    """CacheClient whose HTTP calls are answered by client.replies, in order"""
+
+    client = CacheClient("http://cache/cache", "http://cache/login", "key", batch_window=0,
+                         retries=2, backoff=0, failure_threshold=2, reset_timeout=0.05)
+    client.replies = []
+    client.sent = []
+
+    def post(url, payload):
+        client.sent.append(payload)
+        reply = client.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(client.api, "post", post)
+    return client
+
+def test_breaker_lets_one_trial_through_when_half_open():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "half_open"
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+def test_retries_connection_errors_and_5xx(client):
+    client.replies = [requests.exceptions.ConnectionError(), http_error(503), {"status": "SUCCESS"}]
+    assert client.read("a") == {"status": "SUCCESS"}
+    assert len(client.sent) == 3
+    assert client.breaker.state == "closed"
+
+def test_client_errors_are_not_retried(client):
+    client.replies = [http_error(400)]
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.read("a")
+    assert len(client.sent) == 1
+    assert client.breaker.failures == 0
+
+def test_circuit_opens_after_consecutive_failures(client):
+    client.replies = [requests.exceptions.Timeout()] * 6
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.Timeout):
+            client.read("a")
+    assert client.breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        client.read("a")
+    assert len(client.sent) == 6
+
+@pytest.mark.parametrize("error", [requests.exceptions.ChunkedEncodingError(),
+                                   json.JSONDecodeError("Expecting value", "", 0),
+                                   ValueError("token has no exp claim")])
+def test_unexpected_error_in_trial_call_releases_the_circuit(client, error):
+    client.breaker.record_failure()
+    client.breaker.record_failure()
+    assert client.breaker.state == "open"
+    time.sleep(client.breaker.reset_timeout)
+
+    client.replies = [error]
+    with pytest.raises(type(error)):
+        client.read("a")
+    assert client.breaker.state == "open"
+    time.sleep(client.breaker.reset_timeout)
+    client.replies = [{"status": "SUCCESS"}]
+    assert client.read("a") == {"status": "SUCCESS"}
+    assert client.breaker.state == "closed"
+
+@pytest.mark.parametrize("call", [lambda client: client.incr("n"),
+                                  lambda client: client.write_nx("lock", "me"),
+                                  lambda client: client.cas("doc", 1, "etag")])
+@pytest.mark.parametrize("error", [requests.exceptions.Timeout(), requests.exceptions.ReadTimeout(),
+                                   http_error(503)])
+def test_non_idempotent_calls_are_not_retried_once_sent(client, call, error):
+    client.replies = [error, {"status": "SUCCESS"}]
+    with pytest.raises(type(error)):
+        call(client)
+    assert len(client.sent) == 1
+    assert client.breaker.failures == 1
+
+def test_non_idempotent_calls_retry_a_failed_connect(client):
+    try:
+        requests.post("http://127.0.0.1:1/cache", timeout=1)
+    except requests.exceptions.ConnectionError as e:
+        refused = e
+    client.replies = [refused, requests.exceptions.ConnectTimeout(), http_error(429), {"status": "SUCCESS", "value": 1}]
+    client.retries = 3
+    assert client.incr("n") == {"status": "SUCCESS", "value": 1}
+    assert len(client.sent) == 4
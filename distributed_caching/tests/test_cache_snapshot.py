@@ -0,0 +1,44 @@
+# test_cache_snapshot.py
+# ©2024, Ovais Quraishi
+"""cache_snapshot.py dump and restore, onto a different node list"""
+
+import cache_snapshot
+from conftest import NODES
+
+def test_dump_restore_round_trip_onto_more_nodes(make_cache, tmp_path):
+    old = make_cache()
+    keys = [f"snap:{index}" for index in range(200)]
+    old.mwrite(keys, [{"index": index} for index in range(200)], expire=600, tags=["snap"])
+    old.write("snap:forever", "no expiry", expire=0)
+    old.key_client("snap:gone").set("snap:gone", b"x", px=1)
+
+    path = tmp_path / "cache.snap"
+    dumped = cache_snapshot.dump(old, path, batch_size=50, report_every=3600)
+    assert dumped.keys >= len(keys) + 1
+    for client in old.redis_clients:
+        client.flushall()
+
+    new = make_cache(nodes=NODES + ["node4"], previous_nodes=[])
+    restored = cache_snapshot.restore(new, path, batch_size=50, replace=False, report_every=3600)
+    assert restored.keys == dumped.keys
+    results = new.mread(keys)["results"]
+    assert [result["value"] for result in results] == [{"index": index} for index in range(200)]
+    for key in keys:
+        owner = new.get_node(key)
+        assert [index for index, client in enumerate(new.redis_clients) if client.exists(key)] == [owner]
+        assert 0 < new.redis_clients[owner].ttl(key) <= 600
+    assert new.key_client("snap:forever").ttl("snap:forever") == -1
+    assert new.read("snap:gone")["status"] == "NOT_FOUND"
+    assert new.invalidate_tags(["snap"])["deleted"] == len(keys)
+
+def test_restore_keeps_existing_keys_unless_replace(make_cache, tmp_path):
+    cache = make_cache()
+    cache.write("snap:a", "old")
+    path = tmp_path / "cache.snap"
+    cache_snapshot.dump(cache, path, batch_size=10, report_every=3600)
+    cache.write("snap:a", "new")
+
+    assert cache_snapshot.restore(cache, path, 10, replace=False, report_every=3600).keys == 0
+    assert cache.read("snap:a")["value"] == "new"
+    cache_snapshot.restore(cache, path, 10, replace=True, report_every=3600)
+    assert cache.read("snap:a")["value"] == "old"
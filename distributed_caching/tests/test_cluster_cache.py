@@ -0,0 +1,74 @@
+# test_cluster_cache.py
+# ©2024, Ovais Quraishi
+"""ClusterCache routing and per-slot transactions, on a one-server stand-in
+    for a RedisCluster client (fakeredis has no cluster mode)
+"""
+
+import fakeredis
+import pytest
+import redis
+from redis.crc import key_slot
+
+from distributed_cache import ClusterCache
+
+class FakeClusterClient(fakeredis.FakeStrictRedis):
+    """What ClusterCache uses of RedisCluster, every slot on one server"""
+
+    def keyslot(self, key):
+        return key_slot(key.encode() if isinstance(key, str) else key)
+
+@pytest.fixture
+def cluster(monkeypatch):
+    def connect(self, configs):
+        return [None] * len(configs), [FakeClusterClient(server=fakeredis.FakeServer()) for _ in configs]
+
+    monkeypatch.setattr(ClusterCache, "connect", connect)
+    cache = ClusterCache(["127.0.0.1:7000"])
+    yield cache
+    cache.executor.shutdown(wait=False)
+
+def test_keys_go_to_the_one_cluster_client(cluster):
+    keys = [f"cluster:{index}" for index in range(20)]
+    assert {cluster.get_node(key) for key in keys} == {0}
+    assert cluster.mwrite(keys, keys, tags=["batch"])["status"] == "SUCCESS"
+    assert [result["value"] for result in cluster.mread(keys)["results"]] == keys
+    assert cluster.invalidate_tags(["batch"])["deleted"] == len(keys)
+
+def test_transaction_runs_one_multi_exec_per_slot(cluster, monkeypatch):
+    keys = [f"{{user:{index % 3}}}:{index}" for index in range(12)]
+    slots = []
+    run_slot = cluster.execute_slot_transaction
+
+    def counting(client, requests):
+        slots.append({client.keyslot(request["key"]) for request in requests})
+        return run_slot(client, requests)
+
+    monkeypatch.setattr(cluster, "execute_slot_transaction", counting)
+    with cluster.pipeline(transaction=True) as pipe:
+        for key in keys:
+            pipe.write(key, key)
+        assert all(response["status"] == "SUCCESS" for response in pipe.execute())
+    assert len(slots) == 3 and all(len(slot) == 1 for slot in slots)
+    assert [result["value"] for result in cluster.mread(keys)["results"]] == keys
+
+def test_slot_transaction_is_retried_while_the_slot_moves(cluster, monkeypatch):
+    client = cluster.redis_clients[0]
+    pipeline = client.pipeline
+    refusals = [redis.exceptions.TryAgainError("TRYAGAIN"), redis.exceptions.AskError("866 127.0.0.1:7001")]
+
+    def migrating_pipeline(transaction=True):
+        pipe = pipeline(transaction=transaction)
+        execute = pipe.execute
+
+        def refused_execute(raise_on_error=True):
+            if refusals:
+                raise refusals.pop(0)
+            return execute(raise_on_error=raise_on_error)
+        pipe.execute = refused_execute
+        return pipe
+
+    monkeypatch.setattr(client, "pipeline", migrating_pipeline)
+    requests = [{"command": "WRITE", "key": "{a}:1", "value": 1}, {"command": "READ", "key": "{a}:1"}]
+    replies = cluster.execute_slot_transaction(client, requests)
+    assert not refusals
+    assert replies[0] is True and cluster.decode_value(replies[1]) == 1
@@ -0,0 +1,105 @@
+# test_conditional_writes.py
+# ©2024, Ovais Quraishi
+"""WRITE_NX, CAS and INCR, on their own and under prefix invalidation"""
+
+import time
+
+import pytest
+
+from serializers import Serializer
+
+@pytest.fixture
+def bus_cache(make_cache):
+    """A cache with the invalidation bus, so values are stamped"""
+
+    return make_cache(invalidation_bus=True)
+
+def invalidate(cache, prefix):
+    """Invalidate prefix, leaving the ms clock past the watermark"""
+
+    time.sleep(0.002)
+    assert cache.invalidate(prefixes=[prefix])["status"] == "SUCCESS"
+    time.sleep(0.002)
+
+def test_write_nx(make_cache):
+    cache = make_cache()
+    created = cache.write_nx("lock:a", "owner1", expire=30)
+    assert created["status"] == "SUCCESS"
+    assert cache.write_nx("lock:a", "owner2")["status"] == "EXISTS"
+    read = cache.read("lock:a", read_your_writes=True)
+    assert read["value"] == "owner1"
+    assert read["etag"] == created["etag"]
+
+def test_cas(make_cache):
+    cache = make_cache()
+    cache.write("doc", {"version": 1})
+    etag = cache.read("doc")["etag"]
+    updated = cache.cas("doc", {"version": 2}, etag)
+    assert updated["status"] == "SUCCESS"
+    assert cache.cas("doc", {"version": 3}, etag)["status"] == "CONFLICT"
+    assert cache.cas("missing", 1, etag)["status"] == "CONFLICT"
+    assert cache.read("doc")["value"] == {"version": 2}
+    assert cache.read("doc")["etag"] == updated["etag"]
+
+@pytest.mark.parametrize("with_bus", [False, True])
+def test_incr_reads_back_as_an_int(make_cache, with_bus):
+    cache = make_cache(invalidation_bus=with_bus)
+    assert cache.incr("hits")["value"] == 1
+    assert cache.incr("hits", 5)["value"] == 6
+    assert cache.incr("hits", -2)["value"] == 4
+    assert cache.read("hits")["value"] == 4
+
+@pytest.mark.parametrize("fmt", ["msgpack", "json"])
+@pytest.mark.parametrize("with_bus", [False, True])
+def test_incr_counts_on_from_an_int_write(make_cache, fmt, with_bus):
+    cache = make_cache(serializer=Serializer(fmt=fmt, compression="zlib"), invalidation_bus=with_bus)
+    values = [0, 5, 127, 128, 255, 256, 65535, 65536, 2 ** 32, 2 ** 40, -1, -32, -33, -128, -129, -40000, -2 ** 40]
+    for index, value in enumerate(values):
+        key = f"counter:{index}"
+        cache.write(key, value)
+        assert cache.incr(key, 2)["value"] == value + 2, value
+        assert cache.read(key)["value"] == value + 2
+
+def test_incr_refuses_other_msgpack_values(make_cache):
+    cache = make_cache()
+    for value in [2.5, "5", [5], True]:
+        cache.write("counter", value)
+        assert cache.incr("counter")["status"] == "ERROR", value
+        assert cache.read("counter")["value"] == value
+
+def test_incr_keeps_the_expiry_of_the_counter(make_cache):
+    cache = make_cache()
+    cache.incr("window", expire=100)
+    client = cache.key_client("window")
+    client.expire("window", 50)
+    cache.incr("window", expire=100)
+    assert 0 < client.ttl("window") <= 50
+
+def test_incr_refuses_values_that_are_not_counters(make_cache):
+    cache = make_cache()
+    cache.write("name", "text")
+    response = cache.incr("name")
+    assert response["status"] == "ERROR"
+    assert cache.read("name")["value"] == "text"
+
+def test_incr_invalidate_incr_read(bus_cache):
+    bus_cache.incr("profile:1:visits")
+    assert bus_cache.incr("profile:1:visits")["value"] == 2
+    invalidate(bus_cache, "profile:1:")
+    assert bus_cache.read("profile:1:visits")["status"] == "NOT_FOUND"
+    assert bus_cache.incr("profile:1:visits")["value"] == 1
+    assert bus_cache.read("profile:1:visits")["value"] == 1
+
+def test_write_nx_writes_over_an_invalidated_value(bus_cache):
+    bus_cache.write("profile:2:name", "old")
+    invalidate(bus_cache, "profile:2:")
+    assert bus_cache.write_nx("profile:2:name", "new")["status"] == "SUCCESS"
+    assert bus_cache.read("profile:2:name")["value"] == "new"
+    assert bus_cache.write_nx("profile:2:name", "newer")["status"] == "EXISTS"
+
+def test_cas_conflicts_on_an_invalidated_value(bus_cache):
+    bus_cache.write("profile:3:name", "old")
+    etag = bus_cache.read("profile:3:name")["etag"]
+    invalidate(bus_cache, "profile:3:")
+    assert bus_cache.cas("profile:3:name", "new", etag)["status"] == "CONFLICT"
+    assert bus_cache.read("profile:3:name")["status"] == "NOT_FOUND"
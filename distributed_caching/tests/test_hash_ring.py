@@ -0,0 +1,56 @@
+# test_hash_ring.py
+# ©2024, Ovais Quraishi
+"""HashRing: even spread over the nodes, about 1/N of the keys moving per change"""
+
+from collections import Counter
+
+import pytest
+
+from hash_ring import HashRing
+
+KEYS = [f"key:{index}" for index in range(30000)]
+
+def owners(ring):
+    return {key: ring.get_node(key) for key in KEYS}
+
+@pytest.mark.parametrize("count", [2, 3, 5, 8])
+def test_vnodes_spread_keys_evenly(count):
+    ring = HashRing([f"node{index}" for index in range(count)])
+    per_node = Counter(owners(ring).values())
+    assert len(per_node) == count
+    mean = len(KEYS) / count
+    assert all(0.75 * mean <= keys <= 1.25 * mean for keys in per_node.values())
+
+def test_adding_a_node_moves_about_one_nth_to_it():
+    ring = HashRing(["node1", "node2", "node3"])
+    before = owners(ring)
+    ring.add_node("node4")
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert 0.2 <= len(moved) / len(KEYS) <= 0.3
+    assert {after[key] for key in moved} == {"node4"}
+
+def test_removing_a_node_moves_only_its_keys():
+    ring = HashRing(["node1", "node2", "node3", "node4"])
+    before = owners(ring)
+    ring.remove_node("node2")
+    after = owners(ring)
+
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert {before[key] for key in moved} == {"node2"}
+    assert len(moved) == sum(owner == "node2" for owner in before.values())
+    assert 0.2 <= len(moved) / len(KEYS) <= 0.3
+
+def test_get_nodes_starts_with_the_owner():
+    ring = HashRing(["node1", "node2", "node3"])
+    for key in KEYS[:200]:
+        nodes = ring.get_nodes(key, 5)
+        assert nodes[0] == ring.get_node(key)
+        assert sorted(nodes) == ["node1", "node2", "node3"]
+
+def test_empty_ring_and_duplicate_nodes():
+    with pytest.raises(LookupError):
+        HashRing().get_node("key")
+    with pytest.raises(ValueError):
+        HashRing(["node1", "node1"])
@@ -0,0 +1,43 @@
+# test_hot_keys.py
+# ©2024, Ovais Quraishi
+"""HotKeyTracker ranking, and hot keys copied to and read from other nodes"""
+
+from cache_settings import HOT_COPY_PREFIX, HOT_KEYS_CONFIG
+from hot_keys import HotKeyTracker
+
+def test_tracker_finds_the_hot_key():
+    tracker = HotKeyTracker(top_k=5, threshold=50, decay_interval=3600)
+    for index in range(1000):
+        tracker.record(f"cold:{index}")
+        if index % 5 == 0:
+            tracker.record("hot")
+    assert tracker.top(1)[0][0] == "hot"
+    assert tracker.is_hot("hot")
+    assert not tracker.is_hot("cold:1")
+
+def test_tracker_default_matches_the_config_fallback():
+    assert HotKeyTracker().threshold == HOT_KEYS_CONFIG["threshold"]
+
+def test_hot_key_is_copied_and_read_from_every_copy(make_cache):
+    cache = make_cache(hot_keys=HotKeyTracker(top_k=5, threshold=3, decay_interval=3600), hot_key_copies=3)
+    cache.write("hot", "value")
+    owner = cache.get_node("hot")
+    copy_nodes = [node for node in range(3) if node != owner]
+
+    reads = [cache.read("hot") for _ in range(60)]
+    assert all(read["value"] == "value" for read in reads)
+    assert "hot" in cache.hot_key_stats()["replicated"]
+    for node in copy_nodes:
+        assert cache.redis_clients[node].exists(HOT_COPY_PREFIX + "hot")
+        assert 0 < cache.redis_clients[node].pttl(HOT_COPY_PREFIX + "hot") <= cache.hot_key_copy_ttl * 1000
+    # a copy carries no etag, the owner's READ does
+    assert any("etag" not in read for read in reads) and any("etag" in read for read in reads)
+
+def test_write_drops_the_copies(make_cache):
+    cache = make_cache(hot_keys=HotKeyTracker(top_k=5, threshold=3, decay_interval=3600), hot_key_copies=3)
+    cache.write("hot", "old")
+    for _ in range(20):
+        cache.read("hot")
+    cache.write("hot", "new")
+    assert not any(client.exists(HOT_COPY_PREFIX + "hot") for client in cache.redis_clients)
+    assert {cache.read("hot")["value"] for _ in range(20)} == {"new"}
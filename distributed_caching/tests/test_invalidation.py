@@ -0,0 +1,60 @@
+# test_invalidation.py
+# ©2024, Ovais Quraishi
+"""INVALIDATE through the bus, and data_sync without it"""
+
+import time
+
+import pytest
+
+import data_sync
+
+def test_prefix_invalidation_hides_older_values(make_cache):
+    cache = make_cache(invalidation_bus=True)
+    cache.write("profile:1:name", "old")
+    cache.write("order:1", "kept")
+
+    response = cache.invalidate(prefixes=["profile:1:"])
+    assert response == {"command": "INVALIDATE", "status": "SUCCESS", "keys": 0, "prefixes": 1}
+    assert cache.read("profile:1:name")["status"] == "NOT_FOUND"
+    assert cache.read("order:1")["value"] == "kept"
+
+    time.sleep(0.002)  # watermarks and stamps are in ms
+    cache.write("profile:1:name", "new")
+    assert cache.read("profile:1:name")["value"] == "new"
+
+def test_key_invalidation_deletes(make_cache):
+    cache = make_cache(invalidation_bus=True)
+    cache.mwrite(["a", "b"], [1, 2])
+    assert cache.invalidate(keys=["a", "b"])["keys"] == 2
+    assert [result["status"] for result in cache.mread(["a", "b"])["results"]] == ["NOT_FOUND", "NOT_FOUND"]
+
+def test_invalidate_without_bus_is_an_error(service):
+    response = service({"command": "INVALIDATE", "keys": ["a"]})
+    assert response == {"command": "INVALIDATE", "status": "ERROR", "message": "invalidation bus is not enabled"}
+
+@pytest.mark.parametrize("payload", [{"keys": "a"}, {"keys": [1]}, {"prefixes": [None]}])
+def test_invalidate_needs_lists_of_strings(service, payload):
+    response = service(dict(payload, command="INVALIDATE"))
+    assert response == {"status": "ERROR", "message": "INVALIDATE requires lists of string keys and/or prefixes"}
+
+@pytest.fixture
+def sync_client(service, monkeypatch):
+    """data_sync's CacheClient talking to the Flask test client"""
+
+    monkeypatch.setattr(data_sync.cache_client.api, "post", lambda url, payload: service(payload))
+    monkeypatch.setattr(data_sync.cache_client, "batch_window", 0)
+    return data_sync.cache_client
+
+def test_profile_invalidation_falls_back_to_delete(service, sync_client):
+    service({"command": "MWRITE", "keys": ["profile:1", "profile:2", "profile:3"], "values": [1, 2, 3]})
+    assert data_sync.invalidate_cached_profile("1")
+    assert data_sync.invalidate_cached_profiles(["2", "3", "4"])
+    response = service({"command": "MREAD", "keys": ["profile:1", "profile:2", "profile:3"]})
+    assert [result["status"] for result in response["results"]] == ["NOT_FOUND"] * 3
+
+def test_update_profile_reports_a_failed_invalidation(sync_client, monkeypatch):
+    monkeypatch.setattr(data_sync, "update_backend_profile", lambda *args: type("Response", (), {"status_code": 200}))
+    monkeypatch.setattr(data_sync, "invalidate_keys", lambda keys: False)
+    assert data_sync.update_profile("1", {}, "token") is False
+    monkeypatch.setattr(data_sync, "invalidate_keys", lambda keys: True)
+    assert data_sync.update_profile("1", {}, "token") is True
@@ -0,0 +1,28 @@
+# test_near_cache.py
+# ©2024, Ovais Quraishi
+"""Near cache in front of READ and MREAD"""
+
+from near_cache import NearCache
+
+def test_mread_fetches_only_near_cache_misses(make_cache, monkeypatch):
+    cache = make_cache(near_cache=NearCache(100, 60))
+    cache.mwrite(["near:a", "near:b", "near:c"], [1, 2, 3])
+    assert cache.read("near:a")["value"] == 1
+
+    sent = []
+    send_batch = cache.send_batch
+
+    def recording_send_batch(node, requests, transaction=False):
+        sent.extend(request["key"] for request in requests)
+        return send_batch(node, requests, transaction)
+
+    monkeypatch.setattr(cache, "send_batch", recording_send_batch)
+    results = cache.mread(["near:a", "near:b", "near:c"])["results"]
+    assert [(result["key"], result["value"]) for result in results] == [("near:a", 1), ("near:b", 2), ("near:c", 3)]
+    assert sorted(sent) == ["near:b", "near:c"]
+
+    sent.clear()
+    cache.mread(["near:a", "near:b", "near:c"])
+    assert sent == []
+    cache.mread(["near:a"], read_your_writes=True)
+    assert sent == ["near:a"]
@@ -0,0 +1,50 @@
+# test_pipeline.py
+# ©2024, Ovais Quraishi
+"""CachePipeline: node grouping, request order and concurrent flushes"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+def test_pipeline_keeps_request_order_across_nodes(make_cache):
+    cache = make_cache()
+    keys = [f"pipe:{index}" for index in range(30)]
+    assert len({cache.get_node(key) for key in keys}) == 3
+
+    with cache.pipeline() as pipe:
+        for index, key in enumerate(keys):
+            pipe.write(key, index)
+        pipe.read(keys[0]).delete(keys[1]).read(keys[1])
+        responses = pipe.execute()
+
+    assert [response["key"] for response in responses] == keys + [keys[0], keys[1], keys[1]]
+    assert responses[-3]["value"] == 0
+    assert responses[-2]["status"] == "SUCCESS"
+    assert responses[-1]["status"] == "NOT_FOUND"
+
+def test_transaction_pipeline_writes_every_node(make_cache):
+    cache = make_cache()
+    keys = [f"tx:{index}" for index in range(12)]
+    with cache.pipeline(transaction=True) as pipe:
+        for key in keys:
+            pipe.write(key, key)
+        assert all(response["status"] == "SUCCESS" for response in pipe.execute())
+    assert [result["value"] for result in cache.mread(keys)["results"]] == keys
+
+def test_concurrent_batches_do_not_queue_behind_each_other(make_cache, monkeypatch):
+    """Two request threads, each with a batch for every node: all six node
+        batches have to be in flight at once to get past the barrier
+    """
+
+    cache = make_cache()
+    keys = [f"fan:{index}" for index in range(30)]
+    barrier = threading.Barrier(2 * len(cache.nodes), timeout=5)
+    send_batch = cache.send_batch
+
+    def waiting_send_batch(node, requests, transaction=False):
+        barrier.wait()
+        return send_batch(node, requests, transaction)
+
+    monkeypatch.setattr(cache, "send_batch", waiting_send_batch)
+    with ThreadPoolExecutor(max_workers=2) as callers:
+        results = list(callers.map(lambda _: cache.mread(keys), range(2)))
+    assert all(len(result["results"]) == len(keys) for result in results)
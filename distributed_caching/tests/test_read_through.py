@@ -0,0 +1,93 @@
+# test_read_through.py
+# ©2024, Ovais Quraishi
+"""ReadThrough stampede protection against a backend that counts its calls"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from read_through import ReadThrough
+
+CALLERS = 16
+
+class CountingBackend:
+    """Loader that takes `delay` seconds, or until release() when gated"""
+
+    def __init__(self, delay=0.1, gated=False):
+        self.delay = delay
+        self.calls = 0
+        self.gate = threading.Event()
+        if not gated:
+            self.gate.set()
+        self._lock = threading.Lock()
+
+    def load(self, value):
+        with self._lock:
+            self.calls += 1
+        self.gate.wait(timeout=5)
+        time.sleep(self.delay)
+        return value
+
+def stampede(read_through, key, loader):
+    """CALLERS threads calling get(key) at once, returns their values"""
+
+    barrier = threading.Barrier(CALLERS, timeout=5)
+
+    def call(_):
+        barrier.wait()
+        return read_through.get(key, loader)
+
+    with ThreadPoolExecutor(max_workers=CALLERS) as callers:
+        return list(callers.map(call, range(CALLERS)))
+
+@pytest.fixture
+def read_through(make_cache):
+    return ReadThrough(make_cache(), ttl=60, stale_ttl=60, lock_lease=5, poll_interval=0.01)
+
+def test_expired_hot_key_is_loaded_once(make_cache):
+    read_through = ReadThrough(make_cache(), ttl=0.01, stale_ttl=0.05, lock_lease=5, poll_interval=0.01)
+    read_through.get("profile:1", lambda: "v1")
+    time.sleep(0.15)  # past the stale window too: Redis has dropped it
+    assert not read_through.cache.key_client("profile:1").exists("profile:1")
+
+    backend = CountingBackend()
+    assert stampede(read_through, "profile:1", lambda: backend.load("v2")) == ["v2"] * CALLERS
+    assert backend.calls == 1
+
+def test_stale_value_is_served_while_one_caller_refreshes(read_through):
+    read_through.get("profile:2", lambda: "old", ttl=0.01)
+    time.sleep(0.05)  # past its logical expiry, still in Redis for stale_ttl
+    backend = CountingBackend(delay=0, gated=True)
+
+    refresher = []
+
+    def call(_):
+        value = read_through.get("profile:2", lambda: backend.load("new"))
+        if value == "new":
+            refresher.append(value)
+        return value
+
+    with ThreadPoolExecutor(max_workers=CALLERS) as callers:
+        futures = [callers.submit(call, index) for index in range(CALLERS)]
+        # everyone but the refresher returns the stale value without waiting
+        deadline = time.monotonic() + 5
+        while sum(future.done() for future in futures) < CALLERS - 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        values = [future.result() for future in futures if future.done()]
+        assert values == ["old"] * (CALLERS - 1)
+        backend.gate.set()
+    assert refresher == ["new"]
+    assert backend.calls == 1
+    assert read_through.get("profile:2", lambda: backend.load("newer")) == "new"
+
+def test_lock_of_a_crashed_loader_expires(make_cache):
+    read_through = ReadThrough(make_cache(), lock_lease=0.2, poll_interval=0.01)
+    client = read_through.cache.key_client("profile:3")
+    assert read_through.acquire(client, "profile:3") is not None  # taken, never released
+
+    start = time.monotonic()
+    assert read_through.get("profile:3", lambda: "loaded") == "loaded"
+    assert 0.15 <= time.monotonic() - start < 2
+    assert not client.exists(read_through.lock_key("profile:3"))
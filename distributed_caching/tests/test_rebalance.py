@@ -0,0 +1,76 @@
+# test_rebalance.py
+# ©2024, Ovais Quraishi
+"""rebalance.py moving keys to a fourth node while the service reads them"""
+
+import rebalance
+from conftest import NODES
+
+NEW_NODES = NODES + ["node4"]
+
+def owners(cache, key):
+    """Indexes of the nodes that hold key"""
+
+    return [index for index, client in enumerate(cache.redis_clients) if client.exists(key)]
+
+def test_keys_end_up_on_their_owner_only(make_cache):
+    old = make_cache()
+    keys = [f"move:{index}" for index in range(300)]
+    old.mwrite(keys, keys, expire=600, tags=["moving"])
+
+    progress = rebalance.rebalance(NODES, NEW_NODES, batch_size=50, report_every=3600)
+    new = make_cache(nodes=NEW_NODES, previous_nodes=[])
+    assert progress.moved == sum(new.get_node(key) == 3 for key in keys) > 0
+    assert progress.changed == 0
+    for key in keys:
+        assert owners(new, key) == [new.get_node(key)]
+        assert 0 < new.key_client(key).ttl(key) <= 600
+    assert [result["value"] for result in new.mread(keys)["results"]] == keys
+    assert new.invalidate_tags(["moving"])["deleted"] == len(keys)
+
+def test_owner_copy_written_since_the_change_wins(make_cache):
+    old = make_cache()
+    new = make_cache(nodes=NEW_NODES, previous_nodes=NODES)
+    key = next(f"busy:{index}" for index in range(100) if new.get_node(f"busy:{index}") == 3)
+    old.write(key, "old")
+    new.write(key, "new")
+
+    progress = rebalance.rebalance(NODES, NEW_NODES, batch_size=50, report_every=3600)
+    assert (progress.moved, progress.existing) == (0, 1)
+    assert owners(new, key) == [3]
+    assert new.read(key)["value"] == "new"
+
+def test_key_stays_readable_and_source_changes_win(make_cache, monkeypatch):
+    """Right after the source delete the keys are readable through
+        previous_nodes, and a write to the source just before it keeps the
+        key there
+    """
+
+    old = make_cache()
+    serving = make_cache(nodes=NEW_NODES, previous_nodes=NODES)
+    keys = [key for key in (f"live:{index}" for index in range(200)) if serving.get_node(key) == 3][:10]
+    old.mwrite(keys, keys)
+    rewritten = keys[0]
+    source = old.get_node(rewritten)
+    seen = {}
+
+    mover = make_cache(nodes=NEW_NODES, previous_nodes=NODES)
+    register_script = mover.redis_clients[source].register_script
+
+    def around_source_delete(script):
+        delete_unchanged = register_script(script)
+
+        def run(keys, args):
+            old.write(rewritten, "rewritten")
+            deleted = delete_unchanged(keys=keys, args=args)
+            seen.update((result["key"], result.get("value")) for result in serving.mread(keys_read)["results"])
+            return deleted
+        return run
+
+    keys_read = [key for key in keys if key != rewritten]
+    monkeypatch.setattr(mover.redis_clients[source], "register_script", around_source_delete)
+    moved, existing, changed = rebalance.move_batch(mover, source, 3, [key.encode() for key in keys
+                                                                       if old.get_node(key) == source])
+    assert seen == {key: key for key in keys_read}
+    assert changed == 1 and existing == 0
+    assert owners(serving, rewritten) == [source]
+    assert serving.read(rewritten)["value"] == "rewritten"
@@ -0,0 +1,30 @@
+# test_replicas.py
+# ©2024, Ovais Quraishi
+"""ReplicaSet lag checks from INFO replication"""
+
+from replicas import ReplicaSet
+
+class Info:
+    def __init__(self, replication):
+        self.replication = replication
+
+    def info(self, section):
+        assert section == "replication"
+        return self.replication
+
+CONFIGS = [{"host": "replica1", "port": 6380}, {"host": "replica2", "port": 6381}]
+
+def test_idle_link_is_not_lag():
+    replicas = ReplicaSet(CONFIGS, master={"host": "master", "port": 6379}, max_lag=1000)
+    master = Info({"master_repl_offset": 50000})
+    replicas.check([Info({"master_link_status": "up", "master_last_io_seconds_ago": 9, "slave_repl_offset": 50000}),
+                    Info({"master_link_status": "up", "master_last_io_seconds_ago": 0, "slave_repl_offset": 20000})],
+                   master)
+    assert [replica["lagging"] for replica in replicas.stats()] == [False, True]
+    assert replicas.pick() == 0
+
+def test_link_down_lags_without_master():
+    replicas = ReplicaSet(CONFIGS)
+    replicas.check([Info({"master_link_status": "down", "slave_repl_offset": 0}),
+                    Info({"master_link_status": "up", "slave_repl_offset": 0})])
+    assert [replica["lagging"] for replica in replicas.stats()] == [True, False]
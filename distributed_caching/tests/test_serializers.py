@@ -0,0 +1,34 @@
+# test_serializers.py
+# ©2024, Ovais Quraishi
+"""Serializer round trips, also from many threads at once"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from serializers import Serializer
+
+@pytest.mark.parametrize("fmt", ["json", "msgpack"])
+@pytest.mark.parametrize("compression", ["none", "zlib", "zstd"])
+def test_round_trip(fmt, compression):
+    serializer = Serializer(fmt=fmt, compression=compression)
+    for value in ["text", 5, {"nested": [1, 2.5, None]}, "x" * 5000]:
+        assert serializer.loads(serializer.dumps(value)) == value
+
+def test_legacy_strings_are_returned_as_text():
+    assert Serializer().loads(b"plain value") == "plain value"
+
+@pytest.mark.parametrize("compression", ["zlib", "zstd"])
+def test_concurrent_round_trips_share_one_serializer(compression):
+    """What send_multi does: every node's batch coded on its own thread"""
+
+    serializer = Serializer(fmt="msgpack", compression=compression)
+
+    def round_trips(worker):
+        for index in range(200):
+            value = {"worker": worker, "index": index, "blob": f"{worker}:{index}:" * 300}
+            assert serializer.loads(serializer.dumps(value)) == value
+        return worker
+
+    with ThreadPoolExecutor(max_workers=8) as workers:
+        assert sorted(workers.map(round_trips, range(8))) == list(range(8))
@@ -0,0 +1,53 @@
+# test_tags.py
+# ©2024, Ovais Quraishi
+"""Tag indexes: INVALIDATE_TAG, and index lifetimes following their keys"""
+
+from cache_settings import TAG_INDEX_PREFIX
+
+INDEX = TAG_INDEX_PREFIX + "user:1"
+
+def index_ttls(cache):
+    """TTL of the user:1 index on every node that has one"""
+
+    return [client.ttl(INDEX) for client in cache.redis_clients if client.exists(INDEX)]
+
+def test_invalidate_tag_deletes_tagged_keys_only(make_cache):
+    cache = make_cache()
+    keys = [f"user:1:{index}" for index in range(20)]
+    cache.mwrite(keys, keys, tags=["user:1"])
+    cache.write("user:2:0", "kept", tags=["user:2"])
+
+    response = cache.invalidate_tags(["user:1"])
+    assert (response["status"], response["deleted"]) == ("SUCCESS", len(keys))
+    assert all(result["status"] == "NOT_FOUND" for result in cache.mread(keys)["results"])
+    assert cache.read("user:2:0")["value"] == "kept"
+    assert index_ttls(cache) == []
+
+def test_index_lives_as_long_as_its_longest_lived_key(make_cache):
+    cache = make_cache()
+    key = "user:1:a"
+    cache.write(key, 1, expire=100, tags=["user:1"])
+    client = cache.key_client(key)
+    assert 90 < client.ttl(INDEX) <= 100
+
+    cache.write(key, 2, expire=300, tags=["user:1"])
+    assert 290 < client.ttl(INDEX) <= 300
+    cache.write(key, 3, expire=50, tags=["user:1"])
+    assert 290 < client.ttl(INDEX) <= 300
+
+    cache.write(key, 4, expire=0, tags=["user:1"])
+    assert client.ttl(INDEX) == -1
+    cache.write(key, 5, expire=50, tags=["user:1"])
+    assert client.ttl(INDEX) == -1
+
+def test_batch_index_expiry_covers_every_key(make_cache):
+    cache = make_cache()
+    keys = [f"user:1:{index}" for index in range(30)]
+    cache.mwrite(keys, keys, expire=[10 * (index + 1) for index in range(30)], tags=["user:1"])
+    for client in cache.redis_clients:
+        if client.exists(INDEX):
+            longest = max(client.ttl(member) for member in client.smembers(INDEX))
+            assert longest <= client.ttl(INDEX) <= 300
+
+    cache.mwrite(["user:1:default"], ["default expiry"], tags=["user:1"])
+    assert cache.key_client("user:1:default").ttl(INDEX) > 0